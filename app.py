@@ -1,10 +1,38 @@
 from flask import (
     Flask, render_template, request, jsonify,
-    abort, session
+    abort, session, g, make_response, stream_with_context, has_app_context
 )
+import concurrent.futures
+import bisect
+import contextlib
+import cProfile
+import csv
+import difflib
+import functools
+import gzip
+import io
+import itertools
+import json
+import multiprocessing
 import os
+import re
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import uuid
+import warnings
+import zipfile
+import zlib
+from urllib.parse import urlencode
+import click
+import openpyxl
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 from psycopg2.extras import execute_values
+import numpy as np
 import pandas as pd
 from datetime import datetime
 
@@ -22,7 +50,19 @@ app.secret_key = os.getenv("SECRET_KEY", "dev-secret-key-gaw")
 # ============================================================
 # FUNGSI KONEKSI DATABASE
 # ============================================================
-def get_db():
+# Ukuran pool bisa diatur lewat environment:
+# - DB_POOL_MIN        : koneksi yang langsung dibuka saat pool dibuat
+# - DB_POOL_MAX        : batas koneksi terbuka per proses (per worker gunicorn)
+# - DB_POOL_TIMEOUT    : detik maksimal menunggu koneksi kosong
+# - DB_POOL_PING_AFTER : koneksi yang menganggur lebih lama dari ini (detik)
+#                        dicek dulu dengan "SELECT 1" sebelum dipakai
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_PING_AFTER = float(os.getenv("DB_POOL_PING_AFTER", "30"))
+
+
+def buka_koneksi():
     """
     PRIORITAS:
     1) Kalau ENV DATABASE_URL ada -> pakai itu (Supabase / server lain).
@@ -30,12 +70,15 @@ def get_db():
 
     Setelah connect, kita SET search_path ke metadata_poshujan,public
     supaya tabel tanpa schema (users, pos_hujan, dll) mengarah ke schema itu.
+    Ini cukup sekali per koneksi karena koneksi dipakai ulang oleh pool.
+
+    Semua cursor koneksi ini mencatat durasi query (CursorTerukur).
     """
     db_url = os.getenv("DATABASE_URL")
 
     if db_url:
         # Koneksi via connection string (Supabase)
-        conn = psycopg2.connect(db_url)
+        conn = psycopg2.connect(db_url, cursor_factory=CursorTerukur)
     else:
         # Fallback: koneksi ke PostgreSQL lokal
         conn = psycopg2.connect(
@@ -44,16 +87,196 @@ def get_db():
             user="postgres",
             password="123456",
             port=5432,
+            cursor_factory=CursorTerukur,
         )
 
-    # Set search_path di setiap koneksi
+    # SET ikut transaksi, jadi harus di-commit supaya tidak hilang
+    # kalau transaksi berikutnya di-rollback.
     cur = conn.cursor()
     cur.execute("SET search_path TO metadata_poshujan, public;")
     cur.close()
+    conn.commit()
 
     return conn
 
 
+class PoolKoneksi:
+    """
+    Pool koneksi PostgreSQL yang aman dipakai banyak thread.
+
+    Kalau semua koneksi sedang dipakai dan sudah mencapai maxconn,
+    pemanggil menunggu (bukan error) sampai ada yang dikembalikan
+    atau timeout habis.
+    """
+
+    def __init__(self, minconn, maxconn, timeout, ping_after):
+        self.minconn = max(0, minconn)
+        self.maxconn = max(1, maxconn, self.minconn)
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.pid = os.getpid()
+
+        self._cond = threading.Condition()
+        self._idle = []        # [(conn, waktu_terakhir_dipakai), ...]
+        self._terbuka = 0      # jumlah koneksi terbuka (idle + dipakai)
+        self._stats = {
+            "ambil": 0,
+            "tunggu": 0,
+            "waktu_tunggu_total": 0.0,
+            "waktu_tunggu_max": 0.0,
+            "timeout": 0,
+            "koneksi_baru": 0,
+            "koneksi_dibuang": 0,
+        }
+
+        for _ in range(self.minconn):
+            self._idle.append((self._koneksi_baru(), time.monotonic()))
+            self._terbuka += 1
+
+    def _koneksi_baru(self):
+        conn = buka_koneksi()
+        self._stats["koneksi_baru"] += 1
+        return conn
+
+    def _buang(self, conn):
+        self._stats["koneksi_dibuang"] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _sehat(self, conn, terakhir):
+        if conn.closed:
+            return False
+        if time.monotonic() - terakhir < self.ping_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1;")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def ambil(self):
+        mulai = time.perf_counter()
+        menunggu = False
+        conn, terakhir = None, None
+
+        with self._cond:
+            batas = time.monotonic() + self.timeout
+            while True:
+                if self._idle:
+                    conn, terakhir = self._idle.pop()
+                    break
+                if self._terbuka < self.maxconn:
+                    # slot kosong -> buka koneksi baru di luar lock
+                    self._terbuka += 1
+                    break
+                menunggu = True
+                sisa = batas - time.monotonic()
+                if sisa <= 0 or not self._cond.wait(sisa):
+                    if not self._idle and self._terbuka >= self.maxconn:
+                        self._stats["timeout"] += 1
+                        raise psycopg2.pool.PoolError(
+                            f"Pool koneksi penuh ({self.maxconn}), "
+                            f"tidak ada koneksi kosong dalam {self.timeout} detik."
+                        )
+
+            lama = time.perf_counter() - mulai
+            self._stats["ambil"] += 1
+            if menunggu:
+                self._stats["tunggu"] += 1
+                self._stats["waktu_tunggu_total"] += lama
+                self._stats["waktu_tunggu_max"] = max(self._stats["waktu_tunggu_max"], lama)
+
+        try:
+            if conn is not None and not self._sehat(conn, terakhir):
+                self._buang(conn)
+                conn = None
+            if conn is None:
+                conn = self._koneksi_baru()
+        except Exception:
+            with self._cond:
+                self._terbuka -= 1
+                self._cond.notify()
+            raise
+
+        return conn
+
+    def kembalikan(self, conn):
+        simpan = not conn.closed
+        if simpan and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            # transaksi yang tidak di-commit oleh route dibatalkan
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                simpan = False
+
+        with self._cond:
+            if simpan:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                self._terbuka -= 1
+                self._buang(conn)
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            hasil = dict(self._stats)
+            hasil.update({
+                "pid": self.pid,
+                "min": self.minconn,
+                "max": self.maxconn,
+                "terbuka": self._terbuka,
+                "idle": len(self._idle),
+                "dipakai": self._terbuka - len(self._idle),
+            })
+        hasil["waktu_tunggu_total_ms"] = round(hasil.pop("waktu_tunggu_total") * 1000, 2)
+        hasil["waktu_tunggu_max_ms"] = round(hasil.pop("waktu_tunggu_max") * 1000, 2)
+        return hasil
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Pool dibuat per proses. Setelah fork (worker gunicorn), pid berubah
+    sehingga worker membuat pool sendiri dan tidak memakai socket
+    milik proses induk.
+    """
+    global _pool
+    pool = _pool
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                _pool = PoolKoneksi(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_PING_AFTER)
+            pool = _pool
+    return pool
+
+
+def get_db():
+    """
+    Koneksi untuk request ini. Diambil dari pool sekali saja per request
+    (disimpan di flask.g) dan dikembalikan otomatis di teardown,
+    jadi route TIDAK perlu memanggil conn.close().
+    """
+    if "db_conn" not in g:
+        g.db_conn = get_pool().ambil()
+        pastikan_skema_lazy(g.db_conn)
+    return g.db_conn
+
+
+@app.teardown_appcontext
+def lepas_db(exc):
+    conn = g.pop("db_conn", None)
+    if conn is not None:
+        get_pool().kembalikan(conn)
+
+
 # ============================================================
 # HELPER: CEK LOGIN UNTUK API (UPLOAD)
 # ============================================================
@@ -62,6 +285,743 @@ def ensure_logged_in_api():
         abort(403)
 
 
+# ============================================================
+# STATUS PROSES (DIBAGI ANTAR WORKER GUNICORN)
+# ============================================================
+# Progress upload disimpan di SQLite lokal (bukan di memori) supaya
+# polling dari browser bisa dijawab worker mana pun.
+LOCAL_STATE_DB = os.getenv(
+    "LOCAL_STATE_DB",
+    os.path.join(tempfile.gettempdir(), "webgis_poshujan_state.sqlite3")
+)
+STATUS_SIMPAN_DETIK = 24 * 3600
+
+SKEMA_STATE = [
+    """
+    CREATE TABLE IF NOT EXISTS status_proses (
+        id         TEXT PRIMARY KEY,
+        data       TEXT NOT NULL,
+        diperbarui REAL NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS cache_respons (
+        kunci       TEXT PRIMARY KEY,
+        body        BLOB NOT NULL,
+        mimetype    TEXT NOT NULL,
+        etag        TEXT,
+        dibuat      REAL NOT NULL,
+        dipakai     REAL NOT NULL,
+        kedaluwarsa REAL,
+        ruang       TEXT NOT NULL DEFAULT 'umum'
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS cache_respons_ruang_dipakai ON cache_respons (ruang, dipakai)",
+    """
+    CREATE TABLE IF NOT EXISTS cache_tag (
+        tag   TEXT NOT NULL,
+        kunci TEXT NOT NULL,
+        PRIMARY KEY (tag, kunci)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS cache_tag_kunci ON cache_tag (kunci)",
+    """
+    CREATE TABLE IF NOT EXISTS cache_statistik (
+        nama  TEXT PRIMARY KEY,
+        nilai INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS versi_data (
+        id    INTEGER PRIMARY KEY CHECK (id = 1),
+        versi INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS versi_pos (
+        id    INTEGER PRIMARY KEY CHECK (id = 1),
+        versi INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS metrik (
+        nama  TEXT NOT NULL,
+        label TEXT NOT NULL,
+        le    TEXT NOT NULL,
+        nilai REAL NOT NULL,
+        PRIMARY KEY (nama, label, le)
+    )
+    """,
+]
+# Naikkan kalau struktur tabel cache berubah: tabel cache lama dibuang
+# (isinya memang boleh hilang), status proses tetap disimpan.
+SKEMA_STATE_VERSI = 3
+
+_state_local = threading.local()
+
+
+def state_db():
+    """Koneksi SQLite per thread (dan per proses, dicek lewat pid)."""
+    conn = getattr(_state_local, "conn", None)
+    if conn is None or _state_local.pid != os.getpid():
+        conn = sqlite3.connect(LOCAL_STATE_DB, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        if conn.execute("PRAGMA user_version;").fetchone()[0] < SKEMA_STATE_VERSI:
+            conn.execute("DROP TABLE IF EXISTS cache_respons;")
+            conn.execute("DROP TABLE IF EXISTS cache_tag;")
+            conn.execute(f"PRAGMA user_version = {SKEMA_STATE_VERSI};")
+        for ddl in SKEMA_STATE:
+            conn.execute(ddl)
+        _state_local.conn = conn
+        _state_local.pid = os.getpid()
+    return conn
+
+
+@contextlib.contextmanager
+def transaksi_state():
+    """BEGIN IMMEDIATE: baca-lalu-tulis aman walau dipakai banyak proses."""
+    db = state_db()
+    db.execute("BEGIN IMMEDIATE;")
+    try:
+        yield db
+    except BaseException:
+        db.execute("ROLLBACK;")
+        raise
+    db.execute("COMMIT;")
+
+
+def simpan_status(id_status, **data):
+    """Gabungkan data ke status yang sudah ada (atau buat baru)."""
+    sekarang = time.time()
+    with transaksi_state() as db:
+        row = db.execute("SELECT data FROM status_proses WHERE id = ?", (id_status,)).fetchone()
+        status = json.loads(row[0]) if row else {"dibuat": sekarang}
+        status.update(data)
+        status["diperbarui"] = sekarang
+        db.execute(
+            "INSERT OR REPLACE INTO status_proses (id, data, diperbarui) VALUES (?, ?, ?)",
+            (id_status, json.dumps(status, default=str), sekarang)
+        )
+        if not row:
+            # bersihkan status lama sesekali (setiap ada status baru)
+            db.execute("DELETE FROM status_proses WHERE diperbarui < ?",
+                       (sekarang - STATUS_SIMPAN_DETIK,))
+    return status
+
+
+def baca_status(id_status):
+    row = state_db().execute("SELECT data FROM status_proses WHERE id = ?", (id_status,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+# ============================================================
+# CACHE RESPONS (LRU, DIBAGI ANTAR WORKER)
+# ============================================================
+# Endpoint baca (/api/pos_hujan, /api/curah_hujan, /pos/<id>) selalu
+# menghasilkan respons yang sama sampai ada upload. Respons disimpan di
+# SQLite lokal yang sama dengan status proses, diberi tag, dan dihapus
+# oleh proses upload:
+# - "pos:<id>"  : data satu pos (curah hujan pos itu berubah)
+# - "pos_hujan" : daftar pos + data terkini (peta)
+# - upload metadata menghapus semuanya
+#
+# - CACHE_ENABLED     : "0" untuk mematikan cache
+# - CACHE_MAX_ENTRIES : jumlah respons maksimal (yang paling lama tidak
+#                       dipakai dibuang lebih dulu)
+# - CACHE_MAX_TILE    : sama, khusus tile peta (ruang "tile"): tile yang
+#                       banyak & kecil tidak mendesak respons lain keluar
+# - CACHE_TTL         : umur maksimal respons dalam detik (0 = tanpa batas)
+# - CACHE_FLUSH_DETIK : jeda minimal antar tulis waktu pakai (LRU) dan
+#                       hit/miss ke SQLite
+#
+# cache_ambil hanya membaca (tanpa BEGIN IMMEDIATE): waktu pakai & hit/miss
+# dikumpulkan di memori tiap proses lalu ditulis sekaligus tiap
+# CACHE_FLUSH_DETIK, dan selalu sebelum cache_simpan membuang entri lama.
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "1") != "0"
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "2000"))
+CACHE_MAX_TILE = int(os.getenv("CACHE_MAX_TILE", "5000"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "0"))
+CACHE_FLUSH_DETIK = float(os.getenv("CACHE_FLUSH_DETIK", "5"))
+
+# ruang cache -> jumlah entri maksimal (LRU dihitung per ruang)
+CACHE_RUANG = {"umum": CACHE_MAX_ENTRIES, "tile": CACHE_MAX_TILE}
+
+_cache_tertunda = {"pid": None, "waktu": 0.0, "dipakai": {}, "statistik": {}}
+_cache_tertunda_lock = threading.Lock()
+
+
+def _cek_proses_cache():
+    """Dipanggil dengan _cache_tertunda_lock: proses hasil fork membuang angka milik induk."""
+    if _cache_tertunda["pid"] != os.getpid():
+        _cache_tertunda.update(pid=os.getpid(), waktu=time.monotonic(), dipakai={}, statistik={})
+
+
+def _ambil_cache_tertunda(paksa):
+    """Kosongkan & kembalikan (dipakai, statistik) kalau sudah waktunya ditulis."""
+    sekarang = time.monotonic()
+    with _cache_tertunda_lock:
+        _cek_proses_cache()
+        if not paksa and sekarang - _cache_tertunda["waktu"] < CACHE_FLUSH_DETIK:
+            return None
+        dipakai, statistik = _cache_tertunda["dipakai"], _cache_tertunda["statistik"]
+        _cache_tertunda.update(waktu=sekarang, dipakai={}, statistik={})
+    return dipakai, statistik
+
+
+def _tulis_cache_tertunda(db, dipakai, statistik):
+    db.executemany(
+        "UPDATE cache_respons SET dipakai = MAX(dipakai, ?) WHERE kunci = ?",
+        [(t, kunci) for kunci, t in dipakai.items()]
+    )
+    db.executemany("""
+        INSERT INTO cache_statistik (nama, nilai) VALUES (?, ?)
+        ON CONFLICT (nama) DO UPDATE SET nilai = nilai + excluded.nilai
+    """, list(statistik.items()))
+
+
+def simpan_cache_tertunda(paksa=False):
+    tertunda = _ambil_cache_tertunda(paksa)
+    if tertunda is None or not any(tertunda):
+        return
+    try:
+        with transaksi_state() as db:
+            _tulis_cache_tertunda(db, *tertunda)
+    except sqlite3.Error as e:
+        app.logger.warning("Gagal menyimpan statistik cache: %s", e)
+
+
+def versi_data():
+    """Naik setiap kali upload mengubah data (lihat hapus_cache)."""
+    row = state_db().execute("SELECT versi FROM versi_data WHERE id = 1").fetchone()
+    return row[0] if row else 0
+
+
+def cache_ambil(kunci, statistik=True):
+    sekarang = time.time()
+    row = state_db().execute("""
+        SELECT body, mimetype, etag, kedaluwarsa
+        FROM cache_respons
+        WHERE kunci = ?
+    """, (kunci,)).fetchone()
+    # entri kedaluwarsa dianggap miss; ditimpa / dibuang oleh cache_simpan
+    if row is not None and row[3] is not None and row[3] < sekarang:
+        row = None
+
+    with _cache_tertunda_lock:
+        _cek_proses_cache()
+        if row is not None:
+            _cache_tertunda["dipakai"][kunci] = sekarang
+        if statistik:
+            nama = "miss" if row is None else "hit"
+            _cache_tertunda["statistik"][nama] = _cache_tertunda["statistik"].get(nama, 0) + 1
+    simpan_cache_tertunda()
+
+    if row is None:
+        return None
+    return row[0], row[1], row[2]
+
+
+def cache_simpan(kunci, body, mimetype, etag, tags, versi, ruang="umum"):
+    """
+    Simpan respons yang dihitung pada versi data `versi`. Kalau versi sudah
+    naik selama respons dihitung (ada upload di tengah jalan), respons
+    tidak disimpan supaya cache tidak berisi data lama.
+    """
+    sekarang = time.time()
+    kedaluwarsa = sekarang + CACHE_TTL if CACHE_TTL > 0 else None
+    tertunda = _ambil_cache_tertunda(paksa=True)
+    with transaksi_state() as db:
+        # waktu pakai terbaru ditulis dulu supaya yang dibuang benar yang
+        # paling lama tidak dipakai
+        _tulis_cache_tertunda(db, *tertunda)
+        row = db.execute("SELECT versi FROM versi_data WHERE id = 1").fetchone()
+        if (row[0] if row else 0) != versi:
+            return False
+
+        db.execute("""
+            INSERT OR REPLACE INTO cache_respons
+                (kunci, body, mimetype, etag, dibuat, dipakai, kedaluwarsa, ruang)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (kunci, body, mimetype, etag, sekarang, sekarang, kedaluwarsa, ruang))
+        db.execute("DELETE FROM cache_tag WHERE kunci = ?", (kunci,))
+        db.executemany(
+            "INSERT OR IGNORE INTO cache_tag (tag, kunci) VALUES (?, ?)",
+            [(tag, kunci) for tag in tags]
+        )
+
+        if CACHE_TTL > 0:
+            db.execute("""
+                DELETE FROM cache_tag WHERE kunci IN
+                    (SELECT kunci FROM cache_respons WHERE kedaluwarsa < ?)
+            """, (sekarang,))
+            db.execute("DELETE FROM cache_respons WHERE kedaluwarsa < ?", (sekarang,))
+
+        lebih = db.execute(
+            "SELECT COUNT(*) FROM cache_respons WHERE ruang = ?", (ruang,)
+        ).fetchone()[0] - CACHE_RUANG[ruang]
+        if lebih > 0:
+            dibuang = [r[0] for r in db.execute(
+                "SELECT kunci FROM cache_respons WHERE ruang = ? ORDER BY dipakai LIMIT ?",
+                (ruang, lebih)
+            )]
+            db.executemany("DELETE FROM cache_respons WHERE kunci = ?", [(k,) for k in dibuang])
+            db.executemany("DELETE FROM cache_tag WHERE kunci = ?", [(k,) for k in dibuang])
+            db.execute("""
+                INSERT INTO cache_statistik (nama, nilai) VALUES ('dibuang', ?)
+                ON CONFLICT (nama) DO UPDATE SET nilai = nilai + excluded.nilai
+            """, (len(dibuang),))
+    return True
+
+
+def cache_tags_dari(kunci):
+    return {r[0] for r in state_db().execute("SELECT tag FROM cache_tag WHERE kunci = ?", (kunci,))}
+
+
+def hapus_cache(tags=None):
+    """
+    Hapus respons dengan tag tertentu, atau semuanya kalau tags None.
+    Versi data ikut naik, jadi ETag respons baru pasti berbeda.
+    """
+    try:
+        with transaksi_state() as db:
+            db.execute("""
+                INSERT INTO versi_data (id, versi) VALUES (1, 1)
+                ON CONFLICT (id) DO UPDATE SET versi = versi + 1
+            """)
+
+            if tags is None:
+                db.execute("DELETE FROM cache_respons;")
+                db.execute("DELETE FROM cache_tag;")
+                return
+
+            tags = list(tags)
+            for i in range(0, len(tags), 500):
+                bagian = tags[i:i + 500]
+                tanda = ",".join("?" * len(bagian))
+                db.execute(f"""
+                    DELETE FROM cache_respons
+                    WHERE kunci IN (SELECT kunci FROM cache_tag WHERE tag IN ({tanda}))
+                """, bagian)
+            db.execute("""
+                DELETE FROM cache_tag
+                WHERE kunci NOT IN (SELECT kunci FROM cache_respons)
+            """)
+    except sqlite3.Error as e:
+        app.logger.warning("Gagal menghapus cache: %s", e)
+
+
+def tandai_cache(*tags):
+    """Dipanggil dari view untuk menambah tag yang baru diketahui (mis. id pos)."""
+    g.setdefault("cache_tags", set()).update(tags)
+
+
+# ============================================================
+# ETAG & KOMPRESI RESPONS
+# ============================================================
+# ETag = versi data saat respons dihitung. Browser mengirim If-None-Match,
+# dan kalau respons di cache masih punya ETag yang sama -> 304 tanpa body.
+# Body besar dikompres gzip (atau brotli kalau modul "brotli" terpasang);
+# hasil kompresi ikut disimpan di cache, jadi tiap versi cukup
+# dikompres sekali.
+# - COMPRESS_MIN_BYTES : body lebih kecil dari ini tidak dikompres
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_MIMETYPES = ("application/json", "text/html", "application/octet-stream")
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def pilih_encoding(body, mimetype):
+    if len(body) < COMPRESS_MIN_BYTES or mimetype not in COMPRESS_MIMETYPES:
+        return None
+    terima = request.accept_encodings
+    if brotli is not None and terima["br"]:
+        return "br"
+    if terima["gzip"]:
+        return "gzip"
+    return None
+
+
+def kompres(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+
+def buat_respons_cache(kunci, body, mimetype, etag, versi, status_cache, ruang="umum"):
+    """Respons final: 304 / body terkompresi (dari cache bila ada) / body asli."""
+    if etag and request.if_none_match.contains_weak(etag):
+        resp = app.response_class(status=304)
+    else:
+        encoding = pilih_encoding(body, mimetype)
+        if encoding is not None:
+            varian = f"{kunci}#{encoding}"
+            hit = cache_ambil(varian, statistik=False) if CACHE_ENABLED else None
+            if hit is not None:
+                body = hit[0]
+            else:
+                body = kompres(body, encoding)
+                if CACHE_ENABLED:
+                    cache_simpan(varian, body, mimetype, etag, cache_tags_dari(kunci), versi, ruang)
+
+        resp = app.response_class(body, mimetype=mimetype)
+        if encoding is not None:
+            resp.headers["Content-Encoding"] = encoding
+
+    resp.headers["Vary"] = "Accept-Encoding, Accept"
+    # selalu cek ulang ke server, tapi cukup 304 kalau belum berubah
+    resp.headers["Cache-Control"] = "no-cache"
+    if etag:
+        resp.set_etag(etag, weak=True)
+    resp.headers["X-Cache"] = status_cache
+    return resp
+
+
+def cache_respons(*tags_dasar, ruang="umum"):
+    def dekorator(view):
+        @functools.wraps(view)
+        def pembungkus(*args, **kwargs):
+            # Format biner yang diminta lewat header Accept diperlakukan
+            # seperti ?format=..., supaya JSON & biner tidak tertukar di cache
+            params = request.args.items(multi=True)
+            fmt = format_dari_accept() if "format" not in request.args else None
+            if fmt:
+                params = itertools.chain(params, [("format", fmt)])
+            params = sorted(params)
+
+            kunci = request.path
+            if params:
+                kunci += "?" + urlencode(params)
+
+            try:
+                versi = versi_data()
+                hit = cache_ambil(kunci) if CACHE_ENABLED else None
+            except sqlite3.Error as e:
+                app.logger.warning("Cache tidak bisa dibaca: %s", e)
+                return view(*args, **kwargs)
+
+            if hit is not None:
+                body, mimetype, etag = hit
+                return buat_respons_cache(kunci, body, mimetype, etag, versi, "HIT", ruang)
+
+            etag = f"v{versi}"
+            format_biner = request.args.get("format") or fmt
+            if format_biner and format_biner != "json":
+                etag += f"-{format_biner}"
+            if not CACHE_ENABLED and request.if_none_match.contains_weak(etag):
+                return buat_respons_cache(kunci, b"", None, etag, versi, "MISS")
+
+            resp = make_response(view(*args, **kwargs))
+            if resp.status_code != 200 or resp.direct_passthrough:
+                return resp
+
+            body = resp.get_data()
+            if CACHE_ENABLED:
+                tags = set(tags_dasar) | g.get("cache_tags", set())
+                try:
+                    cache_simpan(kunci, body, resp.mimetype, etag, tags, versi, ruang)
+                except sqlite3.Error as e:
+                    app.logger.warning("Cache tidak bisa ditulis: %s", e)
+            hasil = buat_respons_cache(kunci, body, resp.mimetype, etag, versi, "MISS", ruang)
+            if "Server-Timing" in resp.headers:
+                hasil.headers["Server-Timing"] = resp.headers["Server-Timing"]
+            return hasil
+        return pembungkus
+    return dekorator
+
+
+@app.route("/api/cache_stats")
+def api_cache_stats():
+    simpan_cache_tertunda(paksa=True)
+    db = state_db()
+    statistik = dict(db.execute("SELECT nama, nilai FROM cache_statistik").fetchall())
+    jumlah, ukuran = db.execute(
+        "SELECT COUNT(*), COALESCE(SUM(LENGTH(body)), 0) FROM cache_respons"
+    ).fetchone()
+    per_ruang = dict(db.execute("SELECT ruang, COUNT(*) FROM cache_respons GROUP BY ruang"))
+    hit, miss = statistik.get("hit", 0), statistik.get("miss", 0)
+    return jsonify({
+        "aktif": CACHE_ENABLED,
+        "hit": hit,
+        "miss": miss,
+        "hit_ratio": round(hit / (hit + miss), 4) if hit + miss else None,
+        "dibuang": statistik.get("dibuang", 0),
+        "entri": jumlah,
+        "entri_max": CACHE_MAX_ENTRIES,
+        "ruang": {nama: {"entri": per_ruang.get(nama, 0), "entri_max": maks}
+                  for nama, maks in CACHE_RUANG.items()},
+        "ukuran_byte": ukuran,
+        "ttl_detik": CACHE_TTL or None,
+    })
+
+
+# ============================================================
+# METRIK & INSTRUMENTASI (PROMETHEUS /metrics)
+# ============================================================
+# Setiap request dicatat: latensi per route, jumlah & durasi query SQL
+# (semua cursor dari koneksi pool diukur lewat CursorTerukur), plus waktu
+# per fase upload dan jumlah baris yang dimuat. Angka dikumpulkan di
+# memori tiap proses lalu dijumlahkan ke SQLite state (tabel metrik) tiap
+# METRIK_FLUSH_DETIK, jadi /metrics dari worker mana pun berisi total
+# semua worker (dan proses pengolah job).
+#
+# Latensi respons yang di-stream (/api/export) dihitung sampai header
+# dikirim, bukan sampai file selesai.
+#
+# - METRIK_AKTIF       : "0" untuk mematikan pencatatan
+# - METRIK_FLUSH_DETIK : jeda minimal antar tulis ke SQLite
+# - SQL_LAMBAT_MS      : query yang lebih lama dari ini ditulis ke log
+#                        (warning) dan dihitung; 0 = mati
+# - PROFIL_AKTIF       : "1" supaya request dengan ?profil=1 diprofil
+#                        (cProfile); hasil .prof disimpan di PROFIL_DIR
+#                        dan namanya dikirim di header X-Profil
+METRIK_AKTIF = os.getenv("METRIK_AKTIF", "1") != "0"
+METRIK_FLUSH_DETIK = float(os.getenv("METRIK_FLUSH_DETIK", "5"))
+SQL_LAMBAT_MS = float(os.getenv("SQL_LAMBAT_MS", "0"))
+PROFIL_AKTIF = os.getenv("PROFIL_AKTIF", "0") == "1"
+PROFIL_DIR = os.getenv(
+    "PROFIL_DIR",
+    os.path.join(tempfile.gettempdir(), "webgis_poshujan_profil")
+)
+
+BUCKET_DETIK = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BUCKET_JUMLAH = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+# nama -> (jenis, keterangan, bucket)
+METRIK = {
+    "poshujan_http_request_duration_seconds": (
+        "histogram", "Latensi request per route", BUCKET_DETIK),
+    "poshujan_sql_query_duration_seconds": (
+        "histogram", "Durasi satu statement SQL", BUCKET_DETIK),
+    "poshujan_sql_queries_per_request": (
+        "histogram", "Jumlah statement SQL per request", BUCKET_JUMLAH),
+    "poshujan_sql_request_seconds": (
+        "histogram", "Total waktu SQL per request", BUCKET_DETIK),
+    "poshujan_sql_slow_total": (
+        "counter", "Statement SQL yang lebih lama dari SQL_LAMBAT_MS", None),
+    "poshujan_ingest_total": (
+        "counter", "Upload yang selesai diproses", None),
+    "poshujan_ingest_rows_total": (
+        "counter", "Baris yang dimuat oleh upload", None),
+    "poshujan_ingest_seconds_total": (
+        "counter", "Total waktu proses upload", None),
+    "poshujan_ingest_phase_seconds_total": (
+        "counter", "Waktu upload per fase (baca, bersih, mapping, staging, merge, commit, ...)", None),
+    "poshujan_cache_total": (
+        "counter", "Hasil cache respons (hit, miss, dibuang)", None),
+}
+
+_metrik = {}
+_metrik_lock = threading.Lock()
+_metrik_flush = {"pid": None, "waktu": 0.0}
+
+
+def label_prom(**label):
+    """{"rute": '/a"b'} -> 'rute="/a\\"b"' (urut nama label)."""
+    return ",".join(
+        f'{k}="' + str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for k, v in sorted(label.items())
+    )
+
+
+def _cek_proses_metrik():
+    """Dipanggil dengan _metrik_lock: proses hasil fork membuang angka milik induk."""
+    if _metrik_flush["pid"] != os.getpid():
+        _metrik.clear()
+        _metrik_flush.update(pid=os.getpid(), waktu=time.monotonic())
+
+
+def tambah_metrik(nama, nilai=1.0, **label):
+    if not METRIK_AKTIF:
+        return
+    kunci = (nama, label_prom(**label), "")
+    with _metrik_lock:
+        _cek_proses_metrik()
+        _metrik[kunci] = _metrik.get(kunci, 0.0) + nilai
+
+
+def amati_metrik(nama, nilai, **label):
+    """Satu observasi histogram: bucket kumulatif + _sum + _count."""
+    if not METRIK_AKTIF:
+        return
+    teks = label_prom(**label)
+    bucket = METRIK[nama][2]
+    with _metrik_lock:
+        _cek_proses_metrik()
+        # bucket di bawah nilai tetap ditulis (0) supaya tiap seri punya
+        # bucket lengkap
+        pertama = bisect.bisect_left(bucket, nilai)
+        for i, batas in enumerate(bucket):
+            kunci = (f"{nama}_bucket", teks, repr(float(batas)))
+            _metrik[kunci] = _metrik.get(kunci, 0.0) + (i >= pertama)
+        for akhiran, tambah in (("_bucket", 1), ("_sum", nilai), ("_count", 1)):
+            kunci = (nama + akhiran, teks, "+Inf" if akhiran == "_bucket" else "")
+            _metrik[kunci] = _metrik.get(kunci, 0.0) + tambah
+
+
+def simpan_metrik(paksa=False):
+    """Tambahkan angka di memori proses ini ke tabel metrik (lalu kosongkan)."""
+    sekarang = time.monotonic()
+    with _metrik_lock:
+        _cek_proses_metrik()
+        if not _metrik or (not paksa and sekarang - _metrik_flush["waktu"] < METRIK_FLUSH_DETIK):
+            return
+        isi = list(_metrik.items())
+        _metrik.clear()
+        _metrik_flush["waktu"] = sekarang
+    try:
+        with transaksi_state() as db:
+            db.executemany("""
+                INSERT INTO metrik (nama, label, le, nilai) VALUES (?, ?, ?, ?)
+                ON CONFLICT (nama, label, le) DO UPDATE SET nilai = nilai + excluded.nilai
+            """, [(n, lb, le, v) for (n, lb, le), v in isi])
+    except sqlite3.Error as e:
+        app.logger.warning("Gagal menyimpan metrik: %s", e)
+
+
+def catat_waktu_ingest(jenis, waktu, baris, total):
+    """Fase upload (dict waktu dari tambah_waktu) + jumlah baris ke metrik."""
+    tambah_metrik("poshujan_ingest_total", jenis=jenis)
+    tambah_metrik("poshujan_ingest_rows_total", baris, jenis=jenis)
+    tambah_metrik("poshujan_ingest_seconds_total", total, jenis=jenis)
+    for fase, detik in waktu.items():
+        tambah_metrik("poshujan_ingest_phase_seconds_total", detik, jenis=jenis, fase=fase)
+
+
+def ringkas_sql(query):
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    return " ".join(str(query).split())[:500]
+
+
+def catat_sql(query, detik):
+    rute = "lainnya"
+    if has_app_context():
+        g.sql_jumlah = g.get("sql_jumlah", 0) + 1
+        g.sql_detik = g.get("sql_detik", 0.0) + detik
+        rute = g.get("metrik_rute", rute)
+    amati_metrik("poshujan_sql_query_duration_seconds", detik, rute=rute)
+    if SQL_LAMBAT_MS > 0 and detik * 1000 >= SQL_LAMBAT_MS:
+        tambah_metrik("poshujan_sql_slow_total", rute=rute)
+        app.logger.warning("SQL lambat %.1f ms [%s]: %s", detik * 1000, rute, ringkas_sql(query))
+
+
+class CursorTerukur(psycopg2.extensions.cursor):
+    """Cursor yang mencatat durasi execute / executemany / copy_expert."""
+
+    def execute(self, query, vars=None):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            catat_sql(query, time.perf_counter() - t0)
+
+    def executemany(self, query, vars_list):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            catat_sql(query, time.perf_counter() - t0)
+
+    def copy_expert(self, sql, file, size=8192):
+        t0 = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            catat_sql(sql, time.perf_counter() - t0)
+
+
+@app.before_request
+def mulai_metrik_request():
+    g.metrik_mulai = time.perf_counter()
+    g.metrik_rute = request.url_rule.rule if request.url_rule else "tidak_ada"
+    g.sql_jumlah, g.sql_detik = 0, 0.0
+
+    if PROFIL_AKTIF and request.args.get("profil") == "1":
+        profil = cProfile.Profile()
+        try:
+            profil.enable()
+        except ValueError:
+            # profiler lain sedang aktif di thread ini
+            return
+        g.profil = profil
+
+
+@app.after_request
+def catat_metrik_request(resp):
+    mulai = g.pop("metrik_mulai", None)
+    if mulai is None:
+        return resp
+    durasi = time.perf_counter() - mulai
+    rute = g.metrik_rute
+
+    profil = g.pop("profil", None)
+    if profil is not None:
+        profil.disable()
+        os.makedirs(PROFIL_DIR, exist_ok=True)
+        nama = (f"{time.strftime('%Y%m%d-%H%M%S')}_"
+                f"{re.sub(r'[^A-Za-z0-9]+', '_', rute).strip('_') or 'root'}_"
+                f"{uuid.uuid4().hex[:6]}.prof")
+        profil.dump_stats(os.path.join(PROFIL_DIR, nama))
+        resp.headers["X-Profil"] = nama
+
+    amati_metrik("poshujan_http_request_duration_seconds", durasi,
+                 rute=rute, method=request.method, status=resp.status_code)
+    amati_metrik("poshujan_sql_queries_per_request", g.sql_jumlah, rute=rute)
+    amati_metrik("poshujan_sql_request_seconds", g.sql_detik, rute=rute)
+
+    timing = f'sql;dur={g.sql_detik * 1000:.1f};desc="{g.sql_jumlah} query", app;dur={durasi * 1000:.1f}'
+    if "Server-Timing" in resp.headers:
+        timing = resp.headers["Server-Timing"] + ", " + timing
+    resp.headers["Server-Timing"] = timing
+
+    simpan_metrik()
+    return resp
+
+
+@app.route("/metrics")
+def metrics():
+    """Semua metrik dalam format teks Prometheus (total semua worker)."""
+    simpan_metrik(paksa=True)
+    simpan_cache_tertunda(paksa=True)
+    db = state_db()
+    rows = db.execute("SELECT nama, label, le, nilai FROM metrik").fetchall()
+    rows += [
+        ("poshujan_cache_total", label_prom(hasil=nama), "", nilai)
+        for nama, nilai in db.execute("SELECT nama, nilai FROM cache_statistik")
+    ]
+
+    # baris dikelompokkan per metrik, lalu per seri label:
+    # _bucket (urut le), _sum, _count
+    akhiran = {"_bucket": 0, "_sum": 1, "_count": 2}
+    per_metrik = {}
+    for nama, label, le, nilai in rows:
+        dasar, urut = nama, 0
+        for a, i in akhiran.items():
+            if nama.endswith(a) and nama[:-len(a)] in METRIK:
+                dasar, urut = nama[:-len(a)], i
+        le_angka = float("inf") if le == "+Inf" else float(le or 0)
+        per_metrik.setdefault(dasar, []).append((label, urut, le_angka, nama, le, nilai))
+
+    baris = []
+    for dasar, (jenis, keterangan, _) in METRIK.items():
+        if dasar not in per_metrik:
+            continue
+        baris += [f"# HELP {dasar} {keterangan}", f"# TYPE {dasar} {jenis}"]
+        for label, _, _, nama, le, nilai in sorted(per_metrik[dasar]):
+            if le:
+                label = f'{label},le="{le}"' if label else f'le="{le}"'
+            baris.append(f"{nama}{{{label}}} {nilai:.17g}" if label else f"{nama} {nilai:.17g}")
+
+    resp = app.response_class("\n".join(baris) + "\n", mimetype="text/plain")
+    resp.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+
 # ============================================================
 # HALAMAN UTAMA (PETA)
 # ============================================================
@@ -112,7 +1072,6 @@ def api_login():
         row = cur.fetchone()
     finally:
         cur.close()
-        conn.close()
 
     if not row:
         return jsonify({
@@ -163,7 +1122,21 @@ def api_logout():
 # HALAMAN DETAIL POS HUJAN
 # ============================================================
 @app.route("/pos/<int:id_poshujan>")
+@cache_respons()
 def detail_pos(id_poshujan):
+    tandai_cache(f"pos:{id_poshujan}")
+
+    # Periode opsional (?start=YYYY-MM-DD&end=YYYY-MM-DD) supaya pos dengan
+    # riwayat panjang tidak mengirim bertahun-tahun baris ke HTML
+    try:
+        start = parse_tanggal_param("start")
+        end = parse_tanggal_param("end")
+        saring_qc = parse_qc_param()
+    except ValueError as e:
+        abort(400, description=str(e))
+
+    waktu = {}
+    t0 = time.perf_counter()
     conn = get_db()
     cur = conn.cursor()
 
@@ -189,7 +1162,6 @@ def detail_pos(id_poshujan):
 
     if not meta_row:
         cur.close()
-        conn.close()
         abort(404, description="Pos hujan tidak ditemukan")
 
     meta = {
@@ -204,117 +1176,175 @@ def detail_pos(id_poshujan):
         "provinsi":   meta_row[8],
         "kabupaten":  meta_row[9],
     }
+    waktu["meta"] = time.perf_counter() - t0
 
     # ========================================================
-    # DATA CH HARIAN
+    # DATA CH HARIAN (SATU KALI QUERY)
     # ========================================================
-    cur.execute("""
-        SELECT tanggal, ch_mm
-        FROM curah_hujan
-        WHERE id_poshujan = %s
-          AND ch_mm IS NOT NULL
-        ORDER BY tanggal
-    """, (id_poshujan,))
-    rows_harian = cur.fetchall()
+    t0 = time.perf_counter()
+    harian = ambil_ch_harian(cur, id_poshujan, start, end, saring_qc)
+    waktu["query"] = time.perf_counter() - t0
 
-    harian_labels = []
-    harian_values = []
+    # ========================================================
+    # REKAP BULANAN / DASARIAN / TAHUNAN (dari data harian)
+    # ========================================================
+    t0 = time.perf_counter()
+    rekap = rekap_ch(harian)
+    harian_labels = harian["tanggal"].dt.strftime("%Y-%m-%d").tolist()
+    harian_values = harian["ch"].tolist()
+    waktu["rekap"] = time.perf_counter() - t0
 
-    for tanggal, ch in rows_harian:
-        if hasattr(tanggal, "strftime"):
-            harian_labels.append(tanggal.strftime("%Y-%m-%d"))
-        else:
-            harian_labels.append(str(tanggal))
+    # indeks iklim dari seluruh riwayat pos: tidak ikut filter periode /
+    # ?qc= halaman ini, selalu memakai saringan QC default (QC_SARING)
+    # seperti /api/indeks_iklim
+    t0 = time.perf_counter()
+    if start is None and end is None and saring_qc == QC_SARING:
+        riwayat = harian
+    else:
+        riwayat = ambil_ch_harian(cur, id_poshujan)
+    cur.close()
+    iklim = indeks_iklim_pos(id_poshujan, riwayat)
+    waktu["iklim"] = time.perf_counter() - t0
 
-        if ch is not None:
-            harian_values.append(float(ch))
+    t0 = time.perf_counter()
+    html = render_template(
+        "detail_pos.html",
+        meta=meta,
+        start=start,
+        end=end,
+        harian_labels=harian_labels,
+        harian_values=harian_values,
+        bulanan_labels=rekap["bulanan"][0],
+        bulanan_values=rekap["bulanan"][1],
+        dasarian_labels=rekap["dasarian"][0],
+        dasarian_values=rekap["dasarian"][1],
+        tahunan_labels=rekap["tahunan"][0],
+        tahunan_values=rekap["tahunan"][1],
+        iklim=iklim,
+        kolom_iklim={k: v for k, v in INDEKS_IKLIM.items() if v[0] == "tahunan"},
+    )
+    waktu["render"] = time.perf_counter() - t0
 
-    # ========================================================
-    # DATA CH BULANAN (AGREGASI)
-    # ========================================================
+    resp = make_response(html)
+    resp.headers["Server-Timing"] = ", ".join(
+        f"{k};dur={v * 1000:.1f}" for k, v in waktu.items()
+    )
+    return resp
+
+
+def parse_tanggal_param(nama):
+    """
+    Ambil ?nama=YYYY-MM-DD dari query string (None kalau kosong).
+    ValueError kalau formatnya salah.
+    """
+    nilai = (request.args.get(nama) or "").strip()
+    if not nilai:
+        return None
+    try:
+        return datetime.strptime(nilai, "%Y-%m-%d").date()
+    except ValueError:
+        raise ValueError(f"Parameter {nama} harus berformat YYYY-MM-DD") from None
+
+
+def parse_int_param(nama, minimum, maksimum):
+    """Ambil ?nama=<int> (None kalau kosong), dibatasi ke [minimum, maksimum]."""
+    nilai = (request.args.get(nama) or "").strip()
+    if not nilai:
+        return None
+    try:
+        angka = int(nilai)
+    except ValueError:
+        raise ValueError(f"Parameter {nama} harus bilangan bulat") from None
+    if angka < minimum:
+        raise ValueError(f"Parameter {nama} minimal {minimum}")
+    return min(angka, maksimum)
+
+
+def ambil_ch_harian(cur, id_poshujan, start=None, end=None, saring_qc=None):
+    """
+    Seri harian satu pos sebagai DataFrame (tanggal datetime64, ch float).
+    Baris dengan flag QC di saring_qc (bitmask FLAG_QC, default QC_SARING)
+    tidak ikut.
+    """
+    if saring_qc is None:
+        saring_qc = QC_SARING
     cur.execute("""
-        SELECT date_trunc('month', tanggal)::date AS bulan,
-               SUM(ch_mm) AS total_ch
+        SELECT tanggal, ch_mm
         FROM curah_hujan
         WHERE id_poshujan = %s
           AND ch_mm IS NOT NULL
-        GROUP BY bulan
-        ORDER BY bulan
-    """, (id_poshujan,))
-    rows_bulanan = cur.fetchall()
+          AND (qc_flag & %s) = 0
+          AND (%s::date IS NULL OR tanggal >= %s::date)
+          AND (%s::date IS NULL OR tanggal <= %s::date)
+        ORDER BY tanggal
+    """, (id_poshujan, saring_qc, start, start, end, end))
+    rows = cur.fetchall()
 
-    bulanan_labels = []
-    bulanan_values = []
+    return pd.DataFrame({
+        "tanggal": pd.to_datetime([r[0] for r in rows]),
+        "ch": np.array([r[1] for r in rows], dtype=np.float64),
+    })
 
-    for bulan, total_ch in rows_bulanan:
-        if hasattr(bulan, "strftime"):
-            bulanan_labels.append(bulan.strftime("%Y-%m"))
-        else:
-            bulanan_labels.append(str(bulan))
 
-        if total_ch is not None:
-            bulanan_values.append(float(total_ch))
+def rekap_ch(harian):
+    """
+    Total bulanan, dasarian (10 harian: tgl 1-10, 11-20, 21-akhir) dan
+    tahunan dari seri harian, dihitung per kolom.
+    Return {periode: (labels, values)}.
+    """
+    tgl = harian["tanggal"].dt
+    ch = harian["ch"]
 
-    cur.close()
-    conn.close()
+    bulan = tgl.to_period("M")
+    dasarian = np.minimum((tgl.day.to_numpy() - 1) // 10, 2) + 1
 
-    return render_template(
-        "detail_pos.html",
-        meta=meta,
-        rows_harian=rows_harian,
-        harian_labels=harian_labels,
-        harian_values=harian_values,
-        bulanan_labels=bulanan_labels,
-        bulanan_values=bulanan_values
-    )
+    bulanan = ch.groupby(bulan, sort=True).sum()
+    per_dasarian = ch.groupby([bulan, dasarian], sort=True).sum()
+    tahunan = ch.groupby(tgl.year, sort=True).sum()
+
+    return {
+        "bulanan": (bulanan.index.strftime("%Y-%m").tolist(), bulanan.tolist()),
+        "dasarian": (
+            [f"{b.strftime('%Y-%m')}-D{d}" for b, d in per_dasarian.index],
+            per_dasarian.tolist(),
+        ),
+        "tahunan": ([str(t) for t in tahunan.index], tahunan.tolist()),
+    }
 
 
 # ============================================================
 # API POS HUJAN UNTUK TABEL & PETA
 # ============================================================
-@app.route("/api/pos_hujan")
-def api_pos_hujan():
-    conn = get_db()
-    cur = conn.cursor()
+# Parameter opsional (dipakai peta supaya hanya memuat pos yang terlihat):
+# - bbox=minLng,minLat,maxLng,maxLat   (urutan sama dengan Leaflet toBBoxString)
+# - near=lat,lng&k=10[&radius_km=50]  (k pos terdekat, ada field jarak_km)
+# - kabupaten=<nama>                  (semua pos di satu kabupaten)
+# Tanpa parameter: semua pos, seperti sebelumnya.
+SQL_DAFTAR_POS = """
+    SELECT
+        p.id_poshujan,
+        p.kode_pos,
+        p.nama_pos,
+        p.lintang_dd,
+        p.bujur_dd,
+        k.nama_kabupaten,
+        p.kecamatan,
+        t.tanggal AS tanggal_terkini,
+        t.ch_mm   AS ch_terkini
+    FROM pos_hujan p
+    LEFT JOIN kabupaten k ON p.id_kabupaten = k.id_kabupaten
+    LEFT JOIN pos_hujan_terkini t ON t.id_poshujan = p.id_poshujan
+"""
+URUTAN_DAFTAR_POS = "ORDER BY k.nama_kabupaten NULLS LAST, p.nama_pos"
 
-    cur.execute("""
-        WITH latest AS (
-            SELECT
-                id_poshujan,
-                MAX(tanggal) AS tanggal_terkini
-            FROM curah_hujan
-            WHERE ch_mm IS NOT NULL
-            GROUP BY id_poshujan
-        ),
-        latest_ch AS (
-            SELECT c.id_poshujan, c.tanggal, c.ch_mm
-            FROM curah_hujan c
-            JOIN latest l
-              ON c.id_poshujan = l.id_poshujan
-             AND c.tanggal = l.tanggal_terkini
-        )
-        SELECT 
-            p.id_poshujan,
-            p.kode_pos,
-            p.nama_pos,
-            p.lintang_dd,
-            p.bujur_dd,
-            k.nama_kabupaten,
-            p.kecamatan,
-            lc.tanggal AS tanggal_terkini,
-            lc.ch_mm   AS ch_terkini
-        FROM pos_hujan p
-        LEFT JOIN kabupaten k ON p.id_kabupaten = k.id_kabupaten
-        LEFT JOIN latest_ch lc ON lc.id_poshujan = p.id_poshujan
-        ORDER BY k.nama_kabupaten NULLS LAST, p.nama_pos;
-    """)
 
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
+def ambil_daftar_pos(cur, where="", params=(), urutan=URUTAN_DAFTAR_POS):
+    # Data terkini dibaca dari pos_hujan_terkini (dijaga oleh proses upload),
+    # bukan MAX(tanggal) atas seluruh curah_hujan setiap kali peta dibuka.
+    cur.execute(f"{SQL_DAFTAR_POS} {where} {urutan}", params)
 
     hasil = []
-    for r in rows:
+    for r in cur.fetchall():
         tanggal_terkini = r[7].strftime("%Y-%m-%d") if r[7] is not None else None
         ch_terkini = float(r[8]) if r[8] is not None else None
 
@@ -329,348 +1359,4805 @@ def api_pos_hujan():
             "tanggal_terkini":   tanggal_terkini,
             "ch_terkini":        ch_terkini,
         })
-
-    return jsonify(hasil)
+    return hasil
 
 
-# ============================================================
-# API JSON CURAH HUJAN PER POS
-# ============================================================
-@app.route("/api/curah_hujan")
-def api_curah_hujan():
-    nama_pos = request.args.get("nama_pos", "").strip()
-    mode = request.args.get("mode", "harian").lower()
+@app.route("/api/pos_hujan")
+@cache_respons("pos_hujan")
+def api_pos_hujan():
+    try:
+        bbox = parse_bbox_param("bbox")
+        near = parse_koordinat_param("near")
+        k = parse_int_param("k", 1, SPASIAL_MAX_K) or 10
+        radius_km = parse_float_param("radius_km")
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    kabupaten = request.args.get("kabupaten", "").strip()
 
-    if not nama_pos:
-        return jsonify({"status": "error", "message": "nama_pos wajib ada"}), 400
+    if (bbox is not None) + (near is not None) + bool(kabupaten) > 1:
+        return jsonify({
+            "status": "error",
+            "message": "Pilih salah satu: bbox, near atau kabupaten"
+        }), 400
 
-    conn = get_db()
-    cur = conn.cursor()
+    if near is not None:
+        return jsonify(cari_pos_terdekat(near[0], near[1], k, radius_km))
+    if bbox is not None:
+        return jsonify(cari_pos_bbox(*bbox))
 
-    cur.execute("""
-        SELECT id_poshujan
-        FROM pos_hujan
-        WHERE LOWER(nama_pos) = LOWER(%s)
-    """, (nama_pos,))
-    res = cur.fetchone()
-    if not res:
+    cur = get_db().cursor()
+    try:
+        hasil = daftar_pos(cur, kabupaten or None)
+    finally:
         cur.close()
-        conn.close()
-        return jsonify({"status": "error", "message": "Pos tidak ditemukan"}), 404
-
-    id_pos = res[0]
+    return jsonify(hasil)
 
-    if mode == "bulanan":
-        cur.execute("""
-            SELECT date_trunc('month', tanggal)::date AS bulan,
-                   SUM(ch_mm) AS total_ch
-            FROM curah_hujan
-            WHERE id_poshujan = %s
-              AND ch_mm IS NOT NULL
-            GROUP BY bulan
-            ORDER BY bulan
-        """, (id_pos,))
-        rows = cur.fetchall()
-        data = [{"bulan": r[0].strftime("%Y-%m"), "ch": float(r[1])} for r in rows]
-        cur.close()
-        conn.close()
-        return jsonify({
-            "status": "success",
-            "mode": "bulanan",
-            "nama_pos": nama_pos,
-            "data": data
-        })
 
+@app.route("/api/wilayah")
+@cache_respons("pos_hujan")
+def api_wilayah():
+    """Daftar kabupaten -> kecamatan yang punya pos (untuk dropdown filter peta)."""
+    cur = get_db().cursor()
     cur.execute("""
-        SELECT tanggal, ch_mm
-        FROM curah_hujan
-        WHERE id_poshujan = %s
-          AND ch_mm IS NOT NULL
-        ORDER BY tanggal
-    """, (id_pos,))
+        SELECT k.nama_kabupaten,
+               array_remove(array_agg(DISTINCT p.kecamatan), NULL)
+        FROM pos_hujan p
+        JOIN kabupaten k ON p.id_kabupaten = k.id_kabupaten
+        GROUP BY k.nama_kabupaten
+        ORDER BY k.nama_kabupaten
+    """)
     rows = cur.fetchall()
-    data = [{"tanggal": r[0].strftime("%Y-%m-%d"), "ch": float(r[1])} for r in rows]
-
     cur.close()
-    conn.close()
     return jsonify({
         "status": "success",
-        "mode": "harian",
-        "nama_pos": nama_pos,
-        "data": data
+        "kabupaten": [{"nama": r[0], "kecamatan": sorted(r[1])} for r in rows]
     })
 
 
+def parse_float_param(nama):
+    nilai = (request.args.get(nama) or "").strip()
+    if not nilai:
+        return None
+    try:
+        angka = float(nilai)
+    except ValueError:
+        raise ValueError(f"Parameter {nama} harus angka") from None
+    if not np.isfinite(angka) or angka <= 0:
+        raise ValueError(f"Parameter {nama} harus angka positif")
+    return angka
+
+
+def parse_koordinat_param(nama):
+    """?nama=lat,lng -> (lat, lng)."""
+    nilai = (request.args.get(nama) or "").strip()
+    if not nilai:
+        return None
+    try:
+        lat, lng = (float(v) for v in nilai.split(","))
+    except ValueError:
+        raise ValueError(f"Parameter {nama} harus berformat lat,lng") from None
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError(f"Parameter {nama} di luar jangkauan koordinat")
+    return lat, lng
+
+
+def parse_bbox_param(nama):
+    """?nama=minLng,minLat,maxLng,maxLat -> (min_lng, min_lat, max_lng, max_lat)."""
+    nilai = (request.args.get(nama) or "").strip()
+    if not nilai:
+        return None
+    try:
+        w, s, e, n = (float(v) for v in nilai.split(","))
+    except ValueError:
+        raise ValueError(f"Parameter {nama} harus berformat minLng,minLat,maxLng,maxLat") from None
+    if not (w <= e and s <= n):
+        raise ValueError(f"Parameter {nama}: min harus lebih kecil dari max")
+    return w, s, e, n
+
+
 # ============================================================
-# UPLOAD METADATA POS HUJAN (EXCEL / CSV)
+# REGISTRY POS HUJAN (DI MEMORI TIAP WORKER)
 # ============================================================
-@app.route("/upload_metadata", methods=["POST"])
-def upload_metadata():
-    ensure_logged_in_api()
+# Metadata pos (id, kode, nama, koordinat, kabupaten/provinsi) dimuat
+# sekali per proses dan disimpan sebagai array (numerik di numpy, nama
+# kabupaten/provinsi sebagai kode ke daftar nama unik). Dipakai untuk
+# mencocokkan nama/kode/id pos tanpa query: /api/curah_hujan, batch,
+# ekspor, upload CH dan daftar pos untuk peta.
+#
+# Registry hanya dimuat ulang kalau versi pos naik, yaitu setelah
+# /upload_metadata (atau migrasi-db). Upload CH tidak mengubahnya.
+#
+# Nama dicocokkan setelah dinormalisasi (huruf kecil, spasi dirapikan).
+# Nama yang tidak ditemukan diberi saran nama terdekat (difflib):
+# - POS_SARAN_MAKS  : jumlah saran per nama
+# - POS_SARAN_MIN   : kemiripan minimal (0..1)
+POS_SARAN_MAKS = int(os.getenv("POS_SARAN_MAKS", "3"))
+POS_SARAN_MIN = float(os.getenv("POS_SARAN_MIN", "0.75"))
 
-    if "file" not in request.files:
-        return jsonify({"status": "error", "message": "File tidak ditemukan di request!"})
 
-    file = request.files["file"]
-    if file.filename == "":
-        return jsonify({"status": "error", "message": "Tidak ada file yang dipilih!"})
+def normalisasi_nama_pos(nama):
+    """'  Pos  Bakung ' -> 'pos bakung'."""
+    return " ".join(str(nama).split()).lower()
 
-    filename = file.filename.lower()
 
+def versi_pos():
+    """Naik setiap kali metadata pos berubah (lihat naikkan_versi_pos)."""
+    row = state_db().execute("SELECT versi FROM versi_pos WHERE id = 1").fetchone()
+    return row[0] if row else 0
+
+
+def naikkan_versi_pos():
     try:
-        if filename.endswith(".csv"):
-            df = pd.read_csv(file)
-        else:
-            df = pd.read_excel(file)
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Gagal membaca file (Excel/CSV): {e}"})
+        with transaksi_state() as db:
+            db.execute("""
+                INSERT INTO versi_pos (id, versi) VALUES (1, 1)
+                ON CONFLICT (id) DO UPDATE SET versi = versi + 1
+            """)
+    except sqlite3.Error as e:
+        app.logger.warning("Gagal menaikkan versi pos: %s", e)
 
-    required_cols = [
-        "Pos Hujan", "ID", "Balai", "Provinsi",
-        "Kabupaten", "Kecamatan", "Lintang", "Bujur", "Elevasi"
-    ]
-    for col in required_cols:
-        if col not in df.columns:
-            return jsonify({
-                "status": "error",
-                "message": f"Kolom wajib '{col}' tidak ditemukan di file!"
-            })
 
-    df = df.fillna("")
+class RegistryPos:
+    """
+    Semua pos dalam urutan daftar pos (kabupaten, nama). Baris ke-i:
+    id[i], kode[i], nama[i], lat[i]/lng[i] (NaN = kosong), kecamatan[i],
+    kabupaten[kab[i]] dan provinsi[prov[i]] (-1 = kosong).
+    Lookup id/kode/nama lewat dict ke nomor baris.
+    """
 
-    conn = get_db()
-    cur = conn.cursor()
+    def __init__(self, rows):
+        self.id = np.array([r[0] for r in rows], dtype=np.int64)
+        self.kode = np.array([r[1] for r in rows], dtype=object)
+        self.nama = np.array([r[2] for r in rows], dtype=object)
+        self.lat = np.array([np.nan if r[3] is None else r[3] for r in rows], dtype=np.float64)
+        self.lng = np.array([np.nan if r[4] is None else r[4] for r in rows], dtype=np.float64)
+        self.kecamatan = np.array([r[7] for r in rows], dtype=object)
 
-    try:
-        for _, row in df.iterrows():
-            nama_prov = str(row["Provinsi"]).strip()
-            nama_kab  = str(row["Kabupaten"]).strip()
-
-            # PROVINSI
-            if nama_prov != "":
-                cur.execute("""
-                    INSERT INTO provinsi (nama_provinsi)
-                    VALUES (%s)
-                    ON CONFLICT (nama_provinsi) DO NOTHING;
-                """, (nama_prov,))
-
-                cur.execute("""
-                    SELECT id_provinsi
-                    FROM provinsi
-                    WHERE nama_provinsi = %s
-                """, (nama_prov,))
-                res = cur.fetchone()
-                id_prov = res[0] if res else None
-            else:
-                id_prov = None
-
-            # KABUPATEN
-            if nama_kab != "" and id_prov is not None:
-                cur.execute("""
-                    INSERT INTO kabupaten (id_provinsi, nama_kabupaten)
-                    VALUES (%s, %s)
-                    ON CONFLICT (id_provinsi, nama_kabupaten) DO NOTHING;
-                """, (id_prov, nama_kab))
-
-                cur.execute("""
-                    SELECT id_kabupaten
-                    FROM kabupaten
-                    WHERE id_provinsi = %s AND nama_kabupaten = %s
-                """, (id_prov, nama_kab))
-                res = cur.fetchone()
-                id_kab = res[0] if res else None
-            else:
-                id_kab = None
+        kab = pd.Categorical([r[5] for r in rows])
+        prov = pd.Categorical([r[6] for r in rows])
+        self.kabupaten = list(kab.categories)
+        self.provinsi = list(prov.categories)
+        self.kab = kab.codes.astype(np.int32)
+        self.prov = prov.codes.astype(np.int32)
 
-            # POS HUJAN
-            kode_pos = str(row["ID"]).strip()
-            nama_pos = str(row["Pos Hujan"]).strip()
-            balai    = str(row["Balai"]).strip() or None
-            kec      = str(row["Kecamatan"]).strip() or None
+        self._baris_id = {int(v): i for i, v in enumerate(self.id)}
+        self._baris_kode = {v: i for i, v in enumerate(self.kode) if v is not None}
+        # nama kembar setelah normalisasi: yang terakhir menang
+        self._baris_nama = {
+            normalisasi_nama_pos(v): i for i, v in enumerate(self.nama) if v is not None
+        }
+        self._nama_norm = list(self._baris_nama)
+        self._saran = {}
+        self._mapping = None
+        self._tetangga = None
 
-            try:
-                lintang = float(row["Lintang"])
-                bujur   = float(row["Bujur"])
-            except Exception:
-                print("Baris dilewati (Lintang/Bujur tidak valid):", nama_pos)
-                continue
+    def __len__(self):
+        return len(self.id)
 
-            elev = None
-            elev_str = str(row["Elevasi"]).strip()
-            if elev_str != "":
-                try:
-                    elev = int(float(elev_str))
-                except Exception:
-                    elev = None
+    def cari_id(self, id_poshujan):
+        return self._baris_id.get(id_poshujan)
 
-            cur.execute("""
-                INSERT INTO pos_hujan (
-                    kode_pos, nama_pos, balai, kecamatan,
-                    id_provinsi, id_kabupaten,
-                    lintang_dd, bujur_dd, elevasi_m, geom
-                )
-                VALUES (
-                    %s, %s, %s, %s,
-                    %s, %s,
-                    %s, %s, %s,
-                    ST_SetSRID(ST_MakePoint(%s, %s), 4326)
-                )
-                ON CONFLICT (kode_pos)
-                DO UPDATE SET
-                    nama_pos    = EXCLUDED.nama_pos,
-                    balai       = EXCLUDED.balai,
-                    kecamatan   = EXCLUDED.kecamatan,
-                    id_provinsi = EXCLUDED.id_provinsi,
-                    id_kabupaten= EXCLUDED.id_kabupaten,
-                    lintang_dd  = EXCLUDED.lintang_dd,
-                    bujur_dd    = EXCLUDED.bujur_dd,
-                    elevasi_m   = EXCLUDED.elevasi_m,
-                    geom        = EXCLUDED.geom;
-            """, (
-                kode_pos, nama_pos, balai, kec,
-                id_prov, id_kab,
-                lintang, bujur, elev,
-                bujur, lintang
-            ))
+    def cari_kode(self, kode_pos):
+        return self._baris_kode.get(kode_pos)
 
-        conn.commit()
+    def cari_nama(self, nama):
+        return self._baris_nama.get(normalisasi_nama_pos(nama))
 
-    except Exception as e:
-        conn.rollback()
-        cur.close()
-        conn.close()
-        return jsonify({"status": "error", "message": f"Error saat simpan metadata: {e}"})
+    def mapping_nama(self):
+        """Series nama ternormalisasi -> id_poshujan (untuk siapkan_baris_ch)."""
+        if self._mapping is None:
+            self._mapping = pd.Series(
+                self.id[list(self._baris_nama.values())].astype(object),
+                index=pd.Index(self._nama_norm, dtype=object),
+                dtype=object,
+            )
+        return self._mapping
 
-    cur.close()
-    conn.close()
-    return jsonify({"status": "success", "message": "Metadata pos hujan berhasil disimpan ke database."})
+    def tetangga(self):
+        """Tetangga QC tiap baris (tetangga_qc), dihitung sekali per registry."""
+        if self._tetangga is None:
+            self._tetangga = tetangga_qc(self.lat, self.lng)
+        return self._tetangga
+
+    def saran(self, nama, n=POS_SARAN_MAKS, minimal=POS_SARAN_MIN):
+        """Nama pos terdaftar yang paling mirip dengan `nama` (urut dari yang termirip)."""
+        kunci = normalisasi_nama_pos(nama)
+        if kunci not in self._saran:
+            cocok = difflib.get_close_matches(kunci, self._nama_norm, n=n, cutoff=minimal)
+            self._saran[kunci] = [self.nama[self._baris_nama[c]] for c in cocok]
+        return self._saran[kunci]
+
+    def saran_banyak(self, daftar_nama):
+        """{nama: [saran, ...]} untuk nama yang punya saran."""
+        hasil = {}
+        for nama in daftar_nama:
+            saran = self.saran(nama)
+            if saran:
+                hasil[nama] = saran
+        return hasil
+
+    def pos(self, i):
+        """Dict metadata baris ke-i (format sama dengan ambil_daftar_pos)."""
+        return {
+            "id_poshujan": int(self.id[i]),
+            "kode_pos":    self.kode[i],
+            "nama":        self.nama[i],
+            "lat":         None if np.isnan(self.lat[i]) else float(self.lat[i]),
+            "lng":         None if np.isnan(self.lng[i]) else float(self.lng[i]),
+            "kabupaten":   self.kabupaten[self.kab[i]] if self.kab[i] >= 0 else None,
+            "kecamatan":   self.kecamatan[i],
+        }
+
+
+SQL_REGISTRY_POS = f"""
+    SELECT
+        p.id_poshujan,
+        p.kode_pos,
+        p.nama_pos,
+        p.lintang_dd,
+        p.bujur_dd,
+        k.nama_kabupaten,
+        prov.nama_provinsi,
+        p.kecamatan
+    FROM pos_hujan p
+    LEFT JOIN kabupaten k ON p.id_kabupaten = k.id_kabupaten
+    LEFT JOIN provinsi prov ON p.id_provinsi = prov.id_provinsi
+    {URUTAN_DAFTAR_POS}
+"""
+
+_registry_pos = {"pid": None, "versi": None, "registry": None}
+_registry_pos_lock = threading.Lock()
+
+
+def registry_pos():
+    """Registry per proses, dimuat ulang kalau versi pos berubah."""
+    versi = versi_pos()
+    with _registry_pos_lock:
+        if (_registry_pos["pid"] != os.getpid()
+                or _registry_pos["versi"] != versi):
+            cur = get_db().cursor()
+            try:
+                cur.execute(SQL_REGISTRY_POS)
+                registry = RegistryPos(cur.fetchall())
+            finally:
+                cur.close()
+            _registry_pos.update(pid=os.getpid(), versi=versi, registry=registry)
+        return _registry_pos["registry"]
+
+
+def daftar_pos(cur, kabupaten=None):
+    """
+    Sama dengan ambil_daftar_pos() (tanpa filter / filter kabupaten), tapi
+    metadata dari registry: yang dibaca dari database hanya
+    pos_hujan_terkini.
+    """
+    registry = registry_pos()
+    cur.execute("SELECT id_poshujan, tanggal, ch_mm FROM pos_hujan_terkini")
+    terkini = {r[0]: r[1:] for r in cur.fetchall()}
+
+    if kabupaten is None:
+        baris = range(len(registry))
+    elif kabupaten in registry.kabupaten:
+        baris = np.flatnonzero(registry.kab == registry.kabupaten.index(kabupaten))
+    else:
+        baris = []
+
+    hasil = []
+    for i in baris:
+        item = registry.pos(i)
+        tanggal, ch = terkini.get(item["id_poshujan"], (None, None))
+        item["tanggal_terkini"] = tanggal.strftime("%Y-%m-%d") if tanggal is not None else None
+        item["ch_terkini"] = float(ch) if ch is not None else None
+        hasil.append(item)
+    return hasil
 
 
 # ============================================================
-# UPLOAD DATA CURAH HUJAN (EXCEL / CSV) — versi cepat (batch)
+# INDEKS SPASIAL POS HUJAN (bbox / pos terdekat)
 # ============================================================
-@app.route("/upload_curah_hujan", methods=["POST"])
-def upload_curah_hujan():
-    # pastikan login dulu
-    ensure_logged_in_api()
+# Dua engine, dipilih lewat SPASIAL_ENGINE:
+# - "memori" (default): grid lintang/bujur di memori tiap worker, dibangun
+#   dari daftar pos dan dibangun ulang kalau versi data berubah
+#   (upload metadata / CH). Query bbox & terdekat tidak menyentuh database.
+# - "postgis": query langsung ke pos_hujan.geom memakai indeks GiST
+#   (&& untuk bbox, <-> untuk KNN). Indeks dibuat dengan:
+#       flask --app app buat-indeks-spasial
+# - SPASIAL_GRID_DERAJAT : ukuran sel grid (derajat)
+# - SPASIAL_MAX_K        : batas k untuk near=
+# - SPASIAL_MAX_CINCIN   : terdekat() melebar paling jauh sekian cincin sel;
+#                          lebih dari itu (atau titik di luar sebaran pos,
+#                          mis. ?near= di kutub) langsung haversine ke semua
+#                          pos sekaligus (vektor numpy)
+SPASIAL_ENGINE = os.getenv("SPASIAL_ENGINE", "memori")
+SPASIAL_GRID_DERAJAT = float(os.getenv("SPASIAL_GRID_DERAJAT", "0.5"))
+SPASIAL_MAX_K = int(os.getenv("SPASIAL_MAX_K", "100"))
+SPASIAL_MAX_CINCIN = int(os.getenv("SPASIAL_MAX_CINCIN", "4"))
+# - CLUSTER_RADIUS_PX    : ukuran sel cluster di layar (piksel) per zoom
+# - CLUSTER_MAX_ZOOM     : zoom tertinggi yang masih di-cluster
+CLUSTER_RADIUS_PX = int(os.getenv("CLUSTER_RADIUS_PX", "60"))
+CLUSTER_MAX_ZOOM = int(os.getenv("CLUSTER_MAX_ZOOM", "18"))
 
-    if "file" not in request.files:
-        return jsonify({"status": "error", "message": "File tidak ditemukan di request!"})
+RADIUS_BUMI_KM = 6371.0088
+KM_PER_DERAJAT = np.pi * RADIUS_BUMI_KM / 180
 
-    file = request.files["file"]
-    if file.filename == "":
-        return jsonify({"status": "error", "message": "Tidak ada file yang dipilih!"})
+DDL_INDEKS_SPASIAL = """
+    CREATE INDEX IF NOT EXISTS pos_hujan_geom_gist
+        ON pos_hujan USING GIST (geom);
+"""
 
-    filename = file.filename.lower()
 
-    # --- BACA EXCEL / CSV ----------------------------------------------------
-    try:
-        if filename.endswith(".csv"):
-            df = pd.read_csv(file)
+def jarak_km(lat, lng, lat_arr, lng_arr):
+    """Jarak haversine (km) dari satu titik ke array titik."""
+    lat1, lng1 = np.radians(lat), np.radians(lng)
+    lat2, lng2 = np.radians(lat_arr), np.radians(lng_arr)
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * RADIUS_BUMI_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class IndeksSpasial:
+    """
+    Grid sel persegi (ukuran_sel derajat) atas lintang/bujur pos.
+    bbox  : hanya sel yang beririsan dengan kotak yang diperiksa.
+    terdekat : cari melebar cincin demi cincin dari sel titik acuan,
+               berhenti begitu k kandidat terbaik pasti sudah tercakup;
+               titik di luar sebaran pos atau pencarian yang melebihi
+               SPASIAL_MAX_CINCIN dihitung langsung ke semua pos.
+    """
+
+    def __init__(self, daftar, ukuran_sel=SPASIAL_GRID_DERAJAT):
+        self.daftar = [d for d in daftar if d["lat"] is not None and d["lng"] is not None]
+        self.ukuran = ukuran_sel
+        self.lat = np.array([d["lat"] for d in self.daftar], dtype=np.float64)
+        self.lng = np.array([d["lng"] for d in self.daftar], dtype=np.float64)
+        self.ch = np.array(
+            [np.nan if d.get("ch_terkini") is None else d["ch_terkini"] for d in self.daftar],
+            dtype=np.float64,
+        )
+        self._cluster = {}
+
+        self.sel = {}
+        if not self.daftar:
+            self.batas = (0, 0, 0, 0)
+            return
+
+        si = np.floor(self.lat / ukuran_sel).astype(np.int64)
+        sj = np.floor(self.lng / ukuran_sel).astype(np.int64)
+        urut = np.lexsort((sj, si))
+        kunci = np.stack([si[urut], sj[urut]], axis=1)
+        awal = np.flatnonzero(np.r_[True, np.any(kunci[1:] != kunci[:-1], axis=1)])
+        for idx in np.split(urut, awal[1:]):
+            self.sel[(int(si[idx[0]]), int(sj[idx[0]]))] = idx
+        self.batas = (si.min(), si.max(), sj.min(), sj.max())
+
+    def _sel_idx(self, lat, lng):
+        return int(np.floor(lat / self.ukuran)), int(np.floor(lng / self.ukuran))
+
+    def _kumpulkan(self, daftar_sel):
+        bagian = [self.sel[c] for c in daftar_sel if c in self.sel]
+        return np.concatenate(bagian) if bagian else np.zeros(0, dtype=np.int64)
+
+    def bbox(self, w, s, e, n):
+        i0, j0 = self._sel_idx(s, w)
+        i1, j1 = self._sel_idx(n, e)
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > len(self.sel):
+            # kotak lebih luas dari isi grid: cukup periksa sel yang terisi
+            daftar_sel = [c for c in self.sel if i0 <= c[0] <= i1 and j0 <= c[1] <= j1]
         else:
-            df = pd.read_excel(file)
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Gagal membaca file (Excel/CSV): {e}"})
+            daftar_sel = [(i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)]
+        idx = self._kumpulkan(daftar_sel)
+        masuk = ((self.lat[idx] >= s) & (self.lat[idx] <= n)
+                 & (self.lng[idx] >= w) & (self.lng[idx] <= e))
+        return np.sort(idx[masuk])
 
-    # Normalisasi nama kolom
-    df.columns = df.columns.str.strip().str.lower().str.replace(" ", "_")
+    def terdekat(self, lat, lng, k, radius_km=None):
+        """Return (indeks, jarak_km) urut dari yang terdekat."""
+        if not self.daftar:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
 
-    col_pos = next((c for c in ["pos_hujan", "pos", "stasiun"] if c in df.columns), None)
-    col_tgl = next((c for c in ["tanggal", "tgl", "date"] if c in df.columns), None)
-    col_ch  = next((c for c in ["curah_hujan", "ch", "ch_mm", "hujan"] if c in df.columns), None)
+        ci, cj = self._sel_idx(lat, lng)
+        i_min, i_max, j_min, j_max = self.batas
+        if not (i_min <= ci <= i_max and j_min <= cj <= j_max):
+            return self._terdekat_semua(lat, lng, k, radius_km)
 
-    if not col_pos or not col_tgl or not col_ch:
-        return jsonify({
-            "status": "error",
-            "message": "Kolom wajib (Pos Hujan, Tanggal, Curah Hujan) tidak ditemukan di file."
-        })
+        kandidat = []
+        for r in range(SPASIAL_MAX_CINCIN + 1):
+            if r == 0:
+                cincin = [(ci, cj)]
+            else:
+                cincin = ([(ci - r, j) for j in range(cj - r, cj + r + 1)]
+                          + [(ci + r, j) for j in range(cj - r, cj + r + 1)]
+                          + [(i, cj - r) for i in range(ci - r + 1, ci + r)]
+                          + [(i, cj + r) for i in range(ci - r + 1, ci + r)])
+            baru = self._kumpulkan(cincin)
+            if len(baru):
+                kandidat.append(baru)
 
-    df_use = df[[col_pos, col_tgl, col_ch]].copy()
-    df_use.columns = ["pos_hujan", "tanggal", "curah_hujan"]
+            # jarak (km) yang pasti sudah tercakup cincin 0..r; satu derajat
+            # bujur makin sempit ke arah kutub, jadi pakai lintang terjauh
+            lintang_jauh = min(abs(lat) + r * self.ukuran, 89.0)
+            tercakup = r * self.ukuran * KM_PER_DERAJAT * np.cos(np.radians(lintang_jauh))
+            if radius_km is not None and tercakup >= radius_km:
+                break
+            if kandidat and sum(len(x) for x in kandidat) >= k:
+                idx = np.concatenate(kandidat)
+                jarak = jarak_km(lat, lng, self.lat[idx], self.lng[idx])
+                if np.partition(jarak, k - 1)[k - 1] <= tercakup:
+                    break
+        else:
+            return self._terdekat_semua(lat, lng, k, radius_km)
 
-    df_use["tanggal"] = pd.to_datetime(df_use["tanggal"], errors="coerce").dt.date
-    df_use["curah_hujan"] = pd.to_numeric(df_use["curah_hujan"], errors="coerce")
+        if not kandidat:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        idx = np.concatenate(kandidat)
+        jarak = jarak_km(lat, lng, self.lat[idx], self.lng[idx])
+        return self._pilih_terdekat(idx, jarak, k, radius_km)
 
-    # Handle kode 8888 / 9999 / negatif
-    df_use.loc[df_use["curah_hujan"].isin([8888, 9999]), "curah_hujan"] = pd.NA
-    df_use.loc[df_use["curah_hujan"] < 0, "curah_hujan"] = pd.NA
+    def _terdekat_semua(self, lat, lng, k, radius_km):
+        jarak = jarak_km(lat, lng, self.lat, self.lng)
+        return self._pilih_terdekat(np.arange(len(jarak)), jarak, k, radius_km)
 
-    conn = get_db()
-    cur = conn.cursor()
+    @staticmethod
+    def _pilih_terdekat(idx, jarak, k, radius_km):
+        if radius_km is not None:
+            dekat = jarak <= radius_km
+            idx, jarak = idx[dekat], jarak[dekat]
+        if len(jarak) > k:
+            sebagian = np.argpartition(jarak, k - 1)[:k]
+            idx, jarak = idx[sebagian], jarak[sebagian]
+        urut = np.lexsort((idx, jarak))
+        return idx[urut], jarak[urut]
 
-    gagal_pos = []
-    rows_insert = []
+    def cluster(self, zoom):
+        """
+        Cluster grid di ruang piksel Web Mercator untuk satu level zoom:
+        pos yang jatuh di sel CLUSTER_RADIUS_PX x CLUSTER_RADIUS_PX yang
+        sama digabung. Hasil disimpan per zoom (indeks ini sendiri sudah
+        per versi data), jadi tiap zoom cukup dihitung sekali.
+        Return dict array: lat, lng (centroid), jumlah, ch_maks, ch_rata,
+        w/s/e/n (batas anggota) dan anggota (indeks pos kalau jumlah == 1,
+        selain itu -1).
+        """
+        if zoom in self._cluster:
+            return self._cluster[zoom]
 
-    try:
-        # 1) Ambil semua mapping nama_pos -> id_poshujan sekali saja
-        cur.execute("SELECT LOWER(nama_pos), id_poshujan FROM pos_hujan;")
-        mapping = {row[0]: row[1] for row in cur.fetchall()}
+        skala = 256 * 2 ** zoom / CLUSTER_RADIUS_PX
+        x = (self.lng + 180) / 360 * skala
+        sin_lat = np.clip(np.sin(np.radians(self.lat)), -0.9999, 0.9999)
+        y = (0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)) * skala
+        kunci = np.floor(x).astype(np.int64) * (1 << 32) + np.floor(y).astype(np.int64)
 
-        # 2) Siapkan data yang akan diinsert (di-memory dulu)
-        for _, row in df_use.iterrows():
-            if pd.isna(row["tanggal"]) or pd.isna(row["curah_hujan"]):
-                continue
+        _, pertama, grup, jumlah = np.unique(
+            kunci, return_index=True, return_inverse=True, return_counts=True
+        )
+        n = len(jumlah)
+        ada_ch = ~np.isnan(self.ch)
+        n_ch = np.bincount(grup, weights=ada_ch, minlength=n)
+        total_ch = np.bincount(grup, weights=np.where(ada_ch, self.ch, 0), minlength=n)
 
-            nama_pos_asli = str(row["pos_hujan"]).strip()
-            nama_pos = nama_pos_asli.lower()
-            tanggal  = row["tanggal"]
-            ch       = float(row["curah_hujan"])
+        ch_maks = np.full(n, np.nan)
+        np.fmax.at(ch_maks, grup, self.ch)
+        batas = {}
+        for nama, arr, fungsi, awal in (("w", self.lng, np.minimum, np.inf),
+                                        ("e", self.lng, np.maximum, -np.inf),
+                                        ("s", self.lat, np.minimum, np.inf),
+                                        ("n", self.lat, np.maximum, -np.inf)):
+            batas[nama] = np.full(n, awal)
+            fungsi.at(batas[nama], grup, arr)
 
-            id_pos = mapping.get(nama_pos)
-            if not id_pos:
-                gagal_pos.append(nama_pos_asli)
-                continue
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ch_rata = total_ch / n_ch
+        hasil = {
+            "lat": np.bincount(grup, weights=self.lat, minlength=n) / jumlah,
+            "lng": np.bincount(grup, weights=self.lng, minlength=n) / jumlah,
+            "jumlah": jumlah,
+            "ch_maks": ch_maks,
+            "ch_rata": ch_rata,
+            "anggota": np.where(jumlah == 1, pertama, -1),
+            **batas,
+        }
+        self._cluster[zoom] = hasil
+        return hasil
 
-            rows_insert.append(
-                (id_pos, tanggal, ch, "Upload Excel/CSV")
+
+_indeks_spasial = {"pid": None, "versi": None, "indeks": None}
+_indeks_spasial_lock = threading.Lock()
+
+
+def indeks_spasial():
+    """Indeks spasial per proses, dibangun ulang kalau versi data berubah."""
+    versi = versi_data()
+    with _indeks_spasial_lock:
+        if (_indeks_spasial["pid"] != os.getpid()
+                or _indeks_spasial["versi"] != versi):
+            cur = get_db().cursor()
+            try:
+                daftar = daftar_pos(cur)
+            finally:
+                cur.close()
+            _indeks_spasial.update(pid=os.getpid(), versi=versi, indeks=IndeksSpasial(daftar))
+        return _indeks_spasial["indeks"]
+
+
+def cari_pos_bbox(w, s, e, n):
+    if SPASIAL_ENGINE == "postgis":
+        cur = get_db().cursor()
+        try:
+            return ambil_daftar_pos(
+                cur, "WHERE p.geom && ST_MakeEnvelope(%s, %s, %s, %s, 4326)", (w, s, e, n)
             )
+        finally:
+            cur.close()
 
-        # 3) Batch insert ke curah_hujan (ON CONFLICT DO UPDATE)
-        if rows_insert:
-            execute_values(cur, """
-                INSERT INTO curah_hujan (id_poshujan, tanggal, ch_mm, sumber_data)
-                VALUES %s
-                ON CONFLICT (id_poshujan, tanggal)
-                DO UPDATE SET
-                    ch_mm       = EXCLUDED.ch_mm,
-                    sumber_data = EXCLUDED.sumber_data,
-                    created_at  = NOW();
-            """, rows_insert, page_size=500)
+    indeks = indeks_spasial()
+    return [indeks.daftar[i] for i in indeks.bbox(w, s, e, n)]
 
-        conn.commit()
 
-    except Exception as e:
-        conn.rollback()
-        cur.close()
-        conn.close()
-        return jsonify({"status": "error", "message": f"Error saat simpan curah hujan: {e}"})
+def cari_pos_terdekat(lat, lng, k, radius_km=None):
+    if SPASIAL_ENGINE == "postgis":
+        where, params = "WHERE p.geom IS NOT NULL", [lng, lat]
+        if radius_km is not None:
+            where += """
+                AND ST_DWithin(p.geom::geography,
+                               ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography,
+                               %s)"""
+            params = [lng, lat, radius_km * 1000] + params
+        cur = get_db().cursor()
+        try:
+            # <-> memakai indeks GiST (KNN); jarak_km dihitung ulang di bawah
+            daftar = ambil_daftar_pos(
+                cur, where, params + [k],
+                urutan="ORDER BY p.geom <-> ST_SetSRID(ST_MakePoint(%s, %s), 4326) LIMIT %s",
+            )
+        finally:
+            cur.close()
+        lat_arr = np.array([d["lat"] for d in daftar], dtype=np.float64)
+        lng_arr = np.array([d["lng"] for d in daftar], dtype=np.float64)
+        jarak = jarak_km(lat, lng, lat_arr, lng_arr)
+        urut = np.argsort(jarak, kind="stable")
+        return [{**daftar[i], "jarak_km": round(float(jarak[i]), 3)} for i in urut]
 
-    cur.close()
-    conn.close()
+    indeks = indeks_spasial()
+    idx, jarak = indeks.terdekat(lat, lng, k, radius_km)
+    return [
+        {**indeks.daftar[i], "jarak_km": round(float(j), 3)}
+        for i, j in zip(idx, jarak)
+    ]
+
+
+@app.route("/api/pos_hujan/cluster")
+@cache_respons("pos_hujan")
+def api_pos_hujan_cluster():
+    """
+    Pos yang sudah di-cluster untuk peta: ?zoom=<level>[&bbox=minLng,minLat,maxLng,maxLat].
+    Tiap cluster: jumlah pos, centroid, CH terkini maks/rata-rata dan
+    bbox anggotanya (untuk zoom ke cluster). Cluster berisi satu pos
+    membawa data pos lengkap di "pos".
+    """
+    try:
+        zoom = parse_int_param("zoom", 0, CLUSTER_MAX_ZOOM)
+        bbox = parse_bbox_param("bbox")
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    if zoom is None:
+        return jsonify({"status": "error", "message": "zoom wajib ada"}), 400
+
+    indeks = indeks_spasial()
+    c = indeks.cluster(zoom)
+
+    pilih = np.arange(len(c["jumlah"]))
+    if bbox is not None:
+        w, s, e, n = bbox
+        # cluster ikut kalau ada anggotanya yang beririsan dengan bbox
+        pilih = pilih[(c["e"] >= w) & (c["w"] <= e) & (c["n"] >= s) & (c["s"] <= n)]
+
+    def angka(x):
+        return None if np.isnan(x) else round(float(x), 1)
+
+    hasil = []
+    for i in pilih:
+        item = {
+            "lat": float(c["lat"][i]),
+            "lng": float(c["lng"][i]),
+            "jumlah": int(c["jumlah"][i]),
+            "ch_maks": angka(c["ch_maks"][i]),
+            "ch_rata": angka(c["ch_rata"][i]),
+            "bbox": [float(c["w"][i]), float(c["s"][i]), float(c["e"][i]), float(c["n"][i])],
+        }
+        if c["anggota"][i] >= 0:
+            item["pos"] = indeks.daftar[c["anggota"][i]]
+        hasil.append(item)
+
+    return jsonify({
+        "status": "success",
+        "zoom": zoom,
+        "jumlah_pos": int(c["jumlah"][pilih].sum()),
+        "cluster": hasil,
+    })
 
-    if gagal_pos:
-        gagal_unik = sorted(set(gagal_pos))
-        return jsonify({
-            "status": "success",
-            "message": "Sebagian besar data curah hujan tersimpan. Namun beberapa Pos Hujan tidak ditemukan di metadata.",
-            "pos_tidak_ditemukan": gagal_unik
-        })
 
-    return jsonify({"status": "success", "message": "Semua data curah hujan berhasil disimpan."})
+@app.cli.command("buat-indeks-spasial")
+def buat_indeks_spasial_command():
+    """Isi geom yang masih kosong lalu buat indeks GiST pos_hujan.geom."""
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            UPDATE pos_hujan
+            SET geom = ST_SetSRID(ST_MakePoint(bujur_dd, lintang_dd), 4326)
+            WHERE geom IS NULL
+              AND lintang_dd IS NOT NULL
+              AND bujur_dd IS NOT NULL
+        """)
+        diisi = cur.rowcount
+        cur.execute(DDL_INDEKS_SPASIAL)
+        cur.execute("ANALYZE pos_hujan")
+        conn.commit()
+    finally:
+        cur.close()
+    click.echo(f"geom diisi untuk {diisi} pos; indeks pos_hujan_geom_gist siap")
 
 
 # ============================================================
-# DEBUG: CEK DB & VERSI POSTGRES
+# API JSON CURAH HUJAN PER POS
 # ============================================================
-@app.route("/debug_db")
-def debug_db():
+# Batas ukuran respons /api/curah_hujan:
+# - CH_API_MAX_LIMIT  : baris maksimal per halaman (?limit=)
+# - CH_API_MAX_POINTS : titik maksimal hasil downsampling (?max_points=)
+CH_API_MAX_LIMIT = int(os.getenv("CH_API_MAX_LIMIT", "10000"))
+CH_API_MAX_POINTS = int(os.getenv("CH_API_MAX_POINTS", "5000"))
+
+
+@app.route("/api/curah_hujan")
+@cache_respons()
+def api_curah_hujan():
+    """
+    Seri CH satu pos.
+
+    Parameter:
+    - nama_pos   : wajib
+    - mode       : harian (default) / bulanan
+    - start, end : YYYY-MM-DD, batas periode (inklusif)
+    - limit      : jumlah baris per halaman; kalau masih ada sisa,
+                   respons berisi next_cursor
+    - cursor     : nilai next_cursor dari halaman sebelumnya
+    - max_points : downsampling LTTB di server (puncak hujan tetap terjaga)
+    - qc         : bersih (default) / semua / daftar flag, lihat parse_qc_param()
+    - format     : json (default) / bin / arrow, lihat respons_seri()
+    """
+    nama_pos = request.args.get("nama_pos", "").strip()
+    mode = request.args.get("mode", "harian").lower()
+
+    if not nama_pos:
+        return jsonify({"status": "error", "message": "nama_pos wajib ada"}), 400
+    if mode not in ("harian", "bulanan"):
+        return jsonify({"status": "error", "message": "mode harus harian atau bulanan"}), 400
+
+    try:
+        start = parse_tanggal_param("start")
+        end = parse_tanggal_param("end")
+        limit = parse_int_param("limit", 1, CH_API_MAX_LIMIT)
+        max_points = parse_int_param("max_points", 3, CH_API_MAX_POINTS)
+        cursor = parse_cursor_ch(request.args.get("cursor"), mode)
+        saring_qc = parse_qc_param()
+        fmt = format_seri()
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except LookupError as e:
+        return jsonify({"status": "error", "message": str(e)}), 406
+
+    registry = registry_pos()
+    baris = registry.cari_nama(nama_pos)
+    if baris is None:
+        return jsonify({
+            "status": "error",
+            "message": "Pos tidak ditemukan",
+            "saran": registry.saran(nama_pos),
+        }), 404
+
+    id_pos = int(registry.id[baris])
+    tandai_cache(f"pos:{id_pos}")
+
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("SELECT current_database(), version();")
-    db_name, ver = cur.fetchone()
+
+    if mode == "bulanan":
+        select = "date_trunc('month', tanggal)::date AS bulan, SUM(ch_mm)::float8"
+        group_by = "GROUP BY bulan ORDER BY bulan"
+        kunci_label, format_label = "bulan", "%Y-%m"
+    else:
+        select = "tanggal, ch_mm::float8"
+        group_by = "ORDER BY tanggal"
+        kunci_label, format_label = "tanggal", "%Y-%m-%d"
+
+    # limit + 1 baris supaya tahu masih ada halaman berikutnya atau tidak
+    cur.execute(f"""
+        SELECT {select}
+        FROM curah_hujan
+        WHERE id_poshujan = %s
+          AND ch_mm IS NOT NULL
+          AND (qc_flag & %s) = 0
+          AND (%s::date IS NULL OR tanggal >= %s::date)
+          AND (%s::date IS NULL OR tanggal <= %s::date)
+          AND (%s::date IS NULL OR tanggal > %s::date)
+        {group_by}
+        LIMIT %s
+    """, (id_pos, saring_qc, start, start, end, end, cursor, cursor,
+          None if limit is None else limit + 1))
+    rows = cur.fetchall()
     cur.close()
-    conn.close()
-    return f"DB: {db_name}<br>Versi: {ver}"
+
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1][0].strftime(format_label)
+
+    jumlah_asli = len(rows)
+    diperkecil = max_points is not None and jumlah_asli > max_points
+
+    if fmt != "json":
+        # Langsung dari hasil query ke array, tanpa dict per baris
+        periode = np.array([r[0] for r in rows], dtype="datetime64[D]")
+        ch = np.array([r[1] for r in rows], dtype=np.float64)
+        if diperkecil:
+            idx = lttb(periode.astype(np.float64), ch, max_points)
+            periode, ch = periode[idx], ch[idx]
+        return respons_seri(fmt, mode, periode, ch[np.newaxis, :], {
+            "nama_pos": nama_pos,
+            "id_poshujan": [id_pos],
+            "jumlah_asli": jumlah_asli,
+            "next_cursor": next_cursor,
+        }, pakai_offset=diperkecil)
+
+    if diperkecil:
+        x = np.array([r[0].toordinal() for r in rows], dtype=np.float64)
+        y = np.array([r[1] for r in rows], dtype=np.float64)
+        rows = [rows[i] for i in lttb(x, y, max_points)]
+
+    data = [{kunci_label: r[0].strftime(format_label), "ch": r[1]} for r in rows]
+
+    return jsonify({
+        "status": "success",
+        "mode": mode,
+        "nama_pos": nama_pos,
+        "jumlah": len(data),
+        "jumlah_asli": jumlah_asli,
+        "next_cursor": next_cursor,
+        "data": data
+    })
+
+
+def parse_cursor_ch(nilai, mode):
+    """
+    Cursor = label periode terakhir di halaman sebelumnya (YYYY-MM-DD untuk
+    harian, YYYY-MM untuk bulanan). Dikonversi ke tanggal batas "> cursor".
+    """
+    nilai = (nilai or "").strip()
+    if not nilai:
+        return None
+    try:
+        if mode == "bulanan":
+            bulan = datetime.strptime(nilai, "%Y-%m")
+            # semua tanggal di bulan cursor sudah terkirim
+            return (pd.Timestamp(bulan) + pd.offsets.MonthEnd(0)).date()
+        return datetime.strptime(nilai, "%Y-%m-%d").date()
+    except ValueError:
+        raise ValueError("Parameter cursor tidak valid") from None
+
+
+def lttb(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets: pilih n_out indeks dari seri (x, y)
+    yang bentuknya paling mirip aslinya. Titik pertama & terakhir selalu
+    ikut, dan di tiap bucket dipilih titik yang membentuk segitiga terbesar
+    sehingga puncak (hari hujan lebat) tidak hilang seperti pada rata-rata.
+    Return array indeks (urut naik).
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # batas bucket untuk titik 1..n-2 (titik pertama/terakhir berdiri sendiri)
+    batas = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    hasil = np.empty(n_out, dtype=np.int64)
+    hasil[0] = 0
+    hasil[-1] = n - 1
+
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = batas[i], batas[i + 1]
+
+        # rata-rata bucket berikutnya (bucket terakhir = titik terakhir)
+        if i + 2 < len(batas):
+            nlo, nhi = batas[i + 1], batas[i + 2]
+            cx, cy = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        else:
+            cx, cy = x[n - 1], y[n - 1]
+
+        luas = np.abs(
+            (x[a] - cx) * (y[lo:hi] - y[a])
+            - (x[a] - x[lo:hi]) * (cy - y[a])
+        )
+        a = lo + int(np.argmax(luas))
+        hasil[i + 1] = a
+
+    return hasil
+
+
+# ============================================================
+# API CH BANYAK POS SEKALIGUS (FORMAT KOLOM)
+# ============================================================
+# Batas jumlah pos per permintaan /api/curah_hujan/batch
+CH_BATCH_MAX_POS = int(os.getenv("CH_BATCH_MAX_POS", "100"))
+
+
+def daftar_param(nama):
+    """?nama=a,b&nama=c -> ["a", "b", "c"] (kosong dibuang)."""
+    hasil = []
+    for nilai in request.args.getlist(nama):
+        hasil.extend(v.strip() for v in nilai.split(",") if v.strip())
+    return hasil
+
+
+@app.route("/api/curah_hujan/batch")
+@cache_respons()
+def api_curah_hujan_batch():
+    """
+    Seri CH beberapa pos dalam satu query.
+
+    Parameter:
+    - id         : daftar id_poshujan (dipisah koma / diulang)
+    - kode       : daftar kode_pos (dipisah koma / diulang)
+    - mode       : harian (default) / bulanan
+    - start, end : YYYY-MM-DD, batas periode (inklusif)
+    - qc         : bersih (default) / semua / daftar flag, lihat parse_qc_param()
+    - format     : json (default) / bin / arrow, lihat respons_seri()
+
+    Respons berbentuk kolom: satu sumbu "tanggal" bersama, lalu satu
+    array "ch" per pos yang sejajar dengan sumbu itu (null = tidak ada data).
+    """
+    mode = request.args.get("mode", "harian").lower()
+    if mode not in ("harian", "bulanan"):
+        return jsonify({"status": "error", "message": "mode harus harian atau bulanan"}), 400
+
+    try:
+        start = parse_tanggal_param("start")
+        end = parse_tanggal_param("end")
+        saring_qc = parse_qc_param()
+        fmt = format_seri()
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except LookupError as e:
+        return jsonify({"status": "error", "message": str(e)}), 406
+
+    try:
+        ids = [int(v) for v in daftar_param("id")]
+    except ValueError:
+        return jsonify({"status": "error", "message": "Parameter id harus bilangan bulat"}), 400
+    kodes = daftar_param("kode")
+
+    if not ids and not kodes:
+        return jsonify({"status": "error", "message": "id atau kode wajib ada"}), 400
+    if len(ids) + len(kodes) > CH_BATCH_MAX_POS:
+        return jsonify({
+            "status": "error",
+            "message": f"Maksimal {CH_BATCH_MAX_POS} pos per permintaan"
+        }), 400
+
+    if mode == "bulanan":
+        periode = "date_trunc('month', c.tanggal)::date"
+        format_label = "%Y-%m"
+    else:
+        periode = "c.tanggal"
+        format_label = "%Y-%m-%d"
+
+    # Daftar pos di-resolve dari registry (urut id) + posisi kolomnya
+    registry = registry_pos()
+    baris_id = [registry.cari_id(i) for i in ids]
+    baris_kode = [registry.cari_kode(k) for k in kodes]
+    tidak_ditemukan = (
+        [str(i) for i, b in zip(ids, baris_id) if b is None]
+        + [k for k, b in zip(kodes, baris_kode) if b is None]
+    )
+    baris = sorted(
+        {b for b in baris_id + baris_kode if b is not None},
+        key=lambda b: registry.id[b],
+    )
+    pos_list = [{
+        "id_poshujan": int(registry.id[b]),
+        "kode_pos": registry.kode[b],
+        "nama_pos": registry.nama[b],
+    } for b in baris]
+    kolom = {p["id_poshujan"]: i for i, p in enumerate(pos_list)}
+    for id_pos in kolom:
+        tandai_cache(f"pos:{id_pos}")
+
+    # Satu query untuk semua pos; pos tanpa data di periode ini tetap
+    # punya kolom (isi null)
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT c.id_poshujan, {periode} AS periode, SUM(c.ch_mm)::float8 AS ch
+        FROM curah_hujan c
+        WHERE c.id_poshujan = ANY(%s::bigint[])
+          AND c.ch_mm IS NOT NULL
+          AND (c.qc_flag & %s) = 0
+          AND (%s::date IS NULL OR c.tanggal >= %s::date)
+          AND (%s::date IS NULL OR c.tanggal <= %s::date)
+        GROUP BY 1, 2
+    """, (list(kolom), saring_qc, start, start, end, end))
+    ada_data = cur.fetchall()
+    cur.close()
+
+    # Pivot ke matriks [tanggal x pos]; sel kosong = NaN -> null
+    periode_arr = np.array([r[1] for r in ada_data], dtype="datetime64[D]")
+    sumbu, baris_idx = np.unique(periode_arr, return_inverse=True)
+    matriks = np.full((len(sumbu), len(pos_list)), np.nan)
+    if ada_data:
+        kolom_idx = np.fromiter((kolom[r[0]] for r in ada_data), dtype=np.int64, count=len(ada_data))
+        matriks[baris_idx, kolom_idx] = np.array([r[2] for r in ada_data], dtype=np.float64)
+
+    if fmt != "json":
+        return respons_seri(fmt, mode, sumbu, matriks.T, {
+            "id_poshujan": [p["id_poshujan"] for p in pos_list],
+            "kode_pos": [p["kode_pos"] for p in pos_list],
+            "nama_pos": [p["nama_pos"] for p in pos_list],
+            "tidak_ditemukan": tidak_ditemukan,
+        })
+
+    nilai = matriks.astype(object)
+    nilai[np.isnan(matriks)] = None
+    for i, p in enumerate(pos_list):
+        p["ch"] = nilai[:, i].tolist()
+
+    return jsonify({
+        "status": "success",
+        "mode": mode,
+        "start": start.isoformat() if start else None,
+        "end": end.isoformat() if end else None,
+        "tanggal": [t.strftime(format_label) for t in sumbu.astype(object)],
+        "pos": pos_list,
+        "tidak_ditemukan": tidak_ditemukan,
+    })
+
+
+# ============================================================
+# INDEKS IKLIM SEMUA POS (CDD, Rx5day, ANOMALI BULANAN, DLL)
+# ============================================================
+# Seluruh curah_hujan dimuat sekali menjadi matriks pos x hari (float32,
+# NaN = tidak ada data), lalu semua indeks untuk semua pos dihitung dengan
+# operasi numpy per blok pos, tanpa loop per pos. Hasilnya disimpan per
+# proses dan dihitung ulang kalau versi data berubah (seperti indeks spasial).
+#   /api/indeks_iklim?indeks=cdd&tahun=2024        -> nilai semua pos (peta)
+#   /api/indeks_iklim?indeks=anomali_persen&bulan=2025-10
+#   /pos/<id>                                      -> tabel indeks pos itu
+# Halaman pos tidak memakai matriks semua pos: indeksnya dihitung dari
+# seri pos itu saja (indeks_iklim_pos), jadi tidak ada muat ulang seluruh
+# curah_hujan di jalur request halaman setelah upload.
+# Definisi mengikuti ETCCDI, hari hujan = CH >= 1 mm. Persentil (R95p/R99p)
+# dan normal bulanan memakai seluruh riwayat pos sebagai periode acuan.
+# Memori matriks: jumlah pos x jumlah hari x 4 byte.
+# - IKLIM_MIN_LENGKAP      : fraksi hari berdata minimal supaya indeks satu
+#                            tahun / total satu bulan dianggap sah
+# - IKLIM_MIN_TAHUN_NORMAL : jumlah bulan sah minimal untuk normal bulanan
+# - IKLIM_BLOK_POS         : pos per blok hitung (membatasi array sementara)
+IKLIM_MIN_LENGKAP = float(os.getenv("IKLIM_MIN_LENGKAP", "0.8"))
+IKLIM_MIN_TAHUN_NORMAL = int(os.getenv("IKLIM_MIN_TAHUN_NORMAL", "3"))
+IKLIM_BLOK_POS = int(os.getenv("IKLIM_BLOK_POS", "256"))
+HARI_HUJAN_MM = 1.0
+
+# nama -> (periode, satuan, keterangan)
+INDEKS_IKLIM = {
+    "hari_hujan":     ("tahunan", "hari", "Jumlah hari hujan (CH >= 1 mm)"),
+    "prcptot":        ("tahunan", "mm", "Total CH pada hari hujan"),
+    "sdii":           ("tahunan", "mm/hari", "Rata-rata CH per hari hujan"),
+    "rx1day":         ("tahunan", "mm", "CH 1 hari tertinggi"),
+    "rx5day":         ("tahunan", "mm", "CH 5 hari berturut-turut tertinggi"),
+    "cdd":            ("tahunan", "hari", "Hari kering berturut-turut terpanjang"),
+    "cwd":            ("tahunan", "hari", "Hari hujan berturut-turut terpanjang"),
+    "r10mm":          ("tahunan", "hari", "Jumlah hari CH >= 10 mm"),
+    "r20mm":          ("tahunan", "hari", "Jumlah hari CH >= 20 mm"),
+    "r95p":           ("tahunan", "mm", "Total CH hari di atas persentil 95 hari hujan"),
+    "r99p":           ("tahunan", "mm", "Total CH hari di atas persentil 99 hari hujan"),
+    "ch_bulanan":     ("bulanan", "mm", "Total CH bulanan"),
+    "normal":         ("bulanan", "mm", "Normal bulanan (rata-rata seluruh riwayat)"),
+    "anomali":        ("bulanan", "mm", "Selisih total bulanan terhadap normal"),
+    "anomali_persen": ("bulanan", "%", "Selisih total bulanan terhadap normal (persen)"),
+}
+
+
+def muat_matriks_ch(cur):
+    """
+    Seluruh curah_hujan sebagai (ids, hari0, matriks):
+    ids pos terurut, hari0 = tanggal kolom pertama (datetime64[D]),
+    matriks float32 [pos, hari] dengan NaN untuk hari tanpa data.
+    """
+    cur.execute("SELECT id_poshujan FROM pos_hujan ORDER BY id_poshujan")
+    ids = np.array([r[0] for r in cur.fetchall()], dtype=np.int64)
+
+    # COPY jauh lebih cepat daripada fetchall untuk jutaan baris
+    buf = io.StringIO()
+    cur.copy_expert(f"""
+        COPY (
+            SELECT id_poshujan, tanggal - DATE '1970-01-01', ch_mm
+            FROM curah_hujan
+            WHERE ch_mm IS NOT NULL
+              AND (qc_flag & {QC_SARING}) = 0
+        ) TO STDOUT
+    """, buf)
+    buf.seek(0)
+    data = pd.read_csv(
+        buf, sep="\t", header=None, names=["id", "hari", "ch"],
+        dtype={"id": np.int64, "hari": np.int32, "ch": np.float32},
+    )
+
+    if data.empty:
+        return ids, np.datetime64("1970-01-01"), np.empty((len(ids), 0), dtype=np.float32)
+
+    baris = np.searchsorted(ids, data["id"].to_numpy())
+    baris = np.minimum(baris, len(ids) - 1)
+    ada = ids[baris] == data["id"].to_numpy()
+
+    hari = data["hari"].to_numpy()
+    hari_min = int(hari.min())
+    matriks = np.full((len(ids), int(hari.max()) - hari_min + 1), np.nan, dtype=np.float32)
+    matriks[baris[ada], hari[ada] - hari_min] = data["ch"].to_numpy()[ada]
+    return ids, np.datetime64(hari_min, "D"), matriks
+
+
+def deret_terpanjang(kondisi, awal):
+    """
+    Panjang deret True terpanjang per baris untuk tiap segmen kolom
+    (segmen dimulai di indeks `awal`); deret selalu putus di awal segmen.
+    """
+    idx = np.arange(kondisi.shape[1], dtype=np.int32)
+    putus = np.full(kondisi.shape[1], -1, dtype=np.int32)
+    putus[awal] = awal - 1
+    # posisi putus terakhir <= t; panjang deret di t = t - posisi itu
+    terakhir = np.maximum.accumulate(np.where(kondisi, putus, idx), axis=1)
+    return np.maximum.reduceat(idx - terakhir, awal, axis=1)
+
+
+def persentil_baris(x, q):
+    """
+    Persentil per baris dengan NaN diabaikan (interpolasi linear seperti
+    np.nanpercentile, tapi satu kali sort untuk semua baris).
+    Return [baris, len(q)]; NaN untuk baris tanpa nilai.
+    """
+    urut = np.sort(x, axis=1)  # NaN di akhir
+    n = np.isfinite(x).sum(axis=1)[:, None]
+    posisi = np.maximum(n - 1, 0) * (np.asarray(q, dtype=np.float64) / 100)
+    bawah = np.floor(posisi).astype(np.intp)
+    atas = np.minimum(bawah + 1, np.maximum(n - 1, 0))
+    nilai_bawah = np.take_along_axis(urut, bawah, axis=1)
+    nilai_atas = np.take_along_axis(urut, atas, axis=1)
+    hasil = nilai_bawah + (nilai_atas - nilai_bawah) * (posisi - bawah)
+    return np.where(n > 0, hasil, np.nan)
+
+
+class IndeksIklim:
+    """Indeks iklim tahunan & bulanan semua pos, dihitung sekali dari matriks."""
+
+    def __init__(self, ids, hari0, matriks):
+        self.ids = ids
+        self.baris = {int(i): n for n, i in enumerate(ids)}
+        n_pos, n_hari = matriks.shape
+
+        tanggal = hari0 + np.arange(n_hari)
+        self.tahun, awal_tahun = np.unique(tanggal.astype("datetime64[Y]"), return_index=True)
+        self.bulan, awal_bulan = np.unique(tanggal.astype("datetime64[M]"), return_index=True)
+        # kelengkapan dihitung terhadap jumlah hari kalender, jadi tahun /
+        # bulan yang baru berjalan sebagian tidak dianggap lengkap
+        hari_tahun = ((self.tahun + 1).astype("datetime64[D]") - self.tahun.astype("datetime64[D]")).astype(int)
+        hari_bulan = ((self.bulan + 1).astype("datetime64[D]") - self.bulan.astype("datetime64[D]")).astype(int)
+
+        self.tahunan = {
+            nama: np.full((n_pos, len(self.tahun)), np.nan, dtype=np.float32)
+            for nama, (periode, _, _) in INDEKS_IKLIM.items() if periode == "tahunan"
+        }
+        self.lengkap_tahun = np.zeros((n_pos, len(self.tahun)), dtype=np.float32)
+        ch_bulanan = np.full((n_pos, len(self.bulan)), np.nan, dtype=np.float32)
+
+        if n_hari:
+            for a in range(0, n_pos, IKLIM_BLOK_POS):
+                blok = slice(a, a + IKLIM_BLOK_POS)
+                self._hitung_tahunan(matriks[blok], blok, awal_tahun, hari_tahun)
+                ch_bulanan[blok] = self._hitung_bulanan(matriks[blok], awal_bulan, hari_bulan)
+
+        self.bulanan = self._hitung_anomali(ch_bulanan)
+
+    def _hitung_tahunan(self, x, blok, awal, hari_kalender):
+        def per_tahun(arr, dtype=np.float64):
+            return np.add.reduceat(arr, awal, axis=1, dtype=dtype)
+
+        valid = np.isfinite(x)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            basah = x >= HARI_HUJAN_MM
+            kering = valid & ~basah
+            t = self.tahunan
+
+            hari_hujan = per_tahun(basah, np.int32)
+            prcptot = per_tahun(np.where(basah, x, 0))
+            t["hari_hujan"][blok] = hari_hujan
+            t["prcptot"][blok] = prcptot
+            t["sdii"][blok] = prcptot / hari_hujan
+            t["r10mm"][blok] = per_tahun(x >= 10, np.int32)
+            t["r20mm"][blok] = per_tahun(x >= 20, np.int32)
+
+            rx1 = np.maximum.reduceat(np.where(valid, x, -np.inf), awal, axis=1)
+            t["rx1day"][blok] = np.where(np.isinf(rx1), np.nan, rx1)
+
+            # jumlah 5 hari (hari t-4..t) dari selisih cumsum; jendela yang
+            # bolong tidak dihitung. Jendela dicatat di tahun hari terakhirnya.
+            nol = np.zeros((x.shape[0], 1))
+            cs = np.concatenate([nol, np.cumsum(np.where(valid, x, 0), axis=1, dtype=np.float64)], axis=1)
+            cn = np.concatenate([nol, np.cumsum(valid, axis=1, dtype=np.float64)], axis=1)
+            jumlah5 = np.full(x.shape, -np.inf)
+            jumlah5[:, 4:] = np.where(cn[:, 5:] - cn[:, :-5] == 5, cs[:, 5:] - cs[:, :-5], -np.inf)
+            rx5 = np.maximum.reduceat(jumlah5, awal, axis=1)
+            t["rx5day"][blok] = np.where(np.isinf(rx5), np.nan, rx5)
+
+            # hari kosong memutus deret kering maupun basah
+            t["cdd"][blok] = deret_terpanjang(kering, awal)
+            t["cwd"][blok] = deret_terpanjang(basah, awal)
+
+            # persentil CH hari hujan sepanjang riwayat, per pos
+            ambang = persentil_baris(np.where(basah, x, np.nan), [95, 99])
+            t["r95p"][blok] = per_tahun(np.where(x > ambang[:, :1], x, 0))
+            t["r99p"][blok] = per_tahun(np.where(x > ambang[:, 1:], x, 0))
+
+        lengkap = per_tahun(valid, np.int32) / hari_kalender
+        self.lengkap_tahun[blok] = lengkap
+        for arr in t.values():
+            arr[blok][lengkap < IKLIM_MIN_LENGKAP] = np.nan
+
+    @staticmethod
+    def _hitung_bulanan(x, awal, hari_kalender):
+        valid = np.isfinite(x)
+        total = np.add.reduceat(np.where(valid, x, 0), awal, axis=1, dtype=np.float64)
+        lengkap = np.add.reduceat(valid, awal, axis=1, dtype=np.int32) / hari_kalender
+        total[lengkap < IKLIM_MIN_LENGKAP] = np.nan
+        return total
+
+    def _hitung_anomali(self, ch_bulanan):
+        normal = np.full(ch_bulanan.shape, np.nan, dtype=np.float32)
+        bulan_ke = self.bulan.astype(int) % 12
+        sah = np.isfinite(ch_bulanan)
+        for b in range(12):
+            kolom = bulan_ke == b
+            if not kolom.any():
+                continue
+            n = sah[:, kolom].sum(axis=1)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                rata = np.where(sah[:, kolom], ch_bulanan[:, kolom], 0).sum(axis=1) / n
+            rata[n < IKLIM_MIN_TAHUN_NORMAL] = np.nan
+            normal[:, kolom] = rata[:, None]
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            persen = np.where(normal > 0, (ch_bulanan / normal - 1) * 100, np.nan)
+        return {
+            "ch_bulanan": ch_bulanan,
+            "normal": normal,
+            "anomali": ch_bulanan - normal,
+            "anomali_persen": persen.astype(np.float32),
+        }
+
+    def label_periode(self, jenis):
+        if jenis == "tahunan":
+            return [str(t) for t in self.tahun]
+        return [str(b) for b in self.bulan]
+
+    def nilai(self, indeks, periode=None):
+        """
+        (periode, ids, nilai) semua pos yang punya nilai untuk satu tahun
+        ("YYYY") / bulan ("YYYY-MM"); default periode terakhir.
+        LookupError kalau periode di luar data.
+        """
+        jenis = INDEKS_IKLIM[indeks][0]
+        label = self.label_periode(jenis)
+        if not label:
+            raise LookupError("Belum ada data curah hujan")
+        if periode is None:
+            periode = label[-1]
+        if periode not in label:
+            raise LookupError(f"Periode {periode} di luar data ({label[0]} s/d {label[-1]})")
+
+        arr = (self.tahunan if jenis == "tahunan" else self.bulanan)[indeks]
+        kolom = arr[:, label.index(periode)]
+        ada = np.isfinite(kolom)
+        return periode, self.ids[ada], kolom[ada]
+
+    def per_pos(self, id_poshujan, n_bulan=12):
+        """Indeks tahunan & anomali n_bulan terakhir satu pos (list of dict)."""
+        i = self.baris.get(id_poshujan)
+        if i is None:
+            return {"tahunan": [], "bulanan": []}
+
+        def bulat(v):
+            return None if not np.isfinite(v) else round(float(v), 1)
+
+        tahunan = []
+        for j, tahun in enumerate(self.label_periode("tahunan")):
+            if self.lengkap_tahun[i, j] == 0:
+                continue
+            baris = {"tahun": tahun, "lengkap": round(float(self.lengkap_tahun[i, j]) * 100)}
+            baris.update({nama: bulat(arr[i, j]) for nama, arr in self.tahunan.items()})
+            tahunan.append(baris)
+
+        bulanan = []
+        label = self.label_periode("bulanan")
+        for j in range(max(0, len(label) - n_bulan), len(label)):
+            baris = {"bulan": label[j]}
+            baris.update({nama: bulat(arr[i, j]) for nama, arr in self.bulanan.items()})
+            bulanan.append(baris)
+        return {"tahunan": tahunan, "bulanan": bulanan}
+
+
+_indeks_iklim = {"pid": None, "versi": None, "indeks": None}
+_indeks_iklim_lock = threading.Lock()
+
+
+def indeks_iklim():
+    """Indeks iklim per proses, dihitung ulang kalau versi data berubah."""
+    versi = versi_data()
+    with _indeks_iklim_lock:
+        if (_indeks_iklim["pid"] != os.getpid()
+                or _indeks_iklim["versi"] != versi):
+            cur = get_db().cursor()
+            try:
+                ids, hari0, matriks = muat_matriks_ch(cur)
+            finally:
+                cur.close()
+            _indeks_iklim.update(pid=os.getpid(), versi=versi, indeks=IndeksIklim(ids, hari0, matriks))
+        return _indeks_iklim["indeks"]
+
+
+def indeks_iklim_pos(id_poshujan, harian):
+    """
+    IndeksIklim.per_pos dari seri harian satu pos saja (DataFrame
+    ambil_ch_harian, seluruh riwayat). Anomali = n bulan terakhir yang
+    dicakup seri pos itu.
+    """
+    if harian.empty:
+        return {"tahunan": [], "bulanan": []}
+    hari = harian["tanggal"].to_numpy().astype("datetime64[D]")
+    hari0 = hari.min()
+    kolom = (hari - hari0).astype(np.int64)
+    matriks = np.full((1, int(kolom.max()) + 1), np.nan, dtype=np.float32)
+    matriks[0, kolom] = harian["ch"].to_numpy()
+    return IndeksIklim(np.array([id_poshujan], dtype=np.int64), hari0, matriks).per_pos(id_poshujan)
+
+
+@app.route("/api/indeks_iklim")
+@cache_respons("iklim")
+def api_indeks_iklim():
+    """
+    Satu indeks iklim untuk semua pos (untuk mewarnai peta).
+
+    Parameter:
+    - indeks : nama indeks (lihat INDEKS_IKLIM), default cdd
+    - tahun  : YYYY untuk indeks tahunan (default tahun terakhir)
+    - bulan  : YYYY-MM untuk indeks bulanan (default bulan terakhir)
+    """
+    indeks = (request.args.get("indeks") or "cdd").lower()
+    if indeks not in INDEKS_IKLIM:
+        return jsonify({"status": "error", "message": f"indeks harus salah satu dari: {', '.join(INDEKS_IKLIM)}"}), 400
+    jenis, satuan, keterangan = INDEKS_IKLIM[indeks]
+
+    try:
+        if jenis == "tahunan":
+            tahun = parse_int_param("tahun", 1900, 9999)
+            periode = str(tahun) if tahun is not None else None
+        else:
+            bulan = (request.args.get("bulan") or "").strip()
+            try:
+                periode = datetime.strptime(bulan, "%Y-%m").strftime("%Y-%m") if bulan else None
+            except ValueError:
+                raise ValueError("Parameter bulan harus berformat YYYY-MM") from None
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    try:
+        periode, ids, nilai = indeks_iklim().nilai(indeks, periode)
+    except LookupError as e:
+        return jsonify({"status": "error", "message": str(e)}), 404
+
+    # batas kelas (kuintil) untuk legenda / warna marker
+    kelas = np.round(np.quantile(nilai, [0.2, 0.4, 0.6, 0.8]), 1).tolist() if len(nilai) else []
+
+    return jsonify({
+        "status": "success",
+        "indeks": indeks,
+        "keterangan": keterangan,
+        "satuan": satuan,
+        "periode": periode,
+        "jumlah": len(ids),
+        "kelas": kelas,
+        "id": ids.tolist(),
+        "nilai": np.round(nilai.astype(np.float64), 1).tolist(),
+    })
+
+
+# ============================================================
+# INTERPOLASI GRID CURAH HUJAN (IDW / KERNEL LAIN)
+# ============================================================
+# Permukaan CH kontinu dari nilai pos untuk satu hari (tanggal=YYYY-MM-DD)
+# atau satu bulan (bulan=YYYY-MM):
+#   /api/grid_ch?tanggal=...&metode=idw&resolusi=0.05&format=json|asc|npz
+#   /tiles/ch/<z>/<x>/<y>.png?tanggal=...   (tile peta 256x256, Web Mercator)
+# Grid dihitung sekali per (periode, metode, resolusi) lalu disimpan di
+# cache respons dengan tag tanggal:<..> / bulan:<..>; upload CH yang
+# menyentuh tanggal itu menghapus grid beserta tile-nya. Tile disimpan di
+# ruang cache "tile" dengan batas sendiri (CACHE_MAX_TILE).
+#
+# Biaya dibatasi (endpoint ini tanpa login): grid lebih dari GRID_SEL_MAKS
+# sel dihitung dengan resolusi yang dikasarkan (kelipatan resolusi yang
+# diminta; resolusi sebenarnya ada di respons). Tiap sel hanya memakai
+# GRID_K_POS pos terdekat dalam GRID_RADIUS_MAKS_KM, dicari lewat
+# IndeksSpasial per blok sel (baris x kolom), dan blok dibelah sampai
+# sel x pos kandidat <= GRID_BLOK_SEL.
+# - GRID_RESOLUSI_DEFAULT : ukuran sel default (derajat)
+# - GRID_RESOLUSI_MIN     : sel terkecil yang boleh diminta (derajat)
+# - GRID_PADDING_DERAJAT  : grid diperluas sejauh ini di luar pos terluar
+# - GRID_RADIUS_MAKS_KM   : sel yang lebih jauh dari ini ke pos terdekat
+#                           dikosongkan (laut / daerah tanpa pos)
+# - GRID_SEL_MAKS         : jumlah sel grid maksimal (nx x ny)
+# - GRID_K_POS            : pos terdekat per sel (0 = semua pos dalam radius)
+GRID_RESOLUSI_DEFAULT = float(os.getenv("GRID_RESOLUSI_DEFAULT", "0.05"))
+GRID_RESOLUSI_MIN = float(os.getenv("GRID_RESOLUSI_MIN", "0.01"))
+GRID_PADDING_DERAJAT = float(os.getenv("GRID_PADDING_DERAJAT", "0.5"))
+GRID_RADIUS_MAKS_KM = float(os.getenv("GRID_RADIUS_MAKS_KM", "100"))
+GRID_SEL_MAKS = int(os.getenv("GRID_SEL_MAKS", "2000000"))
+GRID_K_POS = int(os.getenv("GRID_K_POS", "16"))
+
+# sel grid x pos yang dihitung sekaligus (membatasi memori matriks jarak)
+GRID_BLOK_SEL = 2_000_000
+# sisi blok awal (sel); blok yang terlalu padat dibelah lagi
+GRID_BLOK_SISI = 256
+
+
+def kernel_idw(jarak, pangkat=2.0):
+    """Inverse distance weighting: bobot = 1 / jarak^pangkat."""
+    return 1.0 / np.maximum(jarak, 1e-6) ** pangkat
+
+
+def kernel_gauss(jarak, skala_km=25.0):
+    """Bobot Gaussian: pos dekat dominan, pos jauh turun halus."""
+    return np.exp(-0.5 * (jarak / skala_km) ** 2)
+
+
+# Kernel interpolasi: nama -> fungsi(jarak_km) -> bobot.
+# Tambah metode baru cukup dengan mendaftarkan fungsinya di sini.
+KERNEL_INTERPOLASI = {
+    "idw": kernel_idw,
+    "gauss": kernel_gauss,
+}
+
+# Kelas warna CH (batas bawah mm, RGBA); di bawah kelas pertama transparan
+KELAS_WARNA_CH = {
+    "harian": [
+        (0.5, (199, 233, 192, 170)),
+        (5, (161, 217, 155, 190)),
+        (10, (65, 182, 196, 200)),
+        (20, (34, 94, 168, 210)),
+        (50, (37, 52, 148, 220)),
+        (100, (128, 0, 128, 230)),
+    ],
+    "bulanan": [
+        (20, (199, 233, 192, 170)),
+        (50, (161, 217, 155, 180)),
+        (100, (65, 182, 196, 190)),
+        (200, (34, 94, 168, 200)),
+        (300, (37, 52, 148, 210)),
+        (500, (128, 0, 128, 220)),
+    ],
+}
+
+
+def interpolasi_grid(lat, lng, nilai, bbox, resolusi, kernel,
+                     radius_maks_km=GRID_RADIUS_MAKS_KM, k=GRID_K_POS):
+    """
+    Interpolasi nilai pos ke grid reguler.
+    bbox = (w, s, e, n); baris 0 = lintang paling selatan.
+    Jarak memakai proyeksi equirectangular (cukup akurat untuk skala
+    ratusan km). Grid dihitung per blok sel; pos kandidat satu blok =
+    pos dalam radius_maks_km dari blok itu (IndeksSpasial.bbox), lalu tiap
+    sel memakai k pos terdekat.
+    Return array float32 [ny, nx], NaN di luar jangkauan pos.
+    """
+    w, s, e, n = bbox
+    ny = int(round((n - s) / resolusi))
+    nx = int(round((e - w) / resolusi))
+    lat_sel = s + (np.arange(ny) + 0.5) * resolusi
+    lng_sel = w + (np.arange(nx) + 0.5) * resolusi
+
+    kos = np.cos(np.radians((s + n) / 2))
+    px = lng * kos * KM_PER_DERAJAT
+    py = lat * KM_PER_DERAJAT
+    gx = lng_sel * kos * KM_PER_DERAJAT
+    gy = lat_sel * KM_PER_DERAJAT
+
+    grid = np.full((ny, nx), np.nan, dtype=np.float32)
+    if not len(nilai):
+        return grid
+
+    indeks = IndeksSpasial([{"lat": a, "lng": b} for a, b in zip(lat, lng)])
+    # radius dalam derajat menurut metrik jarak di atas (kos tetap)
+    d_lat = radius_maks_km / KM_PER_DERAJAT
+    d_lng = radius_maks_km / (KM_PER_DERAJAT * kos)
+
+    blok = [(i, min(i + GRID_BLOK_SISI, ny), j, min(j + GRID_BLOK_SISI, nx))
+            for i in range(0, ny, GRID_BLOK_SISI) for j in range(0, nx, GRID_BLOK_SISI)]
+    while blok:
+        i0, i1, j0, j1 = blok.pop()
+        idx = indeks.bbox(lng_sel[j0] - d_lng, lat_sel[i0] - d_lat,
+                          lng_sel[j1 - 1] + d_lng, lat_sel[i1 - 1] + d_lat)
+        if not len(idx):
+            continue
+        n_sel = (i1 - i0) * (j1 - j0)
+        if n_sel * len(idx) > GRID_BLOK_SEL and n_sel > 1:
+            # belah di sisi yang lebih panjang
+            if i1 - i0 >= j1 - j0:
+                tengah = (i0 + i1) // 2
+                blok += [(i0, tengah, j0, j1), (tengah, i1, j0, j1)]
+            else:
+                tengah = (j0 + j1) // 2
+                blok += [(i0, i1, j0, tengah), (i0, i1, tengah, j1)]
+            continue
+
+        # [baris, kolom, pos]
+        jarak = np.hypot(
+            gx[np.newaxis, j0:j1, np.newaxis] - px[idx],
+            gy[i0:i1, np.newaxis, np.newaxis] - py[idx],
+        )
+        v = nilai[idx]
+        if k and len(idx) > k:
+            pilih = np.argpartition(jarak, k - 1, axis=2)[..., :k]
+            jarak = np.take_along_axis(jarak, pilih, axis=2)
+            v = v[pilih]
+        bobot = kernel(jarak)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            hasil = (bobot * v).sum(axis=2) / bobot.sum(axis=2)
+        hasil[jarak.min(axis=2) > radius_maks_km] = np.nan
+        grid[i0:i1, j0:j1] = hasil
+    return grid
+
+
+def bbox_grid(lat, lng, resolusi):
+    """
+    Batas grid (dibulatkan ke kelipatan resolusi supaya sel sejajar) dan
+    resolusi yang dipakai: dikasarkan ke kelipatan resolusi kalau jumlah
+    sel melebihi GRID_SEL_MAKS.
+    """
+    pad = GRID_PADDING_DERAJAT
+    while True:
+        bbox = (
+            np.floor((lng.min() - pad) / resolusi) * resolusi,
+            np.floor((lat.min() - pad) / resolusi) * resolusi,
+            np.ceil((lng.max() + pad) / resolusi) * resolusi,
+            np.ceil((lat.max() + pad) / resolusi) * resolusi,
+        )
+        n_sel = round((bbox[2] - bbox[0]) / resolusi) * round((bbox[3] - bbox[1]) / resolusi)
+        if n_sel <= GRID_SEL_MAKS:
+            return bbox, resolusi
+        resolusi *= int(np.ceil(np.sqrt(n_sel / GRID_SEL_MAKS)))
+
+
+def ambil_nilai_periode(cur, mode, periode):
+    """(lat, lng, ch) semua pos untuk satu tanggal / total satu bulan."""
+    if mode == "bulanan":
+        filter_periode = "c.tanggal >= %s::date AND c.tanggal < (%s::date + INTERVAL '1 month')"
+        params = (f"{periode}-01", f"{periode}-01")
+    else:
+        filter_periode = "c.tanggal = %s::date"
+        params = (periode,)
+
+    cur.execute(f"""
+        SELECT p.lintang_dd, p.bujur_dd, SUM(c.ch_mm)::float8
+        FROM curah_hujan c
+        JOIN pos_hujan p ON p.id_poshujan = c.id_poshujan
+        WHERE {filter_periode}
+          AND c.ch_mm IS NOT NULL
+          AND (c.qc_flag & {QC_SARING}) = 0
+          AND p.lintang_dd IS NOT NULL
+          AND p.bujur_dd IS NOT NULL
+        GROUP BY p.id_poshujan, p.lintang_dd, p.bujur_dd
+    """, params)
+    rows = cur.fetchall()
+    arr = np.array(rows, dtype=np.float64).reshape(-1, 3)
+    return arr[:, 0], arr[:, 1], arr[:, 2]
+
+
+def parse_grid_param():
+    """
+    Baca tanggal=/bulan=, metode=, resolusi= dari query string.
+    Return (mode, periode, metode, resolusi); ValueError kalau tidak valid.
+    """
+    tanggal = parse_tanggal_param("tanggal")
+    bulan = (request.args.get("bulan") or "").strip()
+    if (tanggal is None) == (not bulan):
+        raise ValueError("Isi salah satu: tanggal=YYYY-MM-DD atau bulan=YYYY-MM")
+    if bulan:
+        try:
+            bulan = datetime.strptime(bulan, "%Y-%m").strftime("%Y-%m")
+        except ValueError:
+            raise ValueError("Parameter bulan harus berformat YYYY-MM") from None
+        mode, periode = "bulanan", bulan
+    else:
+        mode, periode = "harian", tanggal.isoformat()
+
+    metode = (request.args.get("metode") or "idw").lower()
+    if metode not in KERNEL_INTERPOLASI:
+        raise ValueError(f"metode harus salah satu dari: {', '.join(KERNEL_INTERPOLASI)}")
+
+    resolusi = request.args.get("resolusi")
+    try:
+        resolusi = float(resolusi) if resolusi else GRID_RESOLUSI_DEFAULT
+    except ValueError:
+        raise ValueError("Parameter resolusi harus angka (derajat)") from None
+    if not (GRID_RESOLUSI_MIN <= resolusi <= 1.0):
+        raise ValueError(f"resolusi harus antara {GRID_RESOLUSI_MIN} dan 1 derajat")
+    return mode, periode, metode, resolusi
+
+
+def ambil_grid(mode, periode, metode, resolusi):
+    """
+    Grid (dict: ch float32 [ny, nx], bbox, resolusi, jumlah_pos) untuk
+    periode ini, dari cache kalau ada, kalau tidak dihitung lalu disimpan.
+    Grid kosong (tidak ada pos bernilai) -> ch berukuran 0.
+    """
+    tag = f"tanggal:{periode}" if mode == "harian" else f"bulan:{periode}"
+    tandai_cache(tag)
+    kunci = f"grid:{mode}:{periode}:{metode}:{resolusi:g}"
+
+    try:
+        versi = versi_data()
+        hit = cache_ambil(kunci, statistik=False) if CACHE_ENABLED else None
+    except sqlite3.Error:
+        versi, hit = None, None
+    if hit is not None:
+        with np.load(io.BytesIO(hit[0])) as f:
+            return {
+                "ch": f["ch"],
+                "bbox": tuple(f["bbox"].tolist()),
+                "resolusi": float(f["resolusi"]),
+                "jumlah_pos": int(f["jumlah_pos"]),
+            }
+
+    cur = get_db().cursor()
+    try:
+        lat, lng, nilai = ambil_nilai_periode(cur, mode, periode)
+    finally:
+        cur.close()
+
+    if len(nilai):
+        bbox, resolusi = bbox_grid(lat, lng, resolusi)
+        ch = interpolasi_grid(lat, lng, nilai, bbox, resolusi, KERNEL_INTERPOLASI[metode])
+    else:
+        bbox = (0.0, 0.0, 0.0, 0.0)
+        ch = np.zeros((0, 0), dtype=np.float32)
+
+    grid = {"ch": ch, "bbox": tuple(round(float(x), 6) for x in bbox),
+            "resolusi": resolusi, "jumlah_pos": len(nilai)}
+
+    if CACHE_ENABLED and versi is not None:
+        buf = io.BytesIO()
+        np.savez(buf, ch=ch, bbox=np.array(grid["bbox"]),
+                 resolusi=resolusi, jumlah_pos=len(nilai))
+        try:
+            cache_simpan(kunci, buf.getvalue(), "application/octet-stream",
+                         None, {tag}, versi)
+        except sqlite3.Error as e:
+            app.logger.warning("Grid tidak bisa disimpan ke cache: %s", e)
+    return grid
+
+
+def png_rgba(rgba):
+    """Encode array uint8 [h, w, 4] ke PNG (tanpa dependensi gambar)."""
+    h, w, _ = rgba.shape
+    mentah = np.concatenate(
+        [np.zeros((h, 1), dtype=np.uint8), rgba.reshape(h, w * 4)], axis=1
+    ).tobytes()
+
+    def chunk(jenis, data):
+        return (struct.pack(">I", len(data)) + jenis + data
+                + struct.pack(">I", zlib.crc32(jenis + data) & 0xFFFFFFFF))
+
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 6, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(mentah, 6))
+            + chunk(b"IEND", b""))
+
+
+def warnai_ch(nilai, mode):
+    """Nilai CH -> RGBA uint8 memakai KELAS_WARNA_CH (NaN / kecil = transparan)."""
+    kelas = KELAS_WARNA_CH[mode]
+    batas = np.array([b for b, _ in kelas])
+    palet = np.array([(0, 0, 0, 0)] + [c for _, c in kelas], dtype=np.uint8)
+    idx = np.digitize(np.nan_to_num(nilai, nan=-1.0), batas)
+    return palet[idx]
+
+
+@app.route("/api/grid_ch")
+@cache_respons()
+def api_grid_ch():
+    """
+    Unduh grid interpolasi:
+    - format=json (default): metadata + statistik grid
+    - format=asc : ESRI ASCII Grid (bisa dibuka QGIS/ArcGIS), NODATA -9999
+    - format=npz : numpy (ch [ny, nx] float32, bbox, resolusi)
+    """
+    try:
+        mode, periode, metode, resolusi = parse_grid_param()
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    fmt = (request.args.get("format") or "json").lower()
+    if fmt not in ("json", "asc", "npz"):
+        return jsonify({"status": "error", "message": "format harus json, asc atau npz"}), 400
+
+    grid = ambil_grid(mode, periode, metode, resolusi)
+    # bisa lebih kasar dari yang diminta (GRID_SEL_MAKS)
+    resolusi = grid["resolusi"]
+    ch = grid["ch"]
+    w, s, e, n = grid["bbox"]
+    if fmt != "json" and ch.size == 0:
+        return jsonify({"status": "error", "message": "Tidak ada data pos untuk periode ini"}), 404
+
+    nama_file = f"ch_{mode}_{periode}_{metode}_{resolusi:g}"
+    if fmt == "asc":
+        buf = io.StringIO()
+        buf.write(f"ncols {ch.shape[1]}\nnrows {ch.shape[0]}\n"
+                  f"xllcorner {w}\nyllcorner {s}\ncellsize {resolusi}\n"
+                  "NODATA_value -9999\n")
+        # ASCII grid ditulis dari baris paling utara
+        np.savetxt(buf, np.nan_to_num(ch[::-1], nan=-9999), fmt="%.2f")
+        resp = app.response_class(buf.getvalue(), mimetype="text/plain")
+        resp.headers["Content-Disposition"] = f"attachment; filename={nama_file}.asc"
+        return resp
+    if fmt == "npz":
+        buf = io.BytesIO()
+        np.savez_compressed(buf, ch=ch, bbox=np.array(grid["bbox"]), resolusi=resolusi)
+        resp = app.response_class(buf.getvalue(), mimetype="application/octet-stream")
+        resp.headers["Content-Disposition"] = f"attachment; filename={nama_file}.npz"
+        return resp
+
+    ada = ~np.isnan(ch)
+    return jsonify({
+        "status": "success",
+        "mode": mode,
+        "periode": periode,
+        "metode": metode,
+        "resolusi": resolusi,
+        "bbox": [w, s, e, n],
+        "ukuran": list(ch.shape),
+        "jumlah_pos": grid["jumlah_pos"],
+        "ch_min": float(ch[ada].min()) if ada.any() else None,
+        "ch_maks": float(ch[ada].max()) if ada.any() else None,
+        "ch_rata": float(ch[ada].mean()) if ada.any() else None,
+    })
+
+
+@app.route("/tiles/ch/<int:z>/<int:x>/<int:y>.png")
+@cache_respons(ruang="tile")
+def tile_grid_ch(z, x, y):
+    """Tile PNG 256x256 (skema XYZ, sama dengan OpenStreetMap) dari grid interpolasi."""
+    try:
+        mode, periode, metode, resolusi = parse_grid_param()
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    if not (0 <= z <= 22 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        abort(404)
+
+    grid = ambil_grid(mode, periode, metode, resolusi)
+    # bisa lebih kasar dari yang diminta (GRID_SEL_MAKS)
+    resolusi = grid["resolusi"]
+    ch = grid["ch"]
+    w, s, e, n = grid["bbox"]
+
+    # pusat tiap piksel tile -> lintang/bujur
+    ukuran = 256 * 2 ** z
+    piksel = np.arange(256) + 0.5
+    lng_px = (x * 256 + piksel) / ukuran * 360 - 180
+    lat_px = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y * 256 + piksel) / ukuran))))
+
+    nilai = np.full((256, 256), np.nan, dtype=np.float32)
+    if ch.size:
+        kolom = np.floor((lng_px - w) / resolusi).astype(np.int64)
+        baris = np.floor((lat_px - s) / resolusi).astype(np.int64)
+        ok_k = (kolom >= 0) & (kolom < ch.shape[1])
+        ok_b = (baris >= 0) & (baris < ch.shape[0])
+        if ok_k.any() and ok_b.any():
+            nilai[np.ix_(ok_b, ok_k)] = ch[np.ix_(baris[ok_b], kolom[ok_k])]
+
+    return app.response_class(png_rgba(warnai_ch(nilai, mode)), mimetype="image/png")
+
+
+# ============================================================
+# FORMAT BINER SERI CH (?format=bin / ?format=arrow)
+# ============================================================
+# Untuk klien yang mau datanya langsung jadi array (grafik, numpy, dll),
+# /api/curah_hujan dan /api/curah_hujan/batch bisa mengirim seri sebagai
+# buffer float32 + validity mask, bukan list {"tanggal", "ch"}.
+# Dipilih lewat ?format=bin|arrow atau header Accept; tanpa keduanya
+# respons tetap JSON seperti biasa.
+#
+# Layout format "bin" (semua little-endian):
+#   4 byte   magic b"CHB1"
+#   uint32   panjang header JSON (byte)
+#   header   JSON utf-8: mode, start, step ("1D"/"1M"), count, seri,
+#            offset (bool) + metadata endpoint (id_poshujan, nama_pos, ...)
+#   padding  nol sampai kelipatan 8 byte
+#   float32  nilai [seri x count], baris per pos, NaN untuk sel kosong
+#   int32    offset [count] dari start dalam satuan step
+#            (hanya kalau offset=true, mis. hasil max_points)
+#   bitmask  validity [seri x ceil(count/8)], bit ke-i (LSB dulu) = 1 kalau
+#            nilai ke-i ada; urutan bit sama dengan Arrow
+#
+# Format "arrow" (butuh modul pyarrow): Arrow IPC stream, kolom "tanggal"
+# (date32) + satu kolom float32 per pos (nama kolom = id_poshujan),
+# header JSON yang sama ditaruh di metadata schema ("poshujan").
+FORMAT_SERI_MIMETYPES = {
+    "bin": "application/octet-stream",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.csv
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+def format_dari_accept():
+    """Format biner dari header Accept (None = JSON/biasa)."""
+    terima = request.accept_mimetypes
+    for fmt, mimetype in FORMAT_SERI_MIMETYPES.items():
+        # "*/*" dari browser tidak dihitung, harus disebut eksplisit
+        if mimetype in terima.values() and terima[mimetype] >= terima["application/json"]:
+            return fmt
+    return None
+
+
+def format_seri():
+    """
+    Format respons seri: ?format= menang, lalu header Accept, default json.
+    ValueError kalau format tidak dikenal, LookupError kalau modulnya
+    tidak terpasang.
+    """
+    fmt = (request.args.get("format") or format_dari_accept() or "json").lower()
+    if fmt != "json" and fmt not in FORMAT_SERI_MIMETYPES:
+        raise ValueError("Parameter format harus json, bin atau arrow")
+    if fmt == "arrow" and pyarrow is None:
+        raise LookupError("Format arrow butuh modul pyarrow di server")
+    return fmt
+
+
+def respons_seri(fmt, mode, periode, nilai, meta, pakai_offset=False):
+    """
+    Bungkus seri ke format bin/arrow.
+
+    periode : datetime64[D] urut naik, satu per kolom nilai
+    nilai   : array [seri x len(periode)], NaN = tidak ada data
+    meta    : dict tambahan untuk header
+    Kalau pakai_offset=False, seri diratakan ke grid reguler start + i*step
+    (celah diisi NaN); kalau True, tanggal tiap titik dikirim sebagai offset.
+    """
+    satuan = "M" if mode == "bulanan" else "D"
+    p = periode.astype(f"datetime64[{satuan}]")
+    nilai = np.asarray(nilai, dtype=np.float64).reshape(-1, len(p))
+
+    if len(p):
+        offset = (p - p[0]).astype(np.int64)
+        start = str(p[0])
+    else:
+        offset = np.zeros(0, dtype=np.int64)
+        start = None
+
+    if pakai_offset:
+        grid = nilai
+    else:
+        count = int(offset[-1]) + 1 if len(p) else 0
+        grid = np.full((nilai.shape[0], count), np.nan)
+        grid[:, offset] = nilai
+
+    header = {
+        "versi": 1,
+        "mode": mode,
+        "start": start,
+        "step": f"1{satuan}",
+        "count": grid.shape[1],
+        "seri": grid.shape[0],
+        "offset": bool(pakai_offset),
+        **meta,
+    }
+    valid = ~np.isnan(grid)
+
+    if fmt == "arrow":
+        body = seri_ke_arrow(header, p, grid, valid, pakai_offset)
+    else:
+        header_json = json.dumps(header).encode("utf-8")
+        bagian = [b"CHB1", np.uint32(len(header_json)).astype("<u4").tobytes(), header_json]
+        bagian.append(b"\0" * (-(8 + len(header_json)) % 8))
+        bagian.append(grid.astype("<f4").tobytes())
+        if pakai_offset:
+            bagian.append(offset.astype("<i4").tobytes())
+        bagian.append(np.packbits(valid, axis=1, bitorder="little").tobytes())
+        body = b"".join(bagian)
+
+    return app.response_class(body, mimetype=FORMAT_SERI_MIMETYPES[fmt])
+
+
+def seri_ke_arrow(header, p, grid, valid, pakai_offset):
+    if pakai_offset or not len(p):
+        tanggal = p
+    else:
+        tanggal = p[0] + np.arange(grid.shape[1])
+    kolom = {"tanggal": pyarrow.array(tanggal.astype("datetime64[D]"), type=pyarrow.date32())}
+    for id_pos, baris, ada in zip(header.get("id_poshujan", []), grid, valid):
+        kolom[str(id_pos)] = pyarrow.array(baris.astype(np.float32), mask=~ada)
+
+    tabel = pyarrow.table(kolom).replace_schema_metadata({"poshujan": json.dumps(header)})
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, tabel.schema) as writer:
+        writer.write_table(tabel)
+    return sink.getvalue().to_pybytes()
+
+
+# ============================================================
+# EKSPOR CURAH HUJAN (STREAMING CSV / PARQUET)
+# ============================================================
+# /api/export?id=1,2&kode=...&start=YYYY-MM-DD&end=YYYY-MM-DD&format=csv|parquet
+# Tanpa id/kode = semua pos. Data dibaca lewat named cursor (server-side)
+# per EKSPOR_BATCH_BARIS baris dan langsung dikirim ke klien, jadi memori
+# tetap datar dan byte pertama keluar tanpa menunggu seluruh query.
+# Urutan (id_poshujan, tanggal) mengikuti primary key: tidak perlu sort.
+# CSV memakai layout file ekspor BMKG yang juga diterima upload:
+#   NAME,DATA TIMESTAMP,RAINFALL DAY MM
+#   Bakung,2025-01-01 00:00:00.0 +0:00,59
+# Parquet (butuh pyarrow): kolom yang sama, satu row group per batch.
+EKSPOR_BATCH_BARIS = int(os.getenv("EKSPOR_BATCH_BARIS", "50000"))
+KOLOM_EKSPOR_BMKG = ["NAME", "DATA TIMESTAMP", "RAINFALL DAY MM"]
+FORMAT_EKSPOR_MIMETYPES = {
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+class PenampungAliran(io.RawIOBase):
+    """File tulis yang isinya diambil sepotong-sepotong untuk di-stream."""
+
+    def __init__(self):
+        super().__init__()
+        self._potongan = []
+        self._posisi = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._potongan.append(bytes(data))
+        self._posisi += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._posisi
+
+    def ambil(self):
+        data = b"".join(self._potongan)
+        self._potongan = []
+        return data
+
+
+def aliran_csv_bmkg(batch):
+    buf = io.StringIO()
+    tulis = csv.writer(buf, lineterminator="\n")
+    # header dikirim sebelum query jalan, jadi klien langsung dapat byte pertama
+    tulis.writerow(KOLOM_EKSPOR_BMKG)
+    yield buf.getvalue().encode("utf-8")
+    for rows in batch:
+        buf.seek(0)
+        buf.truncate()
+        tulis.writerows(rows)
+        yield buf.getvalue().encode("utf-8")
+
+
+def aliran_parquet(batch):
+    skema = pyarrow.schema([
+        (KOLOM_EKSPOR_BMKG[0], pyarrow.string()),
+        (KOLOM_EKSPOR_BMKG[1], pyarrow.timestamp("ms", tz="UTC")),
+        (KOLOM_EKSPOR_BMKG[2], pyarrow.float64()),
+    ])
+    sink = PenampungAliran()
+    with pyarrow.parquet.ParquetWriter(sink, skema, compression="zstd") as penulis:
+        yield sink.ambil()  # magic "PAR1", sebelum query jalan
+        for rows in batch:
+            nama, hari, ch = zip(*rows)
+            penulis.write_table(pyarrow.table([
+                pyarrow.array(nama, type=pyarrow.string()),
+                pyarrow.array(np.array(hari, dtype="datetime64[D]").astype("datetime64[ms]"), type=skema.field(1).type),
+                pyarrow.array(ch, type=pyarrow.float64()),
+            ], schema=skema))
+            yield sink.ambil()
+    yield sink.ambil()
+
+
+@app.route("/api/export")
+def api_export():
+    """
+    Ekspor CH banyak pos sekaligus sebagai file (di-stream).
+
+    Parameter:
+    - id / kode  : daftar id_poshujan / kode_pos (dipisah koma), kosong = semua pos
+    - start, end : YYYY-MM-DD (inklusif)
+    - format     : csv (default, layout BMKG) / parquet
+    """
+    fmt = (request.args.get("format") or "csv").lower()
+    if fmt not in FORMAT_EKSPOR_MIMETYPES:
+        return jsonify({"status": "error", "message": f"format harus salah satu dari: {', '.join(FORMAT_EKSPOR_MIMETYPES)}"}), 400
+    if fmt == "parquet" and pyarrow is None:
+        return jsonify({"status": "error", "message": "Format parquet butuh modul pyarrow di server"}), 406
+
+    try:
+        start = parse_tanggal_param("start")
+        end = parse_tanggal_param("end")
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    try:
+        ids = [int(v) for v in daftar_param("id")]
+    except ValueError:
+        return jsonify({"status": "error", "message": "Parameter id harus bilangan bulat"}), 400
+    kode = daftar_param("kode")
+
+    if ids or kode:
+        registry = registry_pos()
+        baris = {registry.cari_id(i) for i in ids} | {registry.cari_kode(k) for k in kode}
+        ids = sorted(int(registry.id[b]) for b in baris if b is not None)
+        if not ids:
+            return jsonify({"status": "error", "message": "Pos hujan tidak ditemukan"}), 404
+
+    if fmt == "csv":
+        # tanggal & angka diformat di Postgres, Python tinggal menulis baris
+        kolom = "to_char(c.tanggal, 'YYYY-MM-DD') || ' 00:00:00.0 +0:00', c.ch_mm::text"
+    else:
+        # tanggal sebagai jumlah hari sejak 1970 (lebih murah dari objek date)
+        kolom = "c.tanggal - DATE '1970-01-01', c.ch_mm::float8"
+
+    sql = f"""
+        SELECT p.nama_pos, {kolom}
+        FROM curah_hujan c
+        JOIN pos_hujan p ON p.id_poshujan = c.id_poshujan
+        WHERE c.ch_mm IS NOT NULL
+          AND (%s::date IS NULL OR c.tanggal >= %s::date)
+          AND (%s::date IS NULL OR c.tanggal <= %s::date)
+          AND (cardinality(%s::bigint[]) = 0 OR c.id_poshujan = ANY(%s::bigint[]))
+        ORDER BY c.id_poshujan, c.tanggal
+    """
+    params = (start, start, end, end, ids, ids)
+
+    def batch():
+        # named cursor: baris tetap di server, diambil per batch.
+        # Transaksinya dibatalkan saat koneksi kembali ke pool.
+        cur = get_db().cursor(name=f"ekspor_{uuid.uuid4().hex}")
+        try:
+            cur.execute(sql, params)
+            while True:
+                rows = cur.fetchmany(EKSPOR_BATCH_BARIS)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cur.close()
+
+    aliran = aliran_csv_bmkg(batch()) if fmt == "csv" else aliran_parquet(batch())
+    nama_file = f"curah_hujan_{start or 'awal'}_{end or 'akhir'}.{fmt}"
+
+    resp = app.response_class(stream_with_context(aliran), mimetype=FORMAT_EKSPOR_MIMETYPES[fmt])
+    resp.headers["Content-Disposition"] = f'attachment; filename="{nama_file}"'
+    resp.headers["Cache-Control"] = "no-store"
+    # proxy (nginx) jangan menahan respons sampai selesai
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+
+# ============================================================
+# UPLOAD METADATA POS HUJAN (EXCEL / CSV)
+# ============================================================
+KOLOM_METADATA = [
+    "Pos Hujan", "ID", "Balai", "Provinsi",
+    "Kabupaten", "Kecamatan", "Lintang", "Bujur", "Elevasi"
+]
+
+
+def proses_upload_metadata(conn, df):
+    """
+    Simpan metadata pos dari DataFrame secara set-based:
+    provinsi & kabupaten diselesaikan sekaligus (nama unik di-insert sekali,
+    id diambil sekali), lalu semua pos di-upsert dalam satu statement.
+    ValueError kalau kolom wajib tidak ada.
+    """
+    for col in KOLOM_METADATA:
+        if col not in df.columns:
+            raise ValueError(f"Kolom wajib '{col}' tidak ditemukan di file!")
+
+    mulai = time.perf_counter()
+    waktu = {}
+    t0 = time.perf_counter()
+
+    df = df.fillna("")
+    teks = {col: df[col].astype(str).str.strip() for col in KOLOM_METADATA}
+
+    nama_prov = teks["Provinsi"]
+    nama_kab  = teks["Kabupaten"]
+    lintang   = pd.to_numeric(teks["Lintang"], errors="coerce")
+    bujur     = pd.to_numeric(teks["Bujur"], errors="coerce")
+    elevasi   = pd.to_numeric(teks["Elevasi"], errors="coerce")
+
+    valid = lintang.notna() & bujur.notna()
+    pos_dilewati = teks["Pos Hujan"][~valid].tolist()
+    tambah_waktu(waktu, "validasi", t0)
+
+    cur = conn.cursor()
+
+    try:
+        # PROVINSI: nama unik di-insert sekali, id diambil sekali
+        t0 = time.perf_counter()
+        prov_unik = sorted(set(nama_prov[nama_prov != ""]))
+        cur.execute("""
+            INSERT INTO provinsi (nama_provinsi)
+            SELECT unnest(%s::text[])
+            ON CONFLICT (nama_provinsi) DO NOTHING;
+        """, (prov_unik,))
+        cur.execute("""
+            SELECT nama_provinsi, id_provinsi
+            FROM provinsi
+            WHERE nama_provinsi = ANY(%s::text[])
+        """, (prov_unik,))
+        id_provinsi = dict(cur.fetchall())
+        tambah_waktu(waktu, "provinsi", t0)
+
+        # KABUPATEN: pasangan (id_provinsi, nama_kabupaten) yang unik
+        t0 = time.perf_counter()
+        id_prov = nama_prov.map(id_provinsi)
+        ada_kab = (nama_kab != "") & id_prov.notna()
+        pasangan = sorted(set(zip(id_prov[ada_kab].astype(int), nama_kab[ada_kab])))
+        kab_prov = [int(p) for p, _ in pasangan]
+        kab_nama = [k for _, k in pasangan]
+
+        cur.execute("""
+            INSERT INTO kabupaten (id_provinsi, nama_kabupaten)
+            SELECT * FROM unnest(%s::int[], %s::text[])
+            ON CONFLICT (id_provinsi, nama_kabupaten) DO NOTHING;
+        """, (kab_prov, kab_nama))
+        cur.execute("""
+            SELECT k.id_provinsi, k.nama_kabupaten, k.id_kabupaten
+            FROM kabupaten k
+            JOIN unnest(%s::int[], %s::text[]) AS u(id_provinsi, nama_kabupaten)
+              ON k.id_provinsi    = u.id_provinsi
+             AND k.nama_kabupaten = u.nama_kabupaten
+        """, (kab_prov, kab_nama))
+        id_kabupaten = {(p, k): i for p, k, i in cur.fetchall()}
+        tambah_waktu(waktu, "kabupaten", t0)
+
+        # POS HUJAN: satu upsert untuk semua baris valid (geom ikut)
+        t0 = time.perf_counter()
+        pos = pd.DataFrame({
+            "kode_pos": teks["ID"],
+            "nama_pos": teks["Pos Hujan"],
+            "balai":    teks["Balai"].replace("", None),
+            "kec":      teks["Kecamatan"].replace("", None),
+            "id_prov":  id_prov,
+            "id_kab":   [
+                id_kabupaten.get((int(p), k)) if ok else None
+                for p, k, ok in zip(id_prov.fillna(0), nama_kab, ada_kab)
+            ],
+            "lintang":  lintang,
+            "bujur":    bujur,
+            "elev":     elevasi.apply(lambda e: None if pd.isna(e) else int(e)),
+        })[valid]
+        # kode_pos kembar di file: baris terakhir yang dipakai
+        pos = pos.drop_duplicates("kode_pos", keep="last")
+
+        cur.execute("""
+            SELECT kode_pos, id_kabupaten, id_provinsi
+            FROM pos_hujan
+            WHERE kode_pos = ANY(%s::text[])
+        """, (pos["kode_pos"].tolist(),))
+        wilayah_lama = cur.fetchall()
+
+        def kolom(nama, jenis=None):
+            nilai = pos[nama].astype(object).where(pos[nama].notna(), None)
+            if jenis is not None:
+                return [None if v is None else jenis(v) for v in nilai]
+            return nilai.tolist()
+
+        cur.execute("""
+            WITH upsert AS (
+                INSERT INTO pos_hujan (
+                    kode_pos, nama_pos, balai, kecamatan,
+                    id_provinsi, id_kabupaten,
+                    lintang_dd, bujur_dd, elevasi_m, geom
+                )
+                SELECT
+                    kode_pos, nama_pos, balai, kecamatan,
+                    id_provinsi, id_kabupaten,
+                    lintang_dd, bujur_dd, elevasi_m,
+                    ST_SetSRID(ST_MakePoint(bujur_dd, lintang_dd), 4326)
+                FROM unnest(
+                    %s::text[], %s::text[], %s::text[], %s::text[],
+                    %s::int[], %s::int[],
+                    %s::float8[], %s::float8[], %s::int[]
+                ) AS u(
+                    kode_pos, nama_pos, balai, kecamatan,
+                    id_provinsi, id_kabupaten,
+                    lintang_dd, bujur_dd, elevasi_m
+                )
+                ON CONFLICT (kode_pos)
+                DO UPDATE SET
+                    nama_pos    = EXCLUDED.nama_pos,
+                    balai       = EXCLUDED.balai,
+                    kecamatan   = EXCLUDED.kecamatan,
+                    id_provinsi = EXCLUDED.id_provinsi,
+                    id_kabupaten= EXCLUDED.id_kabupaten,
+                    lintang_dd  = EXCLUDED.lintang_dd,
+                    bujur_dd    = EXCLUDED.bujur_dd,
+                    elevasi_m   = EXCLUDED.elevasi_m,
+                    geom        = EXCLUDED.geom
+                RETURNING (xmax = 0) AS baru
+            )
+            SELECT COUNT(*) FILTER (WHERE baru), COUNT(*)
+            FROM upsert;
+        """, (
+            kolom("kode_pos"), kolom("nama_pos"), kolom("balai"), kolom("kec"),
+            kolom("id_prov", int), kolom("id_kab", int),
+            kolom("lintang", float), kolom("bujur", float), kolom("elev", int),
+        ))
+        pos_baru, pos_total = cur.fetchone()
+        tambah_waktu(waktu, "pos", t0)
+
+        # pos yang pindah kabupaten/provinsi -> rekap wilayah harus dihitung ulang
+        t0 = time.perf_counter()
+        pindah = pos_total > pos_baru and wilayah_pos_berubah(cur, wilayah_lama)
+        if pindah:
+            rebuild_rekap(cur)
+        tambah_waktu(waktu, "rekap", t0)
+
+        t0 = time.perf_counter()
+        conn.commit()
+        tambah_waktu(waktu, "commit", t0)
+
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+    # nama, lokasi & kabupaten bisa berubah di semua respons
+    naikkan_versi_pos()
+    hapus_cache()
+    catat_waktu_ingest("metadata", waktu, pos_total, time.perf_counter() - mulai)
+
+    hasil = {
+        "message": "Metadata pos hujan berhasil disimpan ke database.",
+        "jumlah": {
+            "baris": len(df),
+            "pos_baru": pos_baru,
+            "pos_diperbarui": pos_total - pos_baru,
+            "dilewati": len(pos_dilewati),
+            "provinsi": len(id_provinsi),
+            "kabupaten": len(id_kabupaten),
+        },
+        "waktu_ms": ringkas_waktu(waktu),
+    }
+    if pos_dilewati:
+        # Baris dengan Lintang/Bujur tidak valid tidak disimpan
+        hasil["pos_dilewati"] = pos_dilewati
+    return hasil
+
+
+def wilayah_pos_berubah(cur, wilayah_lama):
+    """True kalau ada pos (kode_pos, id_kabupaten, id_provinsi) yang sekarang berbeda."""
+    if not wilayah_lama:
+        return False
+    kode, kab, prov = (list(x) for x in zip(*wilayah_lama))
+    cur.execute("""
+        SELECT EXISTS (
+            SELECT 1
+            FROM unnest(%s::text[], %s::int[], %s::int[]) AS l(kode_pos, id_kabupaten, id_provinsi)
+            JOIN pos_hujan p ON p.kode_pos = l.kode_pos
+            WHERE p.id_kabupaten IS DISTINCT FROM l.id_kabupaten
+               OR p.id_provinsi  IS DISTINCT FROM l.id_provinsi
+        )
+    """, (kode, kab, prov))
+    return cur.fetchone()[0]
+
+
+def baca_file_metadata(file, filename):
+    if filename.endswith(".csv"):
+        return pd.read_csv(file)
+    return pd.read_excel(file)
+
+
+@app.route("/upload_metadata", methods=["POST"])
+def upload_metadata():
+    ensure_logged_in_api()
+
+    if "file" not in request.files:
+        return jsonify({"status": "error", "message": "File tidak ditemukan di request!"})
+
+    file = request.files["file"]
+    if file.filename == "":
+        return jsonify({"status": "error", "message": "Tidak ada file yang dipilih!"})
+
+    if INGEST_JOB_WORKERS > 0:
+        return kirim_job("metadata", file)
+
+    filename = file.filename.lower()
+
+    try:
+        df = baca_file_metadata(file, filename)
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Gagal membaca file (Excel/CSV): {e}"})
+
+    try:
+        hasil = proses_upload_metadata(get_db(), df)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)})
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Error saat simpan metadata: {e}"})
+
+    return jsonify({"status": "success", **hasil})
+
+
+# ============================================================
+# DATA TERKINI PER POS (pos_hujan_terkini)
+# ============================================================
+# Satu baris per pos: tanggal terakhir yang punya nilai + ch-nya.
+# Tabel ini diperbarui di transaksi yang sama dengan upload curah hujan,
+# jadi /api/pos_hujan tidak perlu scan seluruh curah_hujan.
+# Untuk backfill / pertama kali: flask --app app rebuild-terkini
+DDL_POS_HUJAN_TERKINI = """
+    CREATE TABLE IF NOT EXISTS pos_hujan_terkini (
+        id_poshujan integer PRIMARY KEY
+                    REFERENCES pos_hujan (id_poshujan) ON DELETE CASCADE,
+        tanggal     date    NOT NULL,
+        ch_mm       numeric,
+        diperbarui  timestamptz NOT NULL DEFAULT NOW()
+    );
+"""
+
+
+def perbarui_terkini(cur, frame):
+    """Majukan pos_hujan_terkini dengan baris terakhir per pos dari frame."""
+    if frame.empty:
+        return 0
+    cur.execute(DDL_POS_HUJAN_TERKINI)
+
+    # tanggal sama muncul dua kali -> baris terakhir di file yang menang
+    terakhir = (
+        frame.sort_values("tanggal", kind="stable")
+             .drop_duplicates("id_poshujan", keep="last")
+    )
+    cur.execute("""
+        INSERT INTO pos_hujan_terkini (id_poshujan, tanggal, ch_mm)
+        SELECT * FROM unnest(%s::int[], %s::date[], %s::float8[])
+        ON CONFLICT (id_poshujan)
+        DO UPDATE SET
+            tanggal    = EXCLUDED.tanggal,
+            ch_mm      = EXCLUDED.ch_mm,
+            diperbarui = NOW()
+        WHERE EXCLUDED.tanggal >= pos_hujan_terkini.tanggal;
+    """, (
+        terakhir["id_poshujan"].tolist(),
+        terakhir["tanggal"].dt.date.tolist(),
+        terakhir["ch_mm"].tolist(),
+    ))
+    # jumlah pos yang data terkininya benar-benar maju
+    return cur.rowcount
+
+
+def rebuild_terkini(cur):
+    cur.execute(DDL_POS_HUJAN_TERKINI)
+    cur.execute("DELETE FROM pos_hujan_terkini;")
+    cur.execute("""
+        INSERT INTO pos_hujan_terkini (id_poshujan, tanggal, ch_mm)
+        SELECT DISTINCT ON (id_poshujan)
+               id_poshujan, tanggal, ch_mm
+        FROM curah_hujan
+        WHERE ch_mm IS NOT NULL
+        ORDER BY id_poshujan, tanggal DESC;
+    """)
+    return cur.rowcount
+
+
+@app.cli.command("rebuild-terkini")
+def rebuild_terkini_command():
+    """Buat ulang pos_hujan_terkini dari seluruh curah_hujan (backfill)."""
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        t0 = time.perf_counter()
+        n = rebuild_terkini(cur)
+        conn.commit()
+    finally:
+        cur.close()
+    hapus_cache(["pos_hujan"])
+    click.echo(f"pos_hujan_terkini: {n} pos diisi ulang ({time.perf_counter() - t0:.2f} detik)")
+
+
+# ============================================================
+# REKAP CH PER POS / KABUPATEN / PROVINSI (ROLLUP)
+# ============================================================
+# rekap_ch menyimpan agregat siap pakai untuk laporan wilayah:
+#   tingkat : pos / kabupaten / provinsi
+#   periode : harian / dasarian (tgl 1-10, 11-20, 21-akhir) / bulanan
+# Nilai per baris:
+#   total_ch : pos -> jumlah CH periode itu; wilayah -> rata-rata total antar pos
+#   rata_ch  : rata-rata CH harian;  maks_ch : CH harian tertinggi
+# Rekap pos-harian tidak disimpan (isinya sama dengan curah_hujan).
+# CH yang ber-flag QC (QC_SARING) tidak ikut dijumlah.
+#
+# Upload CH hanya menghitung ulang sel (pos, bulan) yang tersentuh, lalu
+# sel (kabupaten/provinsi, bulan) tempat pos itu berada.
+# Untuk backfill / setelah pos pindah wilayah: flask --app app rebuild-rekap
+DDL_REKAP_CH = """
+    CREATE TABLE IF NOT EXISTS rekap_ch (
+        tingkat     text    NOT NULL,
+        periode     text    NOT NULL,
+        id_wilayah  integer NOT NULL,
+        awal        date    NOT NULL,
+        jumlah_pos  integer NOT NULL,
+        jumlah_data integer NOT NULL,
+        total_ch    double precision,
+        rata_ch     double precision,
+        maks_ch     double precision,
+        diperbarui  timestamptz NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (tingkat, periode, id_wilayah, awal)
+    );
+"""
+TINGKAT_REKAP = ("pos", "kabupaten", "provinsi")
+# batas baris per respons /api/rekap
+REKAP_MAX_BARIS = int(os.getenv("REKAP_MAX_BARIS", "50000"))
+PERIODE_REKAP = ("harian", "dasarian", "bulanan")
+
+# tabel & kolom nama untuk tiap tingkat
+WILAYAH_REKAP = {
+    "pos":       ("pos_hujan", "id_poshujan", "nama_pos"),
+    "kabupaten": ("kabupaten", "id_kabupaten", "nama_kabupaten"),
+    "provinsi":  ("provinsi", "id_provinsi", "nama_provinsi"),
+}
+
+SQL_AWAL_DASARIAN = """(
+    date_trunc('month', c.tanggal)::date
+    + LEAST((EXTRACT(DAY FROM c.tanggal)::int - 1) / 10, 2) * 10
+)"""
+
+
+def isi_rekap(cur):
+    """
+    Hitung ulang rekap untuk pasangan (id_poshujan, bulan) di temp table
+    rekap_target, termasuk kabupaten/provinsi tempat pos-pos itu berada.
+    Return jumlah baris rekap yang ditulis.
+    """
+    # wilayah yang ikut tersentuh (dihitung dari SEMUA pos di wilayah itu)
+    cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS rekap_target_wilayah (
+            tingkat text, id_wilayah integer, bulan date
+        ) ON COMMIT DROP;
+        TRUNCATE rekap_target_wilayah;
+
+        INSERT INTO rekap_target_wilayah
+        SELECT DISTINCT w.tingkat, w.id_wilayah, t.bulan
+        FROM rekap_target t
+        JOIN pos_hujan p ON p.id_poshujan = t.id_poshujan
+        CROSS JOIN LATERAL (
+            VALUES ('kabupaten', p.id_kabupaten), ('provinsi', p.id_provinsi)
+        ) AS w(tingkat, id_wilayah)
+        WHERE w.id_wilayah IS NOT NULL;
+
+        -- temp table tidak pernah di-ANALYZE otomatis; tanpa statistik
+        -- planner mengira isinya 1 baris dan memilih nested loop
+        ANALYZE rekap_target;
+        ANALYZE rekap_target_wilayah;
+    """)
+
+    # 1) POS: dasarian & bulanan dari curah_hujan
+    cur.execute("""
+        DELETE FROM rekap_ch r
+        USING rekap_target t
+        WHERE r.tingkat = 'pos'
+          AND r.id_wilayah = t.id_poshujan
+          AND r.awal >= t.bulan
+          AND r.awal < t.bulan + INTERVAL '1 month';
+    """)
+    cur.execute(f"""
+        INSERT INTO rekap_ch (tingkat, periode, id_wilayah, awal,
+                              jumlah_pos, jumlah_data, total_ch, rata_ch, maks_ch)
+        SELECT 'pos', per.periode, c.id_poshujan, per.awal,
+               1, COUNT(*), SUM(c.ch_mm)::float8, AVG(c.ch_mm)::float8, MAX(c.ch_mm)::float8
+        FROM curah_hujan c
+        JOIN rekap_target t
+          ON t.id_poshujan = c.id_poshujan
+         AND c.tanggal >= t.bulan
+         AND c.tanggal < t.bulan + INTERVAL '1 month'
+        CROSS JOIN LATERAL (
+            VALUES ('bulanan', t.bulan), ('dasarian', {SQL_AWAL_DASARIAN})
+        ) AS per(periode, awal)
+        WHERE c.ch_mm IS NOT NULL
+          AND (c.qc_flag & {QC_SARING}) = 0
+        GROUP BY per.periode, c.id_poshujan, per.awal;
+    """)
+    ditulis = cur.rowcount
+
+    # 2) WILAYAH
+    cur.execute("""
+        DELETE FROM rekap_ch r
+        USING rekap_target_wilayah t
+        WHERE r.tingkat = t.tingkat
+          AND r.id_wilayah = t.id_wilayah
+          AND r.awal >= t.bulan
+          AND r.awal < t.bulan + INTERVAL '1 month';
+    """)
+    # harian: langsung dari curah_hujan semua pos di wilayah
+    # (per tingkat supaya join ke pos_hujan & indeks curah_hujan tetap lurus)
+    for tingkat in ("kabupaten", "provinsi"):
+        kolom = WILAYAH_REKAP[tingkat][1]
+        cur.execute(f"""
+            INSERT INTO rekap_ch (tingkat, periode, id_wilayah, awal,
+                                  jumlah_pos, jumlah_data, total_ch, rata_ch, maks_ch)
+            SELECT t.tingkat, 'harian', t.id_wilayah, c.tanggal,
+                   COUNT(*), COUNT(*), AVG(c.ch_mm)::float8, AVG(c.ch_mm)::float8, MAX(c.ch_mm)::float8
+            FROM rekap_target_wilayah t
+            JOIN pos_hujan p ON p.{kolom} = t.id_wilayah
+            JOIN curah_hujan c
+              ON c.id_poshujan = p.id_poshujan
+             AND c.tanggal >= t.bulan
+             AND c.tanggal < t.bulan + INTERVAL '1 month'
+             -- kesamaan bulan supaya rebuild penuh bisa hash join
+             AND date_trunc('month', c.tanggal)::date = t.bulan
+            WHERE t.tingkat = %s
+              AND c.ch_mm IS NOT NULL
+              AND (c.qc_flag & {QC_SARING}) = 0
+            GROUP BY t.tingkat, t.id_wilayah, c.tanggal;
+        """, (tingkat,))
+        ditulis += cur.rowcount
+    # dasarian & bulanan: dari rekap pos yang baru dihitung
+    cur.execute("""
+        INSERT INTO rekap_ch (tingkat, periode, id_wilayah, awal,
+                              jumlah_pos, jumlah_data, total_ch, rata_ch, maks_ch)
+        SELECT w.tingkat, r.periode, w.id_wilayah, r.awal,
+               COUNT(*), SUM(r.jumlah_data), AVG(r.total_ch),
+               SUM(r.total_ch) / SUM(r.jumlah_data), MAX(r.maks_ch)
+        FROM rekap_ch r
+        JOIN pos_hujan p ON p.id_poshujan = r.id_wilayah
+        CROSS JOIN LATERAL (
+            VALUES ('kabupaten', p.id_kabupaten), ('provinsi', p.id_provinsi)
+        ) AS w(tingkat, id_wilayah)
+        JOIN rekap_target_wilayah t
+          ON t.tingkat = w.tingkat
+         AND t.id_wilayah = w.id_wilayah
+         AND t.bulan = date_trunc('month', r.awal)::date
+        WHERE r.tingkat = 'pos'
+        GROUP BY w.tingkat, r.periode, w.id_wilayah, r.awal;
+    """)
+    ditulis += cur.rowcount
+    return ditulis
+
+
+def siapkan_rekap_target(cur):
+    cur.execute(DDL_REKAP_CH)
+    cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS rekap_target (
+            id_poshujan integer, bulan date
+        ) ON COMMIT DROP;
+        TRUNCATE rekap_target;
+    """)
+
+
+def perbarui_rekap(cur, frame):
+    """Hitung ulang rekap untuk (pos, bulan) yang ada di frame upload."""
+    if frame.empty:
+        return 0
+
+    pasangan = pd.DataFrame({
+        "id_poshujan": frame["id_poshujan"],
+        "bulan": frame["tanggal"].dt.to_period("M").dt.to_timestamp(),
+    }).drop_duplicates()
+
+    siapkan_rekap_target(cur)
+    cur.execute("""
+        INSERT INTO rekap_target
+        SELECT * FROM unnest(%s::int[], %s::date[])
+    """, (pasangan["id_poshujan"].tolist(), pasangan["bulan"].dt.date.tolist()))
+    return isi_rekap(cur)
+
+
+def rebuild_rekap(cur):
+    """Kosongkan lalu isi ulang seluruh rekap dari curah_hujan."""
+    siapkan_rekap_target(cur)
+    cur.execute("TRUNCATE rekap_ch")
+    cur.execute("""
+        INSERT INTO rekap_target
+        SELECT DISTINCT id_poshujan, date_trunc('month', tanggal)::date
+        FROM curah_hujan
+        WHERE ch_mm IS NOT NULL
+    """)
+    return isi_rekap(cur)
+
+
+@app.cli.command("rebuild-rekap")
+def rebuild_rekap_command():
+    """Buat ulang rekap_ch (pos/kabupaten/provinsi) dari seluruh curah_hujan."""
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        t0 = time.perf_counter()
+        n = rebuild_rekap(cur)
+        conn.commit()
+    finally:
+        cur.close()
+    hapus_cache(["rekap"])
+    click.echo(f"rekap_ch: {n} baris diisi ulang ({time.perf_counter() - t0:.2f} detik)")
+
+
+@app.route("/api/rekap")
+@cache_respons("rekap")
+def api_rekap():
+    """
+    Rekap CH siap pakai.
+
+    Parameter:
+    - tingkat    : pos / kabupaten (default) / provinsi
+    - periode    : harian / dasarian / bulanan (default)
+    - id         : daftar id wilayah (dipisah koma), kosong = semua
+    - start, end : YYYY-MM-DD, batas tanggal awal periode (inklusif)
+    """
+    tingkat = request.args.get("tingkat", "kabupaten").lower()
+    periode = request.args.get("periode", "bulanan").lower()
+    if tingkat not in TINGKAT_REKAP:
+        return jsonify({"status": "error", "message": f"tingkat harus salah satu dari: {', '.join(TINGKAT_REKAP)}"}), 400
+    if periode not in PERIODE_REKAP:
+        return jsonify({"status": "error", "message": f"periode harus salah satu dari: {', '.join(PERIODE_REKAP)}"}), 400
+
+    try:
+        start = parse_tanggal_param("start")
+        end = parse_tanggal_param("end")
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    try:
+        ids = [int(v) for v in daftar_param("id")]
+    except ValueError:
+        return jsonify({"status": "error", "message": "Parameter id harus bilangan bulat"}), 400
+
+    tabel, kolom_id, kolom_nama = WILAYAH_REKAP[tingkat]
+    if tingkat == "pos" and periode == "harian":
+        # pos-harian = data mentah curah_hujan (tanpa yang ber-flag QC)
+        sumber = f"""
+            SELECT id_poshujan AS id_wilayah, tanggal AS awal,
+                   1 AS jumlah_pos, 1 AS jumlah_data,
+                   ch_mm::float8 AS total_ch, ch_mm::float8 AS rata_ch, ch_mm::float8 AS maks_ch
+            FROM curah_hujan
+            WHERE ch_mm IS NOT NULL
+              AND (qc_flag & {QC_SARING}) = 0
+        """
+        kolom_awal, kolom_wil = "tanggal", "id_poshujan"
+        params = []
+    else:
+        sumber = """
+            SELECT id_wilayah, awal, jumlah_pos, jumlah_data, total_ch, rata_ch, maks_ch
+            FROM rekap_ch
+            WHERE tingkat = %s AND periode = %s
+        """
+        kolom_awal, kolom_wil = "awal", "id_wilayah"
+        params = [tingkat, periode]
+
+    sumber += f"""
+              AND (%s::date IS NULL OR {kolom_awal} >= %s::date)
+              AND (%s::date IS NULL OR {kolom_awal} <= %s::date)
+              AND (cardinality(%s::bigint[]) = 0 OR {kolom_wil} = ANY(%s::bigint[]))
+    """
+    params += [start, start, end, end, ids, ids]
+
+    cur = get_db().cursor()
+    cur.execute(f"""
+        SELECT r.id_wilayah, w.{kolom_nama}, r.awal, r.jumlah_pos, r.jumlah_data,
+               r.total_ch, r.rata_ch, r.maks_ch
+        FROM ({sumber}) r
+        LEFT JOIN {tabel} w ON w.{kolom_id} = r.id_wilayah
+        ORDER BY r.id_wilayah, r.awal
+        LIMIT %s
+    """, params + [REKAP_MAX_BARIS + 1])
+    rows = cur.fetchall()
+    cur.close()
+
+    terpotong = len(rows) > REKAP_MAX_BARIS
+    rows = rows[:REKAP_MAX_BARIS]
+
+    def bulat(v):
+        return None if v is None else round(v, 2)
+
+    return jsonify({
+        "status": "success",
+        "tingkat": tingkat,
+        "periode": periode,
+        "jumlah": len(rows),
+        "terpotong": terpotong,
+        "data": [{
+            "id_wilayah": r[0],
+            "nama": r[1],
+            "awal": r[2].strftime("%Y-%m-%d"),
+            "jumlah_pos": r[3],
+            "jumlah_data": r[4],
+            "total_ch": bulat(r[5]),
+            "rata_ch": bulat(r[6]),
+            "maks_ch": bulat(r[7]),
+        } for r in rows],
+    })
+
+
+# ============================================================
+# QC CURAH HUJAN (FLAG PER OBSERVASI)
+# ============================================================
+# Setiap baris curah_hujan punya qc_flag (smallint, bitmask FLAG_QC;
+# 0 = lolos). Pemeriksaan dikerjakan per kolom atas matriks pos x hari
+# (float32, seperti indeks iklim), per blok QC_BLOK_POS pos:
+# - rentang   : CH > QC_CH_MAKS mm/hari
+# - berulang  : nilai >= QC_ULANG_MIN_MM yang sama persis berulang
+#               >= QC_ULANG_HARI hari berturut-turut
+# - persentil : CH > QC_PERSENTIL_FAKTOR x persentil QC_PERSENTIL hari
+#               hujan pos itu di bulan kalender yang sama (kalau data
+#               bulan itu < QC_PERSENTIL_MIN_HARI: semua bulan pos itu).
+#               Ambangnya disimpan di qc_ambang_ch.
+# - tetangga  : CH >= QC_TETANGGA_MIN_MM, minimal QC_TETANGGA_MIN_N dari
+#               QC_TETANGGA_K pos terdekat (<= QC_TETANGGA_KM) berdata,
+#               dan tidak satu pun mencapai QC_TETANGGA_RASIO x nilai itu
+#               pada hari yang sama +-1 hari (jam baca pos bisa bergeser)
+#
+# Upload CH hanya memeriksa ulang sekitar sel yang berubah sebelum commit:
+# petak QC_PETAK_HARI hari di pos itu dan di pos yang menjadikannya
+# tetangga (lihat petak_qc), dimuat per blok QC_BLOK_POS petak dengan
+# range indeks PK, jadi memori tidak tumbuh dengan rentang tanggal file.
+# Hanya sel yang flag-nya berubah yang ditulis.
+# Ambang persentil dan seluruh riwayat (per blok pos): flask --app app qc-ch
+#
+# Data ber-flag (QC_SARING) tidak ikut dijumlah di detail pos, API seri,
+# rekap, indeks iklim dan grid; ?qc=semua menampilkannya lagi. Filternya
+# hanya satu kolom di baris yang memang sudah dibaca (tanpa join).
+# /api/export tetap mengirim data mentah.
+QC_CH_MAKS = float(os.getenv("QC_CH_MAKS", "500"))
+QC_ULANG_HARI = int(os.getenv("QC_ULANG_HARI", "5"))
+QC_ULANG_MIN_MM = float(os.getenv("QC_ULANG_MIN_MM", "1.0"))
+QC_PERSENTIL = float(os.getenv("QC_PERSENTIL", "99"))
+QC_PERSENTIL_FAKTOR = float(os.getenv("QC_PERSENTIL_FAKTOR", "2.0"))
+QC_PERSENTIL_MIN_HARI = int(os.getenv("QC_PERSENTIL_MIN_HARI", "30"))
+QC_TETANGGA_K = int(os.getenv("QC_TETANGGA_K", "5"))
+QC_TETANGGA_KM = float(os.getenv("QC_TETANGGA_KM", "30"))
+QC_TETANGGA_MIN_N = int(os.getenv("QC_TETANGGA_MIN_N", "3"))
+QC_TETANGGA_MIN_MM = float(os.getenv("QC_TETANGGA_MIN_MM", "50"))
+QC_TETANGGA_RASIO = float(os.getenv("QC_TETANGGA_RASIO", "0.1"))
+QC_BLOK_POS = int(os.getenv("QC_BLOK_POS", "256"))
+# minimal 2 x pad + 1 hari (lihat petak_qc)
+QC_PETAK_HARI = max(int(os.getenv("QC_PETAK_HARI", "32")),
+                    2 * max(QC_ULANG_HARI - 1, 1) + 1)
+# batas baris per respons /api/qc_ch
+QC_API_MAX_LIMIT = int(os.getenv("QC_API_MAX_LIMIT", "10000"))
+
+# nama -> (bit, keterangan)
+FLAG_QC = {
+    "rentang":   (1, "CH di luar batas fisik harian"),
+    "berulang":  (2, "Nilai yang sama berulang berhari-hari"),
+    "persentil": (4, "Jauh di atas persentil klimatologis pos"),
+    "tetangga":  (8, "Hujan lebat sementara pos tetangga kering"),
+}
+
+# flag yang membuat CH dibuang dari pembacaan (default: semua flag)
+QC_SARING = sum(
+    FLAG_QC[n.strip()][0]
+    for n in os.getenv("QC_SARING", ",".join(FLAG_QC)).split(",")
+    if n.strip()
+)
+
+DDL_QC_CH = """
+    ALTER TABLE curah_hujan
+        ADD COLUMN IF NOT EXISTS qc_flag smallint NOT NULL DEFAULT 0;
+
+    CREATE TABLE IF NOT EXISTS qc_ambang_ch (
+        id_poshujan integer  NOT NULL,
+        bulan       smallint NOT NULL,
+        ambang      real     NOT NULL,
+        jumlah_data integer  NOT NULL,
+        diperbarui  timestamptz NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (id_poshujan, bulan)
+    );
+"""
+
+
+def nama_flag_qc(flag):
+    return [nama for nama, (bit, _) in FLAG_QC.items() if flag & bit]
+
+
+def parse_qc_param():
+    """
+    ?qc= -> bitmask flag yang disaring dari hasil baca.
+    bersih (default) = QC_SARING, semua = tanpa saring, atau daftar nama
+    flag (dipisah koma). ValueError kalau nama flag tidak dikenal.
+    """
+    nilai = (request.args.get("qc") or "bersih").strip().lower()
+    if nilai == "bersih":
+        return QC_SARING
+    if nilai == "semua":
+        return 0
+    try:
+        return sum(FLAG_QC[n.strip()][0] for n in nilai.split(",") if n.strip())
+    except KeyError:
+        raise ValueError(
+            f"qc harus bersih, semua, atau daftar flag: {', '.join(FLAG_QC)}"
+        ) from None
+
+
+def pad_qc():
+    """Sel sejauh ini (hari) dari sel yang berubah bisa ikut berubah flag-nya."""
+    return max(QC_ULANG_HARI - 1, 1)
+
+
+def muat_jendela_qc(cur, ids, awal, lebar):
+    """
+    CH & flag untuk jendela ke-i: pos ids[i], hari awal[i] ..
+    awal[i] + lebar - 1 (hari sejak 1970-01-01). Return (ch float32
+    [jendela, lebar], NaN = tidak ada data; flag int16 [jendela, lebar]).
+    Satu query, tiap jendela dibaca sebagai range indeks PK.
+    """
+    n = len(ids)
+    ch = np.full((n, lebar), np.nan, dtype=np.float32)
+    flag = np.zeros((n, lebar), dtype=np.int16)
+    if not n or lebar <= 0:
+        return ch, flag
+
+    # LATERAL + LIMIT: planner tidak bisa meratakannya jadi hash/merge
+    # join atas seluruh tabel, tiap jendela tetap satu range scan PK
+    sql = cur.mogrify("""
+        SELECT r.i, c.hari - r.awal, c.ch_mm, c.qc_flag
+        FROM unnest(%s::int[], %s::int[], %s::int[]) AS r(i, id_poshujan, awal)
+        CROSS JOIN LATERAL (
+            SELECT tanggal - DATE '1970-01-01' AS hari, ch_mm, qc_flag
+            FROM curah_hujan
+            WHERE id_poshujan = r.id_poshujan
+              AND tanggal BETWEEN DATE '1970-01-01' + r.awal
+                              AND DATE '1970-01-01' + r.awal + %s
+              AND ch_mm IS NOT NULL
+            LIMIT %s
+        ) c
+    """, (list(range(n)), np.asarray(ids).tolist(), np.asarray(awal).tolist(), lebar - 1, lebar))
+    buf = io.StringIO()
+    cur.copy_expert(f"COPY ({sql.decode()}) TO STDOUT", buf)
+    buf.seek(0)
+    data = pd.read_csv(
+        buf, sep="\t", header=None, names=["i", "hari", "ch", "flag"],
+        dtype={"i": np.int64, "hari": np.int64, "ch": np.float32, "flag": np.int16},
+    )
+    baris, kolom = data["i"].to_numpy(), data["hari"].to_numpy()
+    ch[baris, kolom] = data["ch"].to_numpy()
+    flag[baris, kolom] = data["flag"].to_numpy()
+    return ch, flag
+
+
+def petak_qc(id_pos, tetangga, sel_id, sel_hari):
+    """
+    Petak (pos, QC_PETAK_HARI hari) yang harus diperiksa ulang setelah
+    sel (sel_id, sel_hari) berubah: hari +-pad_qc() di pos itu sendiri dan
+    +-1 hari di pos yang menjadikannya tetangga.
+    Return (baris pos di id_pos, hari pertama petak), tanpa duplikat.
+    """
+    urut_id = np.argsort(id_pos)
+    i = np.minimum(np.searchsorted(id_pos[urut_id], sel_id), max(len(id_pos) - 1, 0))
+    ada = id_pos[urut_id[i]] == sel_id if len(id_pos) else np.zeros(len(sel_id), dtype=bool)
+    q, d = urut_id[i[ada]], np.asarray(sel_hari, dtype=np.int64)[ada]
+
+    # pasangan (p, q): q salah satu tetangga p, diurutkan per q
+    p_all = np.repeat(np.arange(len(tetangga)), tetangga.shape[1])
+    q_all = tetangga.ravel()
+    pakai = q_all >= 0
+    urut = np.argsort(q_all[pakai], kind="stable")
+    q_urut, p_urut = q_all[pakai][urut], p_all[pakai][urut]
+    lo = np.searchsorted(q_urut, q, "left")
+    n_rev = np.searchsorted(q_urut, q, "right") - lo
+    geser = np.arange(n_rev.sum()) - np.repeat(np.cumsum(n_rev) - n_rev, n_rev)
+    rev_p = p_urut[np.repeat(lo, n_rev) + geser]
+    rev_d = np.repeat(d, n_rev)
+
+    # QC_PETAK_HARI >= 2 * pad + 1: ujung-ujung rentang sudah mencakup
+    # semua petak yang disentuhnya
+    pad = pad_qc()
+    pos = np.concatenate([q, q, rev_p, rev_p])
+    hari = np.concatenate([d - pad, d + pad, rev_d - 1, rev_d + 1])
+    petak = np.unique(np.stack([pos, np.floor_divide(hari, QC_PETAK_HARI)], axis=1), axis=0)
+    return petak[:, 0], petak[:, 1] * QC_PETAK_HARI
+
+
+def bulan_kolom(hari0, n_hari):
+    """Bulan kalender (0-11) tiap kolom matriks."""
+    return (hari0 + np.arange(n_hari)).astype("datetime64[M]").astype(np.int64) % 12
+
+
+def tetangga_qc(lat, lng):
+    """
+    QC_TETANGGA_K pos terdekat (<= QC_TETANGGA_KM) untuk tiap pos:
+    indeks baris [pos, K], urut dari yang terdekat; -1 = tidak ada.
+    """
+    n = len(lat)
+    hasil = np.full((n, QC_TETANGGA_K), -1, dtype=np.int64)
+    k = min(QC_TETANGGA_K, n - 1)
+    if k <= 0:
+        return hasil
+
+    # urutan jarak = urutan kuadrat tali busur antar vektor satuan: satu
+    # perkalian matriks per blok, km hanya dihitung untuk k terdekat
+    ada = np.isfinite(lat) & np.isfinite(lng)
+    lat_r, lng_r = np.radians(lat), np.radians(lng)
+    xyz = np.stack(
+        [np.cos(lat_r) * np.cos(lng_r), np.cos(lat_r) * np.sin(lng_r), np.sin(lat_r)], axis=1
+    )
+    xyz[~ada] = 0
+    for a in range(0, n, QC_BLOK_POS):
+        b = min(a + QC_BLOK_POS, n)
+        tali2 = 2 - 2 * (xyz[a:b] @ xyz.T)
+        tali2[:, ~ada] = np.inf
+        tali2[~ada[a:b]] = np.inf
+        tali2[np.arange(b - a), np.arange(a, b)] = np.inf  # diri sendiri
+
+        idx = np.argpartition(tali2, k - 1, axis=1)[:, :k]
+        tali2_k = np.take_along_axis(tali2, idx, axis=1)
+        urut = np.argsort(tali2_k, axis=1, kind="stable")
+        idx = np.take_along_axis(idx, urut, axis=1)
+        tali2_k = np.clip(np.take_along_axis(tali2_k, urut, axis=1), 0, 4)
+        jarak = 2 * RADIUS_BUMI_KM * np.arcsin(np.sqrt(tali2_k) / 2)
+        hasil[a:b, :k] = np.where(jarak <= QC_TETANGGA_KM, idx, -1)
+    return hasil
+
+
+def hitung_ambang_qc(ch, hari0):
+    """
+    Ambang persentil per pos per bulan kalender dari matriks CH:
+    (ambang float32 [pos, 12], jumlah hari hujan int [pos, 12]);
+    NaN = data terlalu sedikit, pos itu tidak diperiksa.
+    """
+    n_pos, n_hari = ch.shape
+    bulan = bulan_kolom(hari0, n_hari)
+    ambang = np.full((n_pos, 12), np.nan, dtype=np.float32)
+    jumlah = np.zeros((n_pos, 12), dtype=np.int64)
+
+    for a in range(0, n_pos, QC_BLOK_POS):
+        x = ch[a:a + QC_BLOK_POS]
+        with np.errstate(invalid="ignore"):
+            # nilai di luar rentang tidak ikut membentuk klimatologi
+            basah = np.where((x >= HARI_HUJAN_MM) & (x <= QC_CH_MAKS), x, np.nan)
+        n_semua = np.isfinite(basah).sum(axis=1)
+        p_semua = persentil_baris(basah, [QC_PERSENTIL])[:, 0]
+
+        for m in range(12):
+            sub = basah[:, bulan == m]
+            n = np.isfinite(sub).sum(axis=1)
+            p = persentil_baris(sub, [QC_PERSENTIL])[:, 0] if sub.shape[1] else np.full(len(x), np.nan)
+            cukup = n >= QC_PERSENTIL_MIN_HARI
+            cadangan = n_semua >= QC_PERSENTIL_MIN_HARI
+            ambang[a:a + len(x), m] = np.where(
+                cukup, p, np.where(cadangan, p_semua, np.nan)
+            ) * QC_PERSENTIL_FAKTOR
+            jumlah[a:a + len(x), m] = np.where(cukup, n, n_semua)
+    return ambang, jumlah
+
+
+def hitung_flag_qc(ch, hari0, ambang, tetangga, baris=None):
+    """
+    Flag QC int16 [baris, hari] untuk baris-baris matriks CH (default
+    semua baris); sel tanpa data = 0. Per baris yang dihitung:
+    hari0 = hari kolom 0 (satu nilai untuk semua atau per baris),
+    ambang [baris, 12] dan tetangga [baris, K] = nomor baris ch
+    tetangganya (-1 = tidak ada).
+    """
+    if baris is None:
+        baris = np.arange(len(ch))
+    n_pos, n_hari = len(baris), ch.shape[1]
+    flag = np.zeros((n_pos, n_hari), dtype=np.int16)
+    if n_hari == 0 or n_pos == 0:
+        return flag
+    hari0 = np.broadcast_to(np.asarray(hari0, dtype="datetime64[D]"), (n_pos,))
+
+    for a in range(0, n_pos, QC_BLOK_POS):
+        b = min(a + QC_BLOK_POS, n_pos)
+        x = ch[baris[a:b]]
+        f = flag[a:b]
+        bulan = bulan_kolom(hari0[a:b, np.newaxis], n_hari)
+        with np.errstate(invalid="ignore"):
+            f[x > QC_CH_MAKS] |= FLAG_QC["rentang"][0]
+
+            # deret nilai sama: id deret naik setiap nilai berganti
+            # (NaN selalu memutus deret), panjang = jumlah sel per id
+            sama = np.zeros(x.shape, dtype=bool)
+            sama[:, 1:] = (x[:, 1:] == x[:, :-1]) & (x[:, 1:] >= QC_ULANG_MIN_MM)
+            id_deret = np.cumsum(~sama).reshape(x.shape)
+            panjang = np.bincount(id_deret.ravel())[id_deret]
+            f[(panjang >= QC_ULANG_HARI) & (x >= QC_ULANG_MIN_MM)] |= FLAG_QC["berulang"][0]
+
+            f[x > np.take_along_axis(ambang[a:b], bulan, axis=1)] |= FLAG_QC["persentil"][0]
+
+            # tetangga: [blok, K, hari], baris -1 = tidak ada tetangga
+            nb = tetangga[a:b]
+            xs = ch[np.maximum(nb, 0)]
+            xs[nb < 0] = np.nan
+            n_ada = np.isfinite(xs).sum(axis=1)
+            maks = np.fmax.reduce(xs, axis=1)
+            maks_geser = maks.copy()
+            maks_geser[:, 1:] = np.fmax(maks_geser[:, 1:], maks[:, :-1])
+            maks_geser[:, :-1] = np.fmax(maks_geser[:, :-1], maks[:, 1:])
+            terisolasi = (
+                (x >= QC_TETANGGA_MIN_MM)
+                & (n_ada >= QC_TETANGGA_MIN_N)
+                & ~(maks_geser >= QC_TETANGGA_RASIO * x)
+            )
+            f[terisolasi] |= FLAG_QC["tetangga"][0]
+    return flag
+
+
+def simpan_ambang_qc(cur, ids, ambang, jumlah):
+    ada = np.isfinite(ambang)
+    baris, bulan = np.nonzero(ada)
+    cur.execute("""
+        INSERT INTO qc_ambang_ch (id_poshujan, bulan, ambang, jumlah_data)
+        SELECT * FROM unnest(%s::int[], %s::smallint[], %s::real[], %s::int[])
+        ON CONFLICT (id_poshujan, bulan) DO UPDATE
+        SET ambang = EXCLUDED.ambang,
+            jumlah_data = EXCLUDED.jumlah_data,
+            diperbarui = NOW()
+    """, (ids[baris].tolist(), (bulan + 1).tolist(),
+          ambang[ada].tolist(), jumlah[ada].tolist()))
+
+
+def ambil_ambang_qc(cur, ids):
+    """Ambang float32 [len(ids), 12] (NaN = tidak ada) untuk pos ids."""
+    ambang = np.full((len(ids), 12), np.nan, dtype=np.float32)
+    if not len(ids):
+        return ambang
+    cur.execute("""
+        SELECT id_poshujan, bulan, ambang
+        FROM qc_ambang_ch
+        WHERE id_poshujan = ANY(%s::int[])
+    """, (np.unique(ids).tolist(),))
+    baris_id = {}
+    for i, id_pos in enumerate(np.asarray(ids).tolist()):
+        baris_id.setdefault(id_pos, []).append(i)
+    for id_pos, bulan, nilai in cur.fetchall():
+        ambang[baris_id[id_pos], bulan - 1] = nilai
+    return ambang
+
+
+def qc_jendela(cur, id_pos, tetangga, pos, awal, lebar, hitung_ambang=False):
+    """
+    Flag baru untuk jendela (pos[i], hari awal[i] .. + lebar - 1).
+    Jendela pos tetangga pada hari yang sama ikut dimuat (sekali untuk
+    tiap pasangan pos/hari). Return (flag lama, flag baru), [jendela, lebar].
+    """
+    nb = tetangga[pos]
+    ada_nb = nb >= 0
+    semua = np.unique(
+        np.stack([
+            np.concatenate([pos, nb[ada_nb]]),
+            np.concatenate([awal, np.broadcast_to(awal[:, np.newaxis], nb.shape)[ada_nb]]),
+        ], axis=1),
+        axis=0, return_inverse=True,
+    )
+    unik, balik = semua[0], semua[1].ravel()
+    ch, flag_lama = muat_jendela_qc(cur, id_pos[unik[:, 0]], unik[:, 1], lebar)
+
+    baris = balik[:len(pos)]
+    tetangga_baris = np.full(nb.shape, -1, dtype=np.int64)
+    tetangga_baris[ada_nb] = balik[len(pos):]
+
+    ids = id_pos[pos]
+    if hitung_ambang:
+        ambang, jumlah = hitung_ambang_qc(ch[baris], np.datetime64(int(awal[0]), "D"))
+        simpan_ambang_qc(cur, ids, ambang, jumlah)
+    else:
+        ambang = ambil_ambang_qc(cur, ids)
+    hari0 = awal.astype("datetime64[D]")
+    flag = hitung_flag_qc(ch, hari0, ambang, tetangga_baris, baris)
+    return flag_lama[baris], flag
+
+
+def jalankan_qc(cur, sel=None, hitung_ambang=False):
+    """
+    Hitung ulang flag QC lalu tulis sel yang flag-nya berubah.
+    - sel = (id_poshujan, hari sejak 1970-01-01) array sel yang berubah:
+      hanya petak di sekitar sel itu (lihat petak_qc), per blok
+      QC_BLOK_POS petak.
+    - sel = None: seluruh riwayat semua pos, per blok QC_BLOK_POS pos.
+      hitung_ambang=True: ambang persentil ikut dihitung ulang.
+    Return (DataFrame id_poshujan/tanggal/qc_flag sel yang berubah, waktu).
+    """
+    waktu = {}
+    t0 = time.perf_counter()
+    registry = registry_pos()
+    id_pos = registry.id
+    tetangga = registry.tetangga()
+    pad = pad_qc()
+
+    if sel is None:
+        cur.execute("""
+            SELECT MIN(tanggal) - DATE '1970-01-01', MAX(tanggal) - DATE '1970-01-01'
+            FROM curah_hujan
+        """)
+        hari_min, hari_max = cur.fetchone()
+        if hari_min is None:
+            hari_min, hari_max = 0, -1
+        pos = np.arange(len(id_pos))
+        awal = np.full(len(pos), hari_min, dtype=np.int64)
+        lebar = hari_max - hari_min + 1
+        tulis = slice(0, lebar)
+        if hitung_ambang:
+            cur.execute("TRUNCATE qc_ambang_ch")
+    else:
+        pos, awal = petak_qc(id_pos, tetangga, *sel)
+        # konteks pad di kedua sisi petak: cukup untuk deret berulang
+        # dan tetangga +-1 hari
+        awal = awal - pad
+        lebar = QC_PETAK_HARI + 2 * pad
+        tulis = slice(pad, pad + QC_PETAK_HARI)
+    tambah_waktu(waktu, "petak", t0)
+
+    bagian = []
+    for a in range(0, len(pos), QC_BLOK_POS):
+        t0 = time.perf_counter()
+        p, w = pos[a:a + QC_BLOK_POS], awal[a:a + QC_BLOK_POS]
+        flag_lama, flag = qc_jendela(cur, id_pos, tetangga, p, w, lebar,
+                                     hitung_ambang=sel is None and hitung_ambang)
+        tambah_waktu(waktu, "hitung", t0)
+
+        t0 = time.perf_counter()
+        beda = np.zeros(flag.shape, dtype=bool)
+        beda[:, tulis] = flag[:, tulis] != flag_lama[:, tulis]
+        baris, kolom = np.nonzero(beda)
+        ubah = pd.DataFrame({
+            "id_poshujan": id_pos[p[baris]],
+            "tanggal": pd.to_datetime((w[baris] + kolom).astype("datetime64[D]")),
+            "qc_flag": flag[baris, kolom],
+        })
+        if len(ubah):
+            # created_at ikut diperbarui seperti upsert upload: migrasi-db
+            # menyalin ulang baris dengan created_at >= awal migrasi, jadi
+            # flag yang berubah selama penyalinan tidak hilang
+            cur.execute("""
+                UPDATE curah_hujan c
+                SET qc_flag = t.qc_flag, created_at = NOW()
+                FROM unnest(%s::int[], %s::date[], %s::smallint[]) AS t(id_poshujan, tanggal, qc_flag)
+                WHERE c.id_poshujan = t.id_poshujan
+                  AND c.tanggal     = t.tanggal
+            """, (ubah["id_poshujan"].tolist(), ubah["tanggal"].dt.date.tolist(),
+                  ubah["qc_flag"].tolist()))
+            bagian.append(ubah)
+        tambah_waktu(waktu, "tulis", t0)
+
+    if not bagian:
+        return pd.DataFrame({
+            "id_poshujan": pd.Series(dtype=np.int64),
+            "tanggal": pd.Series(dtype="datetime64[ns]"),
+            "qc_flag": pd.Series(dtype=np.int16),
+        }), waktu
+    return pd.concat(bagian, ignore_index=True), waktu
+
+
+@app.cli.command("qc-ch")
+@click.option("--pakai-ambang-lama", is_flag=True,
+              help="Pakai ambang persentil yang tersimpan (tidak dihitung ulang).")
+def qc_ch_command(pakai_ambang_lama):
+    """Hitung ulang ambang persentil & flag QC seluruh curah_hujan."""
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        t0 = time.perf_counter()
+        cur.execute(DDL_QC_CH)
+        ubah, waktu = jalankan_qc(cur, hitung_ambang=not pakai_ambang_lama)
+        t1 = time.perf_counter()
+        perbarui_rekap(cur, ubah)
+        tambah_waktu(waktu, "rekap", t1)
+        conn.commit()
+        cur.execute("SELECT qc_flag, COUNT(*) FROM curah_hujan WHERE qc_flag <> 0 GROUP BY 1")
+        per_flag = {nama: 0 for nama in FLAG_QC}
+        for flag, n in cur.fetchall():
+            for nama in nama_flag_qc(flag):
+                per_flag[nama] += n
+    finally:
+        cur.close()
+    hapus_cache_ch(
+        ubah["id_poshujan"].unique().tolist(), False,
+        ubah["tanggal"].drop_duplicates().dt.strftime("%Y-%m-%d").tolist(),
+    )
+    click.echo(f"qc: {len(ubah)} flag berubah ({time.perf_counter() - t0:.2f} detik, "
+               f"{', '.join(f'{k} {v:.0f} ms' for k, v in ringkas_waktu(waktu).items())})")
+    for nama, n in per_flag.items():
+        click.echo(f"  {nama:<10} {n:8d} observasi  ({FLAG_QC[nama][1]})")
+
+
+@app.route("/api/qc_ch")
+@cache_respons("qc")
+def api_qc_ch():
+    """
+    Daftar observasi yang ber-flag QC (untuk diperiksa petugas).
+
+    Parameter:
+    - id         : daftar id_poshujan (opsional, dipisah koma / diulang)
+    - start, end : YYYY-MM-DD, batas periode (inklusif)
+    - flag       : daftar nama flag (default semua flag)
+    - limit      : jumlah baris maksimal (default & batas QC_API_MAX_LIMIT)
+    """
+    try:
+        start = parse_tanggal_param("start")
+        end = parse_tanggal_param("end")
+        limit = parse_int_param("limit", 1, QC_API_MAX_LIMIT) or QC_API_MAX_LIMIT
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    try:
+        ids = [int(v) for v in daftar_param("id")]
+    except ValueError:
+        return jsonify({"status": "error", "message": "Parameter id harus bilangan bulat"}), 400
+
+    nama = [n.lower() for n in daftar_param("flag")] or list(FLAG_QC)
+    salah = [n for n in nama if n not in FLAG_QC]
+    if salah:
+        return jsonify({
+            "status": "error",
+            "message": f"flag {', '.join(salah)} tidak dikenal (pilihan: {', '.join(FLAG_QC)})"
+        }), 400
+    mask = sum(FLAG_QC[n][0] for n in nama)
+
+    cur = get_db().cursor()
+    cur.execute("""
+        SELECT c.id_poshujan, p.nama_pos, c.tanggal, c.ch_mm::float8, c.qc_flag
+        FROM curah_hujan c
+        JOIN pos_hujan p ON p.id_poshujan = c.id_poshujan
+        WHERE (c.qc_flag & %s) <> 0
+          AND (cardinality(%s::int[]) = 0 OR c.id_poshujan = ANY(%s::int[]))
+          AND (%s::date IS NULL OR c.tanggal >= %s::date)
+          AND (%s::date IS NULL OR c.tanggal <= %s::date)
+        ORDER BY c.id_poshujan, c.tanggal
+        LIMIT %s
+    """, (mask, ids, ids, start, start, end, end, limit + 1))
+    rows = cur.fetchall()
+    cur.close()
+
+    data = [{
+        "id_poshujan": r[0],
+        "nama_pos": r[1],
+        "tanggal": r[2].strftime("%Y-%m-%d"),
+        "ch": r[3],
+        "flag": nama_flag_qc(r[4]),
+    } for r in rows[:limit]]
+    return jsonify({
+        "status": "success",
+        "jumlah": len(data),
+        "terpotong": len(rows) > limit,
+        "flag": {k: v[1] for k, v in FLAG_QC.items()},
+        "data": data,
+    })
+
+
+# ============================================================
+# ENGINE PENYIMPANAN CURAH HUJAN
+# ============================================================
+# Dua cara memuat data ke curah_hujan, bisa dipilih per upload
+# (field form "engine") supaya bisa dibandingkan:
+# - "values": execute_values per 500 baris (cara lama)
+# - "copy"  : COPY FROM STDIN ke tabel staging sementara, lalu satu
+#             INSERT ... SELECT ... ON CONFLICT untuk semua baris
+#
+# Upload ulang file yang tumpang tindih tidak menulis ulang baris yang
+# nilainya sama (ON CONFLICT ... WHERE ch_mm IS DISTINCT FROM), jadi
+# created_at, WAL dan indeks tidak ikut berubah. Engine "copy" juga
+# menyimpan sidik (md5 isi) per pos per bulan di sidik_ch: bulan di file
+# yang sidiknya sama persis dengan yang tersimpan dilewati utuh tanpa
+# dibandingkan per baris. Backfill sidik: flask --app app rebuild-sidik-ch
+INGEST_ENGINE = os.getenv("INGEST_ENGINE", "copy")
+INGEST_ENGINES = ("copy", "values")
+
+SUMBER_UPLOAD = "Upload Excel/CSV"
+
+DDL_SIDIK_CH = """
+    CREATE TABLE IF NOT EXISTS sidik_ch (
+        id_poshujan integer NOT NULL,
+        bulan       date    NOT NULL,
+        jumlah      integer NOT NULL,
+        sidik       text    NOT NULL,
+        diperbarui  timestamptz NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (id_poshujan, bulan)
+    );
+"""
+
+# isi satu (pos, bulan) -> md5; ch_mm di-cast ke float8 dulu supaya
+# skala numeric tidak ikut: kolom numeric(…,1) lama "12.0" dan nilai
+# staging "12" sama-sama jadi "12". Sidik yang tersimpan dengan rumus
+# lama cukup diisi ulang sekali: flask --app app rebuild-sidik-ch
+SQL_SIDIK_CH = """
+    md5(string_agg(tanggal::text || '=' || COALESCE(ch_mm::float8::text, ''), ',' ORDER BY tanggal))
+"""
+
+
+def frame_berubah(rows):
+    """Baris RETURNING (id_poshujan, tanggal, ch_mm, baru) -> (DataFrame, jumlah baru)."""
+    return pd.DataFrame({
+        "id_poshujan": np.array([r[0] for r in rows], dtype=np.int64),
+        "tanggal": pd.to_datetime([r[1] for r in rows]),
+        "ch_mm": np.array([r[2] for r in rows], dtype=np.float64),
+    }), sum(1 for r in rows if r[3])
+
+
+def muat_ch_values(cur, frame):
+    # execute_values memang butuh tuple per baris
+    rows_insert = list(zip(
+        frame["id_poshujan"].tolist(),
+        frame["tanggal"].dt.date.tolist(),
+        frame["ch_mm"].tolist(),
+        itertools.repeat(SUMBER_UPLOAD, len(frame)),
+    ))
+    # baru / diperbarui dibedakan lewat CTE "ada" (snapshot sebelum
+    # upsert); xmax tidak bisa di-RETURNING dari tabel berpartisi
+    hasil = execute_values(cur, """
+        WITH v (id_poshujan, tanggal, ch_mm, sumber_data) AS (VALUES %s),
+        ada AS (
+            SELECT v.id_poshujan, v.tanggal
+            FROM v
+            JOIN curah_hujan c
+              ON c.id_poshujan = v.id_poshujan
+             AND c.tanggal     = v.tanggal
+        ), upsert AS (
+            INSERT INTO curah_hujan (id_poshujan, tanggal, ch_mm, sumber_data)
+            SELECT * FROM v
+            ON CONFLICT (id_poshujan, tanggal)
+            DO UPDATE SET
+                ch_mm       = EXCLUDED.ch_mm,
+                sumber_data = EXCLUDED.sumber_data,
+                created_at  = NOW()
+            WHERE curah_hujan.ch_mm IS DISTINCT FROM EXCLUDED.ch_mm
+            RETURNING id_poshujan, tanggal, ch_mm
+        )
+        SELECT u.id_poshujan, u.tanggal, u.ch_mm::float8, ada.id_poshujan IS NULL
+        FROM upsert u
+        LEFT JOIN ada
+          ON ada.id_poshujan = u.id_poshujan
+         AND ada.tanggal     = u.tanggal;
+    """, rows_insert, template="(%s, %s::date, %s::numeric, %s)", page_size=500, fetch=True)
+    berubah, baru = frame_berubah(hasil)
+
+    # engine ini tidak menghitung sidik; sidik bulan yang berubah dibuang
+    # supaya tidak dipakai untuk melewati bulan itu di upload berikutnya
+    if not berubah.empty:
+        bulan = berubah["tanggal"].dt.to_period("M").dt.to_timestamp()
+        pasangan = pd.DataFrame({"id": berubah["id_poshujan"], "bulan": bulan}).drop_duplicates()
+        cur.execute(DDL_SIDIK_CH)
+        cur.execute("""
+            DELETE FROM sidik_ch s
+            USING unnest(%s::int[], %s::date[]) AS t(id_poshujan, bulan)
+            WHERE s.id_poshujan = t.id_poshujan AND s.bulan = t.bulan
+        """, (pasangan["id"].tolist(), pasangan["bulan"].dt.date.tolist()))
+
+    jumlah = {
+        "baru": baru,
+        "diperbarui": len(berubah) - baru,
+        "tidak_berubah": len(frame) - len(berubah),
+        "bulan_dilewati": 0,
+    }
+    return jumlah, berubah
+
+
+def muat_ch_copy(cur, frame, waktu):
+    t0 = time.perf_counter()
+
+    # Tabel staging hidup selama transaksi ini saja. Kalau satu transaksi
+    # memuat beberapa potongan, tabelnya dipakai ulang (dikosongkan dulu).
+    cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS stg_curah_hujan (
+            id_poshujan integer,
+            tanggal     date,
+            ch_mm       double precision,
+            urut        integer
+        ) ON COMMIT DROP;
+        TRUNCATE stg_curah_hujan;
+
+        CREATE TEMP TABLE IF NOT EXISTS stg_curah_hujan_unik (
+            id_poshujan integer,
+            tanggal     date,
+            ch_mm       numeric
+        ) ON COMMIT DROP;
+        TRUNCATE stg_curah_hujan_unik;
+    """)
+    cur.execute(DDL_SIDIK_CH)
+
+    buf = io.StringIO()
+    frame.assign(urut=np.arange(len(frame))).to_csv(
+        buf, sep="\t", header=False, index=False,
+        columns=["id_poshujan", "tanggal", "ch_mm", "urut"],
+        date_format="%Y-%m-%d",
+    )
+    buf.seek(0)
+    cur.copy_expert(
+        "COPY stg_curah_hujan (id_poshujan, tanggal, ch_mm, urut) FROM STDIN",
+        buf
+    )
+
+    # Kalau (pos, tanggal) muncul lebih dari sekali di file,
+    # yang dipakai baris terakhir (sama seperti upload per baris)
+    cur.execute("""
+        INSERT INTO stg_curah_hujan_unik
+        SELECT DISTINCT ON (id_poshujan, tanggal)
+               id_poshujan, tanggal, ch_mm::numeric
+        FROM stg_curah_hujan
+        ORDER BY id_poshujan, tanggal, urut DESC;
+    """)
+    n_unik = cur.rowcount
+    tambah_waktu(waktu, "staging", t0)
+
+    # Bulan yang isinya sama persis dengan yang tersimpan (sidik sama)
+    # dibuang dari staging sebelum dibandingkan per baris
+    t0 = time.perf_counter()
+    cur.execute(f"""
+        WITH sidik_file AS (
+            SELECT id_poshujan, date_trunc('month', tanggal)::date AS bulan,
+                   COUNT(*) AS jumlah, {SQL_SIDIK_CH} AS sidik
+            FROM stg_curah_hujan_unik
+            GROUP BY 1, 2
+        ), sama AS (
+            SELECT f.id_poshujan, f.bulan
+            FROM sidik_file f
+            JOIN sidik_ch s
+              ON s.id_poshujan = f.id_poshujan
+             AND s.bulan       = f.bulan
+            WHERE s.jumlah = f.jumlah
+              AND s.sidik  = f.sidik
+        ), dibuang AS (
+            DELETE FROM stg_curah_hujan_unik u
+            USING sama
+            WHERE u.id_poshujan = sama.id_poshujan
+              AND date_trunc('month', u.tanggal)::date = sama.bulan
+            RETURNING 1
+        )
+        SELECT (SELECT COUNT(*) FROM sama), (SELECT COUNT(*) FROM dibuang);
+    """)
+    bulan_dilewati, baris_dilewati = cur.fetchone()
+    cur.execute("ANALYZE stg_curah_hujan_unik;")
+    tambah_waktu(waktu, "sidik", t0)
+
+    t0 = time.perf_counter()
+    # Baris yang nilainya sama dibuang lewat join biasa (hanya baca).
+    # ON CONFLICT ... WHERE saja tetap mengunci baris itu dan menulis WAL.
+    cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS stg_bulan_sisa (
+            id_poshujan integer,
+            bulan       date
+        ) ON COMMIT DROP;
+        TRUNCATE stg_bulan_sisa;
+
+        INSERT INTO stg_bulan_sisa
+        SELECT DISTINCT id_poshujan, date_trunc('month', tanggal)::date
+        FROM stg_curah_hujan_unik;
+
+        DELETE FROM stg_curah_hujan_unik u
+        USING curah_hujan c
+        WHERE c.id_poshujan = u.id_poshujan
+          AND c.tanggal     = u.tanggal
+          AND c.ch_mm IS NOT DISTINCT FROM u.ch_mm;
+    """)
+
+    # WHERE tetap dipasang untuk upload lain yang berjalan bersamaan.
+    # Yang tersisa di staging sekarang hanya baris baru / berubah; mana
+    # yang baru dilihat dari CTE "ada" (xmax tidak bisa di-RETURNING dari
+    # tabel berpartisi)
+    cur.execute("""
+        WITH ada AS (
+            SELECT u.id_poshujan, u.tanggal
+            FROM stg_curah_hujan_unik u
+            JOIN curah_hujan c
+              ON c.id_poshujan = u.id_poshujan
+             AND c.tanggal     = u.tanggal
+        ), upsert AS (
+            INSERT INTO curah_hujan (id_poshujan, tanggal, ch_mm, sumber_data)
+            SELECT id_poshujan, tanggal, ch_mm, %s
+            FROM stg_curah_hujan_unik
+            ON CONFLICT (id_poshujan, tanggal)
+            DO UPDATE SET
+                ch_mm       = EXCLUDED.ch_mm,
+                sumber_data = EXCLUDED.sumber_data,
+                created_at  = NOW()
+            WHERE curah_hujan.ch_mm IS DISTINCT FROM EXCLUDED.ch_mm
+            RETURNING id_poshujan, tanggal, ch_mm
+        )
+        SELECT u.id_poshujan, u.tanggal, u.ch_mm::float8, ada.id_poshujan IS NULL
+        FROM upsert u
+        LEFT JOIN ada
+          ON ada.id_poshujan = u.id_poshujan
+         AND ada.tanggal     = u.tanggal;
+    """, (SUMBER_UPLOAD,))
+    berubah, baru = frame_berubah(cur.fetchall())
+    tambah_waktu(waktu, "merge", t0)
+
+    # sidik bulan yang tersisa di staging dihitung ulang dari isi tabel
+    # (bulan di file bisa hanya sebagian dari bulan yang tersimpan)
+    t0 = time.perf_counter()
+    cur.execute(f"""
+        INSERT INTO sidik_ch (id_poshujan, bulan, jumlah, sidik)
+        SELECT t.id_poshujan, t.bulan, COUNT(*), {SQL_SIDIK_CH}
+        FROM stg_bulan_sisa t
+        JOIN curah_hujan c
+          ON c.id_poshujan = t.id_poshujan
+         AND c.tanggal >= t.bulan
+         AND c.tanggal < t.bulan + INTERVAL '1 month'
+        GROUP BY t.id_poshujan, t.bulan
+        ON CONFLICT (id_poshujan, bulan)
+        DO UPDATE SET
+            jumlah     = EXCLUDED.jumlah,
+            sidik      = EXCLUDED.sidik,
+            diperbarui = NOW()
+        WHERE sidik_ch.sidik IS DISTINCT FROM EXCLUDED.sidik;
+    """)
+    tambah_waktu(waktu, "sidik", t0)
+
+    jumlah = {
+        "baru": baru,
+        "diperbarui": len(berubah) - baru,
+        "tidak_berubah": n_unik - len(berubah),
+        "bulan_dilewati": bulan_dilewati,
+    }
+    return jumlah, berubah
+
+
+def muat_curah_hujan(cur, frame, engine, waktu):
+    """
+    Simpan frame ke curah_hujan.
+    Return (jumlah, berubah): hitungan baru/diperbarui/tidak_berubah dan
+    DataFrame baris yang benar-benar ditulis (untuk terkini/rekap/cache).
+    """
+    if frame.empty:
+        return {"baru": 0, "diperbarui": 0, "tidak_berubah": 0, "bulan_dilewati": 0}, frame
+
+    if engine == "values":
+        t0 = time.perf_counter()
+        hasil = muat_ch_values(cur, frame)
+        tambah_waktu(waktu, "merge", t0)
+        return hasil
+
+    return muat_ch_copy(cur, frame, waktu)
+
+
+def rebuild_sidik_ch(cur):
+    """Hitung ulang sidik semua (pos, bulan) dari curah_hujan."""
+    cur.execute(DDL_SIDIK_CH)
+    cur.execute("TRUNCATE sidik_ch")
+    cur.execute(f"""
+        INSERT INTO sidik_ch (id_poshujan, bulan, jumlah, sidik)
+        SELECT id_poshujan, date_trunc('month', tanggal)::date, COUNT(*), {SQL_SIDIK_CH}
+        FROM curah_hujan
+        GROUP BY 1, 2
+    """)
+    return cur.rowcount
+
+
+@app.cli.command("rebuild-sidik-ch")
+def rebuild_sidik_ch_command():
+    """Isi ulang sidik_ch (sidik isi per pos per bulan) dari seluruh curah_hujan."""
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        t0 = time.perf_counter()
+        n = rebuild_sidik_ch(cur)
+        conn.commit()
+    finally:
+        cur.close()
+    click.echo(f"sidik_ch: {n} (pos, bulan) diisi ulang ({time.perf_counter() - t0:.2f} detik)")
+
+
+def bersihkan_ch(df):
+    """
+    Cari kolom pos / tanggal / curah hujan, lalu bersihkan nilainya.
+    Hasilnya DataFrame dengan kolom pos_hujan, tanggal (datetime64),
+    curah_hujan (float). ValueError kalau kolom wajib tidak ada.
+    """
+    # Normalisasi nama kolom
+    df.columns = df.columns.str.strip().str.lower().str.replace(" ", "_")
+
+    # nama kolom versi file ekspor BMKG: NAME, DATA TIMESTAMP, RAINFALL DAY MM
+    col_pos = next((c for c in ["pos_hujan", "pos", "stasiun", "name"] if c in df.columns), None)
+    col_tgl = next((c for c in ["tanggal", "tgl", "date", "data_timestamp"] if c in df.columns), None)
+    col_ch  = next((c for c in ["curah_hujan", "ch", "ch_mm", "hujan", "rainfall_day_mm"] if c in df.columns), None)
+
+    if not col_pos or not col_tgl or not col_ch:
+        raise ValueError("Kolom wajib (Pos Hujan, Tanggal, Curah Hujan) tidak ditemukan di file.")
+
+    df_use = df[[col_pos, col_tgl, col_ch]].copy()
+    df_use.columns = ["pos_hujan", "tanggal", "curah_hujan"]
+
+    tanggal = pd.to_datetime(df_use["tanggal"], errors="coerce")
+    if getattr(tanggal.dt, "tz", None) is not None:
+        # "2025-01-01 00:00:00.0 +0:00" -> cukup tanggalnya
+        tanggal = tanggal.dt.tz_localize(None)
+    df_use["tanggal"] = tanggal.dt.normalize()
+    df_use["curah_hujan"] = pd.to_numeric(df_use["curah_hujan"], errors="coerce")
+
+    df_use["curah_hujan"] = bersihkan_nilai_ch(df_use["curah_hujan"])
+
+    return df_use
+
+
+def bersihkan_nilai_ch(ch):
+    """Kode 8888 / 9999 dan nilai negatif -> NaN."""
+    return ch.mask(ch.isin([8888, 9999]) | (ch < 0))
+
+
+def siapkan_baris_ch(df_use, mapping):
+    """
+    Cocokkan nama pos ke id_poshujan secara kolom (tanpa loop per baris).
+
+    mapping: Series index = nama pos ternormalisasi (normalisasi_nama_pos),
+    nilai = id_poshujan (lihat RegistryPos.mapping_nama).
+    Return (frame, pos_tidak_ditemukan). frame berisi kolom
+    id_poshujan, tanggal, ch_mm dan siap dimuat oleh muat_curah_hujan.
+    """
+    valid = df_use["tanggal"].notna() & df_use["curah_hujan"].notna()
+    df_valid = df_use.loc[valid]
+
+    # Nama pos biasanya hanya ratusan nilai unik dari puluhan ribu baris,
+    # jadi normalisasi dikerjakan pada kategori, bukan per baris.
+    nama = df_valid["pos_hujan"].astype(str).astype("category")
+    kategori = nama.cat.categories.str.strip()
+    id_per_kategori = pd.Series(kategori.map(normalisasi_nama_pos), dtype=object).map(mapping).to_numpy()
+
+    kode = nama.cat.codes.to_numpy()
+    id_pos = id_per_kategori[kode]
+    cocok = pd.notna(id_pos)
+
+    tidak_cocok = np.unique(kode[~cocok])
+    gagal_pos = sorted(set(kategori[tidak_cocok]))
+
+    frame = pd.DataFrame({
+        "id_poshujan": id_pos[cocok].astype(np.int64),
+        "tanggal": df_valid["tanggal"].to_numpy()[cocok],
+        "ch_mm": df_valid["curah_hujan"].to_numpy(dtype=np.float64)[cocok],
+    })
+    return frame, gagal_pos
+
+
+def tambah_waktu(waktu, kunci, t0):
+    waktu[kunci] = waktu.get(kunci, 0.0) + (time.perf_counter() - t0)
+
+
+def ringkas_waktu(waktu):
+    return {k: round(v * 1000, 1) for k, v in waktu.items()}
+
+
+# ============================================================
+# UPLOAD BERTAHAP (STREAMING PER POTONGAN)
+# ============================================================
+# File besar dibaca per potongan (chunk) supaya memori worker tetap datar:
+# - CSV  : pd.read_csv(chunksize=...)
+# - XLSX : openpyxl read-only, baris dibaca satu per satu
+# Setiap potongan dibersihkan, dicocokkan dan dimuat sendiri-sendiri.
+#
+# - INGEST_CHUNK_ROWS      : jumlah baris per potongan
+# - INGEST_STREAM_MIN_MB   : file lebih besar dari ini otomatis dibaca bertahap
+# - INGEST_COMMIT_PER      : "transaksi" (satu commit di akhir) atau
+#                            "potongan" (commit tiap potongan)
+INGEST_CHUNK_ROWS = int(os.getenv("INGEST_CHUNK_ROWS", "50000"))
+INGEST_STREAM_MIN_MB = float(os.getenv("INGEST_STREAM_MIN_MB", "20"))
+INGEST_COMMIT_PER = os.getenv("INGEST_COMMIT_PER", "transaksi")
+INGEST_COMMIT_MODES = ("transaksi", "potongan")
+
+
+def baca_file_bertahap(file, filename, ukuran):
+    """Generator DataFrame per potongan <= ukuran baris."""
+    if filename.endswith(".csv"):
+        yield from pd.read_csv(file, chunksize=ukuran)
+        return
+
+    if not filename.endswith((".xlsx", ".xlsm")):
+        # .xls lama tidak didukung openpyxl -> baca sekaligus
+        yield pd.read_excel(file)
+        return
+
+    wb = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        baris = wb.active.iter_rows(values_only=True)
+        header = next(baris, None)
+        if header is None:
+            return
+        kolom = [str(h) if h is not None else "" for h in header]
+
+        while True:
+            isi = list(itertools.islice(baris, ukuran))
+            if not isi:
+                break
+            yield pd.DataFrame(isi, columns=kolom)
+    finally:
+        wb.close()
+
+
+def baca_file_sekaligus(file, filename):
+    if filename.endswith(".csv"):
+        yield pd.read_csv(file)
+    else:
+        yield pd.read_excel(file)
+
+
+def hapus_cache_ch(pos_tersentuh, terkini_berubah, tanggal_tersentuh=()):
+    tags = [f"pos:{i}" for i in pos_tersentuh]
+    # grid interpolasi per tanggal & per bulan yang kena upload
+    tags += [f"tanggal:{t}" for t in tanggal_tersentuh]
+    tags += sorted({f"bulan:{t[:7]}" for t in tanggal_tersentuh})
+    if tanggal_tersentuh:
+        tags += ["rekap", "iklim", "qc"]
+    if terkini_berubah:
+        tags.append("pos_hujan")
+    if tags:
+        hapus_cache(tags)
+
+
+def qc_sebelum_commit(cur, sel_qc, pos_tersentuh, tanggal_tersentuh, waktu):
+    """
+    Flag QC di sekitar sel yang berubah sejak commit terakhir (sel_qc:
+    list pasangan array id_poshujan / hari, dikosongkan); rekap sel yang
+    flag-nya berubah dihitung ulang dan ikut dihapus dari cache.
+    Return jumlah flag yang berubah.
+    """
+    if not sel_qc:
+        return 0
+    t0 = time.perf_counter()
+    sel = (np.concatenate([s[0] for s in sel_qc]), np.concatenate([s[1] for s in sel_qc]))
+    sel_qc.clear()
+    ubah, _ = jalankan_qc(cur, sel)
+    tambah_waktu(waktu, "qc", t0)
+    if ubah.empty:
+        return 0
+
+    t0 = time.perf_counter()
+    perbarui_rekap(cur, ubah)
+    tambah_waktu(waktu, "rekap", t0)
+    pos_tersentuh.update(ubah["id_poshujan"].unique().tolist())
+    tanggal_tersentuh.update(ubah["tanggal"].drop_duplicates().dt.strftime("%Y-%m-%d").tolist())
+    return len(ubah)
+
+
+def proses_upload_ch(conn, potongan, engine, commit_per="transaksi", id_progres=None,
+                     parser="generik"):
+    """
+    Muat curah hujan dari iterator DataFrame (satu atau banyak potongan)
+    hasil baca parser `parser` (lihat PARSER_CH). Mapping pos diambil
+    sekali, lalu setiap potongan dibersihkan, dicocokkan dan dimuat.
+    ValueError kalau kolom wajib tidak ada.
+    """
+    bersihkan = PARSER_CH[parser][2]
+    mulai = time.perf_counter()
+    waktu = {}
+    jumlah = {"baru": 0, "diperbarui": 0, "tidak_berubah": 0, "bulan_dilewati": 0, "qc_berubah": 0}
+    gagal_pos = set()
+    n_dibaca = n_disimpan = n_potongan = 0
+
+    # pos yang tersentuh tapi cache-nya belum dihapus (menunggu commit)
+    pos_tersentuh = set()
+    tanggal_tersentuh = set()
+    terkini_berubah = False
+    # sel yang berubah, menunggu diperiksa QC sebelum commit
+    sel_qc = []
+
+    cur = conn.cursor()
+    try:
+        t0 = time.perf_counter()
+        registry = registry_pos()
+        mapping = registry.mapping_nama()
+        tambah_waktu(waktu, "mapping", t0)
+
+        while True:
+            t0 = time.perf_counter()
+            df = next(potongan, None)
+            tambah_waktu(waktu, "baca", t0)
+            if df is None:
+                break
+
+            t0 = time.perf_counter()
+            df_use = bersihkan(df)
+            n_dibaca += len(df)
+            del df
+            tambah_waktu(waktu, "bersih", t0)
+
+            t0 = time.perf_counter()
+            frame, gagal = siapkan_baris_ch(df_use, mapping)
+            gagal_pos.update(gagal)
+            del df_use
+            tambah_waktu(waktu, "mapping", t0)
+
+            jumlah_potongan, berubah = muat_curah_hujan(cur, frame, engine, waktu)
+
+            # turunan (terkini, rekap, cache) cukup dari baris yang berubah
+            t0 = time.perf_counter()
+            terkini_berubah |= perbarui_terkini(cur, berubah) > 0
+            tambah_waktu(waktu, "terkini", t0)
+
+            t0 = time.perf_counter()
+            perbarui_rekap(cur, berubah)
+            tambah_waktu(waktu, "rekap", t0)
+            pos_tersentuh.update(berubah["id_poshujan"].unique().tolist())
+            tanggal_tersentuh.update(
+                berubah["tanggal"].drop_duplicates().dt.strftime("%Y-%m-%d").tolist()
+            )
+            sel_qc.append((
+                berubah["id_poshujan"].to_numpy(dtype=np.int64),
+                berubah["tanggal"].to_numpy().astype("datetime64[D]").astype(np.int64),
+            ))
+            for k, v in jumlah_potongan.items():
+                jumlah[k] = None if v is None or jumlah[k] is None else jumlah[k] + v
+            n_disimpan += len(frame)
+            n_potongan += 1
+
+            if commit_per == "potongan":
+                jumlah["qc_berubah"] += qc_sebelum_commit(cur, sel_qc, pos_tersentuh, tanggal_tersentuh, waktu)
+                t0 = time.perf_counter()
+                conn.commit()
+                tambah_waktu(waktu, "commit", t0)
+                hapus_cache_ch(pos_tersentuh, terkini_berubah, tanggal_tersentuh)
+                pos_tersentuh, tanggal_tersentuh, terkini_berubah = set(), set(), False
+
+            if id_progres:
+                simpan_status(id_progres, state="berjalan", baris_dibaca=n_dibaca,
+                              baris_disimpan=n_disimpan, potongan=n_potongan)
+
+        jumlah["qc_berubah"] += qc_sebelum_commit(cur, sel_qc, pos_tersentuh, tanggal_tersentuh, waktu)
+        t0 = time.perf_counter()
+        conn.commit()
+        tambah_waktu(waktu, "commit", t0)
+        hapus_cache_ch(pos_tersentuh, terkini_berubah, tanggal_tersentuh)
+
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+    total = time.perf_counter() - mulai
+    catat_waktu_ingest("curah_hujan", waktu, n_disimpan, total)
+
+    return {
+        "engine": engine,
+        "parser": parser,
+        "commit_per": commit_per,
+        "potongan": n_potongan,
+        "baris_dibaca": n_dibaca,
+        "jumlah_baris": n_disimpan,
+        "jumlah": jumlah,
+        "pos_tidak_ditemukan": sorted(gagal_pos),
+        # nama terdaftar yang mirip, untuk memperbaiki file / metadata
+        "saran_pos": registry.saran_banyak(sorted(gagal_pos)),
+        "waktu_ms": ringkas_waktu(waktu),
+        "baris_per_detik": round(n_disimpan / total, 1) if total > 0 else None,
+    }
+
+
+# ============================================================
+# PARSER FILE CURAH HUJAN (DIPILIH DARI HEADER)
+# ============================================================
+# Setiap parser: (cocok(header), baca(file, filename, ukuran), bersihkan(df)).
+# Baris pertama file CSV dibaca dulu, lalu parser pertama yang cocok
+# dipakai; "generik" (pencocok nama kolom + pd.to_datetime) selalu jadi
+# cadangan. Bisa dipaksa lewat field form "parser".
+# - "bmkg": file ekspor BMKG (NAME,DATA TIMESTAMP,RAINFALL DAY MM).
+#   Hanya 3 kolom itu yang dibaca, dengan dtype tetap; tanggal
+#   "2025-01-01 00:00:00.0 +0:00" cukup 10 karakter pertama yang diparse
+#   dengan format tetap (tanpa tebak format per elemen). Pakai pyarrow.csv
+#   kalau terpasang (juga untuk baca bertahap), selain itu pandas engine C.
+# Benchmark: flask --app app bench-parser
+KOLOM_BERSIH_CH = ["pos_hujan", "tanggal", "curah_hujan"]
+
+
+def baca_header_csv(file, filename):
+    """Kolom baris pertama file CSV (None untuk Excel); posisi file tidak berubah."""
+    if not filename.endswith(".csv"):
+        return None
+    awal = file.tell()
+    baris = file.readline()
+    file.seek(awal)
+    if isinstance(baris, bytes):
+        baris = baris.decode("utf-8", errors="replace")
+    return next(csv.reader([baris.lstrip("\ufeff")]), None)
+
+
+def cocok_bmkg(header):
+    return header is not None and [h.strip().upper() for h in header[:3]] == KOLOM_EKSPOR_BMKG
+
+
+def _baca_bmkg_arrow(file, header, ukuran):
+    kolom = header[:3]
+    tipe = dict(zip(kolom, [pyarrow.string(), pyarrow.string(), pyarrow.float64()]))
+    opsi_baca = pyarrow.csv.ReadOptions(
+        # kira-kira 40 byte per baris
+        block_size=max(ukuran * 40, 1 << 20) if ukuran else 1 << 26,
+    )
+    opsi_konversi = pyarrow.csv.ConvertOptions(column_types=tipe, include_columns=kolom)
+    pembaca = pyarrow.csv.open_csv(
+        getattr(file, "stream", file), read_options=opsi_baca, convert_options=opsi_konversi
+    )
+
+    def ke_frame(tabel):
+        tanggal = pyarrow.compute.strptime(
+            pyarrow.compute.utf8_slice_codeunits(tabel.column(1), 0, 10),
+            format="%Y-%m-%d", unit="us", error_is_null=True,
+        )
+        return pd.DataFrame({
+            "pos_hujan": tabel.column(0).to_pandas(),
+            "tanggal": tanggal.to_pandas(),
+            "curah_hujan": tabel.column(2).to_pandas(),
+        })
+
+    if not ukuran:
+        yield ke_frame(pembaca.read_all())
+        return
+    for batch in pembaca:
+        yield ke_frame(pyarrow.Table.from_batches([batch]))
+
+
+def _baca_bmkg_pandas(file, ukuran, tipe_ch=np.float64):
+    opsi = dict(
+        header=0, names=KOLOM_BERSIH_CH, usecols=[0, 1, 2],
+        # tanggal sebagai category: tiap hari unik cukup diparse sekali
+        dtype={"pos_hujan": str, "tanggal": "category", "curah_hujan": tipe_ch},
+    )
+    if ukuran:
+        yield from pd.read_csv(file, chunksize=ukuran, **opsi)
+    else:
+        yield pd.read_csv(file, **opsi)
+
+
+def baca_csv_bmkg(file, filename, ukuran=None, pakai_arrow=None):
+    """Generator DataFrame (pos_hujan, tanggal, curah_hujan) dari file ekspor BMKG."""
+    if pakai_arrow is None:
+        pakai_arrow = pyarrow is not None
+    awal = file.tell()
+    header = baca_header_csv(file, filename)
+
+    potongan = _baca_bmkg_arrow(file, header, ukuran) if pakai_arrow else _baca_bmkg_pandas(file, ukuran)
+    n_dibaca = 0
+    try:
+        for df in potongan:
+            n_dibaca += len(df)
+            yield df
+        return
+    except ValueError:  # termasuk pyarrow.ArrowInvalid
+        pass
+
+    # ada CH yang bukan angka di potongan mana pun: sisa file dibaca ulang
+    # sebagai teks, dibersihkan (to_numeric errors="coerce") oleh
+    # bersihkan_ch_bmkg. Baris yang sudah dikirim dilewati.
+    file.seek(awal)
+    try:
+        for df in _baca_bmkg_pandas(file, ukuran, tipe_ch=str):
+            if n_dibaca >= len(df):
+                n_dibaca -= len(df)
+                continue
+            if n_dibaca:
+                df = df.iloc[n_dibaca:].copy()
+                n_dibaca = 0
+            yield df
+    except ValueError as e:
+        raise ValueError(f"Format file BMKG tidak valid: {e}") from None
+
+
+def bersihkan_ch_bmkg(df):
+    """Pasangan baca_csv_bmkg: tanggal format tetap & kode CH 8888/9999."""
+    df.columns = KOLOM_BERSIH_CH
+    tanggal = df["tanggal"]
+    if isinstance(tanggal.dtype, pd.CategoricalDtype):
+        hari = pd.to_datetime(
+            tanggal.cat.categories.str.slice(0, 10), format="%Y-%m-%d", errors="coerce"
+        )
+        # kode -1 (kosong) -> NaT lewat posisi tambahan di akhir
+        hari = hari.append(pd.DatetimeIndex([pd.NaT], dtype=hari.dtype))
+        df["tanggal"] = hari.take(tanggal.cat.codes.to_numpy())
+    elif not pd.api.types.is_datetime64_any_dtype(tanggal):
+        df["tanggal"] = pd.to_datetime(
+            tanggal.str.slice(0, 10), format="%Y-%m-%d", errors="coerce"
+        )
+    if not pd.api.types.is_float_dtype(df["curah_hujan"]):
+        df["curah_hujan"] = pd.to_numeric(df["curah_hujan"], errors="coerce")
+    df["curah_hujan"] = bersihkan_nilai_ch(df["curah_hujan"])
+    return df
+
+
+def baca_file_generik(file, filename, ukuran=None):
+    if ukuran:
+        return baca_file_bertahap(file, filename, ukuran)
+    return baca_file_sekaligus(file, filename)
+
+
+PARSER_CH = {
+    # nama: (cocok(header), baca(file, filename, ukuran), bersihkan(df))
+    "bmkg": (cocok_bmkg, baca_csv_bmkg, bersihkan_ch_bmkg),
+    "generik": (lambda header: True, baca_file_generik, bersihkan_ch),
+}
+
+
+def pilih_parser_ch(file, filename):
+    header = baca_header_csv(file, filename)
+    return next(nama for nama, (cocok, _, _) in PARSER_CH.items() if cocok(header))
+
+
+# ============================================================
+# UPLOAD DATA CURAH HUJAN (EXCEL / CSV) — versi cepat (batch)
+# ============================================================
+@app.route("/upload_curah_hujan", methods=["POST"])
+def upload_curah_hujan():
+    # pastikan login dulu
+    ensure_logged_in_api()
+
+    if "file" not in request.files:
+        return jsonify({"status": "error", "message": "File tidak ditemukan di request!"})
+
+    file = request.files["file"]
+    if file.filename == "":
+        return jsonify({"status": "error", "message": "Tidak ada file yang dipilih!"})
+
+    engine = (request.form.get("engine") or request.args.get("engine") or INGEST_ENGINE).lower()
+    if engine not in INGEST_ENGINES:
+        return jsonify({
+            "status": "error",
+            "message": f"Engine '{engine}' tidak dikenal (pilihan: {', '.join(INGEST_ENGINES)})."
+        })
+
+    commit_per = (request.form.get("commit_per") or INGEST_COMMIT_PER).lower()
+    if commit_per not in INGEST_COMMIT_MODES:
+        return jsonify({
+            "status": "error",
+            "message": f"commit_per '{commit_per}' tidak dikenal (pilihan: {', '.join(INGEST_COMMIT_MODES)})."
+        })
+
+    parser = (request.form.get("parser") or "").lower() or None
+    if parser is not None and parser not in PARSER_CH:
+        return jsonify({
+            "status": "error",
+            "message": f"parser '{parser}' tidak dikenal (pilihan: {', '.join(PARSER_CH)})."
+        })
+
+    if INGEST_JOB_WORKERS > 0:
+        return kirim_job("curah_hujan", file, {"engine": engine, "commit_per": commit_per, "parser": parser})
+
+    # id dari halaman upload, dipakai untuk polling /api/upload_progress/<id>
+    id_progres = (request.form.get("upload_id") or "").strip()[:64] or None
+
+    filename = file.filename.lower()
+
+    bertahap = request.form.get("stream", "").lower() in ("1", "true", "ya")
+    if (request.content_length or 0) > INGEST_STREAM_MIN_MB * 1024 * 1024:
+        bertahap = True
+
+    if id_progres:
+        simpan_status(id_progres, state="berjalan", baris_dibaca=0, baris_disimpan=0, potongan=0)
+
+    try:
+        parser = parser or pilih_parser_ch(file, filename)
+        potongan = PARSER_CH[parser][1](file, filename, INGEST_CHUNK_ROWS if bertahap else None)
+        hasil = proses_upload_ch(get_db(), potongan, engine, commit_per, id_progres, parser)
+    except ValueError as e:
+        pesan = str(e)
+    except (pd.errors.ParserError, UnicodeDecodeError, zipfile.BadZipFile, OSError) as e:
+        pesan = f"Gagal membaca file (Excel/CSV): {e}"
+    except Exception as e:
+        pesan = f"Error saat simpan curah hujan: {e}"
+    else:
+        pesan = None
+
+    if pesan is not None:
+        if id_progres:
+            simpan_status(id_progres, state="gagal", message=pesan)
+        return jsonify({"status": "error", "message": pesan})
+
+    hasil["status"] = "success"
+    hasil["mode"] = "bertahap" if bertahap else "sekaligus"
+    if hasil["pos_tidak_ditemukan"]:
+        hasil["message"] = "Sebagian besar data curah hujan tersimpan. Namun beberapa Pos Hujan tidak ditemukan di metadata."
+    else:
+        del hasil["pos_tidak_ditemukan"]
+        del hasil["saran_pos"]
+        hasil["message"] = "Semua data curah hujan berhasil disimpan."
+
+    if id_progres:
+        simpan_status(id_progres, state="selesai", baris_dibaca=hasil["baris_dibaca"],
+                      baris_disimpan=hasil["jumlah_baris"], potongan=hasil["potongan"])
+
+    return jsonify(hasil)
+
+
+@app.route("/api/upload_progress/<upload_id>")
+def api_upload_progress(upload_id):
+    ensure_logged_in_api()
+
+    status = baca_status(upload_id)
+    if status is None:
+        return jsonify({"status": "error", "message": "Upload tidak ditemukan"}), 404
+    return jsonify({"status": "success", "upload_id": upload_id, **status})
+
+
+# ============================================================
+# ANTRIAN JOB UPLOAD (DIPROSES DI BELAKANG LAYAR)
+# ============================================================
+# Upload diterima, file disimpan dulu ke disk (spool), lalu diproses oleh
+# pool proses lokal. Worker web langsung bebas lagi dan tidak kena timeout
+# gunicorn; halaman upload cukup polling /api/jobs/<id>.
+#
+# - INGEST_JOB_WORKERS : jumlah proses pengolah per worker web. Default 0 =
+#                        proses langsung di dalam request (cara lama).
+#                        Pool dibuat per worker web, jadi total proses =
+#                        worker gunicorn x INGEST_JOB_WORKERS, masing-masing
+#                        memegang satu koneksi DB selama job berjalan:
+#                        sesuaikan dengan max_connections PostgreSQL.
+# - JOB_SPOOL_DIR      : folder sementara untuk file yang menunggu diproses
+# - JOB_SPOOL_SIMPAN_DETIK : file spool yang lebih tua dari ini (job yang
+#                        tidak pernah jalan, mis. proses pengolah mati atau
+#                        server restart) dibuang setiap ada job baru
+INGEST_JOB_WORKERS = int(os.getenv("INGEST_JOB_WORKERS", "0"))
+JOB_SPOOL_DIR = os.getenv(
+    "JOB_SPOOL_DIR",
+    os.path.join(tempfile.gettempdir(), "webgis_poshujan_jobs")
+)
+JOB_SPOOL_SIMPAN_DETIK = float(os.getenv("JOB_SPOOL_SIMPAN_DETIK", str(STATUS_SIMPAN_DETIK)))
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            # "spawn": proses anak mulai bersih, tidak mewarisi koneksi DB
+            # atau thread milik worker web
+            _executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=INGEST_JOB_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def reset_executor():
+    global _executor
+    with _executor_lock:
+        _executor = None
+
+
+def bersihkan_spool():
+    """Buang file spool lama yang tidak pernah diproses; job-nya ditandai gagal."""
+    batas = time.time() - JOB_SPOOL_SIMPAN_DETIK
+    for entri in os.scandir(JOB_SPOOL_DIR):
+        try:
+            if not entri.is_file() or entri.stat().st_mtime >= batas:
+                continue
+            os.remove(entri.path)
+        except OSError:
+            continue
+        job_id = os.path.splitext(entri.name)[0]
+        status = baca_status(job_id)
+        if status is not None and status.get("state") in ("antri", "berjalan"):
+            simpan_status(job_id, state="gagal", selesai=time.time(),
+                          message="Job tidak selesai diproses (file antrian kedaluwarsa)")
+
+
+def kirim_job(jenis, file, opsi=None):
+    job_id = uuid.uuid4().hex
+    os.makedirs(JOB_SPOOL_DIR, exist_ok=True)
+    bersihkan_spool()
+    ext = os.path.splitext(file.filename)[1].lower()
+    path = os.path.join(JOB_SPOOL_DIR, job_id + ext)
+    try:
+        file.save(path)
+        simpan_status(
+            job_id,
+            state="antri",
+            jenis=jenis,
+            filename=file.filename,
+            username=session.get("username"),
+            baris_dibaca=0,
+        )
+    except BaseException:
+        # file setengah tersimpan / job tidak tercatat -> jangan tertinggal
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        raise
+
+    args = (jalankan_job, job_id, jenis, path, file.filename, opsi or {})
+    try:
+        try:
+            get_executor().submit(*args)
+        except concurrent.futures.process.BrokenProcessPool:
+            # proses anak mati (mis. OOM) -> buat pool baru sekali lagi
+            reset_executor()
+            get_executor().submit(*args)
+    except Exception as e:
+        simpan_status(job_id, state="gagal", message=f"Gagal menjalankan job: {e}")
+        os.remove(path)
+        return jsonify({"status": "error", "message": f"Gagal menjalankan job: {e}"})
+
+    return jsonify({
+        "status": "success",
+        "job_id": job_id,
+        "state": "antri",
+        "message": "File diterima dan sedang diproses."
+    }), 202
+
+
+def jalankan_job(job_id, jenis, path, filename, opsi):
+    """Dijalankan di proses pengolah (bukan di worker web)."""
+    mulai = time.time()
+    simpan_status(job_id, state="berjalan", mulai=mulai)
+
+    try:
+        with app.app_context():
+            g.metrik_rute = f"job:{jenis}"
+            filename = filename.lower()
+            with open(path, "rb") as f:
+                if jenis == "curah_hujan":
+                    parser = opsi.get("parser") or pilih_parser_ch(f, filename)
+                    potongan = PARSER_CH[parser][1](f, filename, INGEST_CHUNK_ROWS)
+                    hasil = proses_upload_ch(
+                        get_db(), potongan,
+                        opsi.get("engine", INGEST_ENGINE),
+                        opsi.get("commit_per", INGEST_COMMIT_PER),
+                        id_progres=job_id,
+                        parser=parser,
+                    )
+                    if hasil["pos_tidak_ditemukan"]:
+                        hasil["message"] = "Sebagian besar data curah hujan tersimpan. Namun beberapa Pos Hujan tidak ditemukan di metadata."
+                    else:
+                        hasil["message"] = "Semua data curah hujan berhasil disimpan."
+                else:
+                    df = baca_file_metadata(f, filename)
+                    hasil = proses_upload_metadata(get_db(), df)
+                    hasil["baris_dibaca"] = len(df)
+
+        simpan_status(job_id, state="selesai", selesai=time.time(), **hasil)
+    except Exception as e:
+        simpan_status(job_id, state="gagal", selesai=time.time(), message=str(e))
+    finally:
+        simpan_metrik(paksa=True)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+@app.route("/api/jobs/<job_id>")
+def api_job(job_id):
+    ensure_logged_in_api()
+
+    status = baca_status(job_id)
+    if status is None or "jenis" not in status:
+        return jsonify({"status": "error", "message": "Job tidak ditemukan"}), 404
+
+    mulai = status.get("mulai")
+    if mulai:
+        akhir = status.get("selesai") or time.time()
+        lama = max(akhir - mulai, 1e-6)
+        status["durasi_detik"] = round(lama, 2)
+        status["baris_per_detik"] = round((status.get("baris_dibaca") or 0) / lama, 1)
+
+    return jsonify({"status": "success", "job_id": job_id, **status})
+
+
+# ============================================================
+# SKEMA DATABASE (BOOTSTRAP & MIGRASI)
+# ============================================================
+# Semua tabel dibuat / dimigrasikan lewat satu perintah yang aman
+# dijalankan berulang:
+#     flask --app app migrasi-db            (DB kosong maupun DB lama)
+#     flask --app app cek-db                (versi skema + rencana query)
+# Migrasi bernomor dicatat di skema_migrasi; yang sudah selesai dilewati.
+#
+# curah_hujan dipartisi RANGE per tahun (curah_hujan_2025, ...) plus
+# partisi default curah_hujan_lainnya untuk tanggal di luar rentang.
+# Primary key (id_poshujan, tanggal) INCLUDE (ch_mm, qc_flag): seri satu
+# pos & anti-join upload bisa index-only scan. Tambahan: BRIN tanggal
+# (filter per tanggal/bulan semua pos), LOWER(nama_pos), GiST geom.
+#
+# Tabel curah_hujan lama (belum berpartisi) disalin per batch
+# MIGRASI_BATCH_BARIS baris (urut primary key, commit tiap batch, bisa
+# dilanjutkan kalau terputus) ke curah_hujan_baru. Selama itu aplikasi
+# tetap membaca & menulis tabel lama; di akhir, baris yang ditulis sejak
+# migrasi mulai disalin ulang dan nama tabel ditukar dalam satu transaksi
+# singkat (tulis menunggu, baca jalan terus). Tabel lama disimpan sebagai
+# curah_hujan_lama (--hapus-lama untuk langsung membuangnya).
+# Upload untuk tahun yang partisinya belum ada masuk curah_hujan_lainnya;
+# migrasi-db berikutnya membuat partisi tahun itu dan memindahkan barisnya
+# (jalankan berkala, misalnya tiap awal tahun).
+# - MIGRASI_BATCH_BARIS     : baris per batch salin
+# - CH_PARTISI_TAHUN_DEPAN  : partisi disiapkan sampai tahun ini + N
+SKEMA_DB = "metadata_poshujan"
+MIGRASI_BATCH_BARIS = int(os.getenv("MIGRASI_BATCH_BARIS", "50000"))
+CH_PARTISI_TAHUN_DEPAN = int(os.getenv("CH_PARTISI_TAHUN_DEPAN", "1"))
+
+KOLOM_CH = "id_poshujan, tanggal, ch_mm, sumber_data, created_at, qc_flag"
+
+DDL_SKEMA_MIGRASI = f"""
+    CREATE SCHEMA IF NOT EXISTS {SKEMA_DB};
+    CREATE TABLE IF NOT EXISTS {SKEMA_DB}.skema_migrasi (
+        versi      integer PRIMARY KEY,
+        keterangan text    NOT NULL,
+        mulai      timestamptz NOT NULL DEFAULT NOW(),
+        selesai    timestamptz
+    );
+"""
+
+# pos_hujan.geom (diisi upload metadata, dipakai engine spasial
+# "postgis") butuh ekstensi PostGIS: migrasi-db berhenti kalau tidak ada.
+DDL_TABEL_DASAR = """
+    CREATE EXTENSION IF NOT EXISTS postgis WITH SCHEMA public;
+
+    CREATE TABLE IF NOT EXISTS provinsi (
+        id_provinsi   serial PRIMARY KEY,
+        nama_provinsi text UNIQUE
+    );
+
+    CREATE TABLE IF NOT EXISTS kabupaten (
+        id_kabupaten   serial PRIMARY KEY,
+        id_provinsi    integer REFERENCES provinsi (id_provinsi),
+        nama_kabupaten text,
+        UNIQUE (id_provinsi, nama_kabupaten)
+    );
+
+    CREATE TABLE IF NOT EXISTS pos_hujan (
+        id_poshujan  serial PRIMARY KEY,
+        kode_pos     text UNIQUE,
+        nama_pos     text,
+        balai        text,
+        kecamatan    text,
+        id_provinsi  integer,
+        id_kabupaten integer,
+        lintang_dd   double precision,
+        bujur_dd     double precision,
+        elevasi_m    integer,
+        geom         geometry(Point, 4326)
+    );
+
+    CREATE TABLE IF NOT EXISTS users (
+        id       serial PRIMARY KEY,
+        username text UNIQUE,
+        password text
+    );
+"""
+
+# {nama}: curah_hujan (DB baru) atau curah_hujan_baru (migrasi)
+DDL_CURAH_HUJAN = """
+    CREATE TABLE IF NOT EXISTS {nama} (
+        id_poshujan integer NOT NULL REFERENCES pos_hujan (id_poshujan),
+        tanggal     date    NOT NULL,
+        ch_mm       numeric,
+        sumber_data text,
+        created_at  timestamptz DEFAULT NOW(),
+        qc_flag     smallint NOT NULL DEFAULT 0,
+        CONSTRAINT {nama}_pkey PRIMARY KEY (id_poshujan, tanggal) INCLUDE (ch_mm, qc_flag)
+    ) PARTITION BY RANGE (tanggal);
+
+    CREATE TABLE IF NOT EXISTS curah_hujan_lainnya PARTITION OF {nama} DEFAULT;
+"""
+
+DDL_INDEKS_DB = """
+    CREATE INDEX IF NOT EXISTS curah_hujan_tanggal_brin
+        ON curah_hujan USING BRIN (tanggal);
+    CREATE INDEX IF NOT EXISTS pos_hujan_nama_lower
+        ON pos_hujan (LOWER(nama_pos));
+""" + DDL_INDEKS_SPASIAL
+
+
+def ada_tabel(cur, nama):
+    """relkind tabel di SKEMA_DB ('r' biasa, 'p' berpartisi) atau None."""
+    cur.execute("""
+        SELECT c.relkind
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %s AND c.relname = %s
+    """, (SKEMA_DB, nama))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def pastikan_partisi_ch(cur, tahun_awal=None, tahun_akhir=None):
+    """
+    Buat partisi tahunan curah_hujan yang belum ada untuk
+    [tahun_awal, tahun_akhir] (default: tahun ini .. + CH_PARTISI_TAHUN_DEPAN)
+    dan untuk tahun yang barisnya terlanjur masuk partisi default.
+    Baris itu dipindah dulu, lalu tabelnya di-attach.
+    Return daftar partisi yang dibuat.
+    """
+    tahun_ini = datetime.now().year
+    tahun_awal = tahun_ini if tahun_awal is None else tahun_awal
+    tahun_akhir = tahun_ini + CH_PARTISI_TAHUN_DEPAN if tahun_akhir is None else tahun_akhir
+
+    cur.execute("SELECT DISTINCT EXTRACT(YEAR FROM tanggal)::int FROM curah_hujan_lainnya")
+    di_default = {r[0] for r in cur.fetchall()}
+
+    dibuat = []
+    for tahun in sorted(set(range(tahun_awal, tahun_akhir + 1)) | di_default):
+        nama = f"curah_hujan_{tahun}"
+        if ada_tabel(cur, nama):
+            continue
+        batas = (f"{tahun}-01-01", f"{tahun + 1}-01-01")
+        if tahun in di_default:
+            cur.execute(f"""
+                CREATE TABLE {nama} (LIKE curah_hujan INCLUDING DEFAULTS);
+                WITH pindah AS (
+                    DELETE FROM curah_hujan_lainnya
+                    WHERE tanggal >= %s AND tanggal < %s
+                    RETURNING {KOLOM_CH}
+                )
+                INSERT INTO {nama} ({KOLOM_CH}) SELECT * FROM pindah;
+                ALTER TABLE curah_hujan ATTACH PARTITION {nama} FOR VALUES FROM (%s) TO (%s);
+            """, batas + batas)
+        else:
+            cur.execute(f"""
+                CREATE TABLE {nama} PARTITION OF curah_hujan FOR VALUES FROM (%s) TO (%s)
+            """, batas)
+        dibuat.append(nama)
+    return dibuat
+
+
+# Objek yang dibaca banyak route tapi ditambahkan setelah DB lama dibuat.
+# Dicek sekali per proses saat koneksi pertama diambil (get_db): kalau di
+# katalog belum ada, DDL-nya (idempoten) dijalankan, jadi DB lama yang
+# belum di-migrasi-db tidak membuat route 500. Cek katalog dulu supaya
+# ALTER TABLE (lock tabel) hanya jalan kalau memang kurang.
+# (nama, query "sudah ada?", DDL atau fungsi(cur) yang membuat + mengisi)
+SKEMA_LAZY = [
+    ("kolom curah_hujan.qc_flag & qc_ambang_ch", """
+        SELECT EXISTS (
+                   SELECT 1 FROM pg_attribute
+                   WHERE attrelid = to_regclass('curah_hujan')
+                     AND attname = 'qc_flag' AND NOT attisdropped)
+               AND to_regclass('qc_ambang_ch') IS NOT NULL
+    """, DDL_QC_CH),
+    # dibaca /api/pos_hujan & indeks spasial; langsung diisi dari curah_hujan
+    ("pos_hujan_terkini", "SELECT to_regclass('pos_hujan_terkini') IS NOT NULL", rebuild_terkini),
+]
+
+_skema_lazy = {"pid": None}
+_skema_lazy_lock = threading.Lock()
+
+
+def pastikan_skema_lazy(conn):
+    """
+    Jalankan SKEMA_LAZY sekali per proses. DB kosong (curah_hujan belum
+    ada) dilewati: itu tugas migrasi-db. Kalau gagal, dicatat di log dan
+    dicoba lagi di koneksi berikutnya.
+    """
+    if _skema_lazy["pid"] == os.getpid():
+        return
+    with _skema_lazy_lock:
+        if _skema_lazy["pid"] == os.getpid():
+            return
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT to_regclass('curah_hujan') IS NOT NULL")
+            if not cur.fetchone()[0]:
+                app.logger.warning("Tabel curah_hujan belum ada: jalankan flask --app app migrasi-db")
+            else:
+                for nama, sql_cek, ddl in SKEMA_LAZY:
+                    cur.execute(sql_cek)
+                    if not cur.fetchone()[0]:
+                        if callable(ddl):
+                            ddl(cur)
+                        else:
+                            cur.execute(ddl)
+                        app.logger.warning(f"Skema lama: {nama} dibuat")
+            conn.commit()
+        except psycopg2.Error as e:
+            conn.rollback()
+            app.logger.error(f"Gagal menyiapkan skema: {e}")
+            return
+        finally:
+            cur.close()
+        _skema_lazy["pid"] = os.getpid()
+
+
+def migrasi_tabel_dasar(conn, cur, echo):
+    cur.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'postgis'")
+    if cur.fetchone() is not None:
+        cur.execute(DDL_TABEL_DASAR)
+    elif ada_tabel(cur, "pos_hujan") is None:
+        raise click.ClickException(
+            "Ekstensi PostGIS tidak tersedia di server PostgreSQL ini "
+            "(dibutuhkan pos_hujan.geom). Pasang PostGIS lalu ulangi migrasi-db."
+        )
+    else:
+        # DB lama yang tabel dasarnya sudah ada: dipakai apa adanya
+        echo("  PostGIS tidak tersedia: tabel dasar yang sudah ada dipakai")
+
+    if ada_tabel(cur, "curah_hujan") is None:
+        cur.execute(DDL_CURAH_HUJAN.format(nama="curah_hujan"))
+        echo(f"  partisi: {', '.join(pastikan_partisi_ch(cur))}")
+
+
+def migrasi_tabel_turunan(conn, cur, echo):
+    for ddl in (DDL_POS_HUJAN_TERKINI, DDL_REKAP_CH, DDL_SIDIK_CH, DDL_QC_CH):
+        cur.execute(ddl)
+
+
+def migrasi_partisi_ch(conn, cur, echo, batch_baris=MIGRASI_BATCH_BARIS):
+    if ada_tabel(cur, "curah_hujan") == "p":
+        return
+
+    # awal migrasi = awal transaksi tertua yang masih jalan: baris yang
+    # ditulis transaksi itu (upload maupun perubahan qc_flag oleh
+    # jalankan_qc) punya created_at >= nilai ini
+    cur.execute("""
+        SELECT s.mulai, COALESCE(
+            (SELECT MIN(xact_start) FROM pg_stat_activity
+             WHERE datname = current_database() AND xact_start IS NOT NULL),
+            NOW())
+        FROM skema_migrasi s
+        WHERE s.versi = 3
+    """)
+    mulai = min(cur.fetchone())
+
+    cur.execute("""
+        SELECT EXTRACT(YEAR FROM MIN(tanggal))::int, EXTRACT(YEAR FROM MAX(tanggal))::int
+        FROM curah_hujan
+    """)
+    tahun_min, tahun_maks = cur.fetchone()
+    tahun_ini = datetime.now().year
+    tahun_awal = min(tahun_min or tahun_ini, tahun_ini)
+    tahun_akhir = max(tahun_maks or tahun_ini, tahun_ini) + CH_PARTISI_TAHUN_DEPAN
+
+    cur.execute(DDL_CURAH_HUJAN.format(nama="curah_hujan_baru"))
+    for tahun in range(tahun_awal, tahun_akhir + 1):
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS curah_hujan_{tahun}
+                PARTITION OF curah_hujan_baru FOR VALUES FROM (%s) TO (%s)
+        """, (f"{tahun}-01-01", f"{tahun + 1}-01-01"))
+    conn.commit()
+
+    # lanjut dari kunci terakhir yang sudah tersalin (kalau pernah terputus)
+    cur.execute("""
+        SELECT id_poshujan, tanggal FROM curah_hujan_baru
+        ORDER BY id_poshujan DESC, tanggal DESC LIMIT 1
+    """)
+    kunci = cur.fetchone() or (-1, datetime(1, 1, 1).date())
+    cur.execute("SELECT COUNT(*) FROM curah_hujan")
+    total = cur.fetchone()[0]
+    cur.execute("SELECT COUNT(*) FROM curah_hujan_baru")
+    disalin = cur.fetchone()[0]
+
+    t0 = time.perf_counter()
+    while True:
+        cur.execute(f"""
+            WITH batch AS (
+                SELECT {KOLOM_CH}
+                FROM curah_hujan
+                WHERE (id_poshujan, tanggal) > (%s, %s)
+                ORDER BY id_poshujan, tanggal
+                LIMIT %s
+            ), salin AS (
+                INSERT INTO curah_hujan_baru ({KOLOM_CH})
+                SELECT * FROM batch
+                ON CONFLICT DO NOTHING
+            )
+            SELECT COUNT(*), MAX(id_poshujan), MAX(tanggal) FILTER (
+                WHERE id_poshujan = (SELECT MAX(id_poshujan) FROM batch)
+            )
+            FROM batch
+        """, (kunci[0], kunci[1], batch_baris))
+        n, id_akhir, tanggal_akhir = cur.fetchone()
+        conn.commit()
+        if not n:
+            break
+        kunci = (id_akhir, tanggal_akhir)
+        disalin += n
+        echo(f"  disalin {disalin}/{total} baris ({time.perf_counter() - t0:.1f} detik)")
+
+    # tukar nama: tulis ke tabel lama ditahan sebentar, baca tetap jalan
+    cur.execute(f"""
+        LOCK TABLE curah_hujan IN EXCLUSIVE MODE;
+
+        INSERT INTO curah_hujan_baru ({KOLOM_CH})
+        SELECT {KOLOM_CH} FROM curah_hujan
+        WHERE created_at >= %s
+        ON CONFLICT (id_poshujan, tanggal)
+        DO UPDATE SET
+            ch_mm       = EXCLUDED.ch_mm,
+            sumber_data = EXCLUDED.sumber_data,
+            created_at  = EXCLUDED.created_at,
+            qc_flag     = EXCLUDED.qc_flag;
+    """, (mulai,))
+    echo(f"  {cur.rowcount} baris yang ditulis selama migrasi disalin ulang")
+    cur.execute("""
+        ALTER TABLE curah_hujan RENAME TO curah_hujan_lama;
+        ALTER TABLE curah_hujan_lama RENAME CONSTRAINT curah_hujan_pkey TO curah_hujan_lama_pkey;
+        ALTER TABLE curah_hujan_baru RENAME TO curah_hujan;
+        ALTER TABLE curah_hujan RENAME CONSTRAINT curah_hujan_baru_pkey TO curah_hujan_pkey;
+        ANALYZE curah_hujan;
+    """)
+
+
+def migrasi_indeks(conn, cur, echo):
+    cur.execute(DDL_INDEKS_DB)
+    cur.execute("ANALYZE pos_hujan")
+
+
+# versi -> (keterangan, fungsi(conn, cur, echo)); urutan = urutan jalan
+MIGRASI_DB = {
+    1: ("tabel dasar (provinsi, kabupaten, pos_hujan, users, curah_hujan)", migrasi_tabel_dasar),
+    2: ("tabel turunan (terkini, rekap, sidik, qc)", migrasi_tabel_turunan),
+    3: ("curah_hujan berpartisi per tahun", migrasi_partisi_ch),
+    4: ("indeks (BRIN tanggal, LOWER(nama_pos), GiST geom)", migrasi_indeks),
+}
+
+
+@app.cli.command("migrasi-db")
+@click.option("--batch-baris", default=MIGRASI_BATCH_BARIS, show_default=True,
+              help="Baris per batch saat menyalin curah_hujan ke tabel berpartisi.")
+@click.option("--hapus-lama", is_flag=True, help="Buang curah_hujan_lama setelah migrasi.")
+def migrasi_db_command(batch_baris, hapus_lama):
+    """Buat / migrasikan skema database ke versi terbaru (aman diulang)."""
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        cur.execute(DDL_SKEMA_MIGRASI)
+        cur.execute("SELECT versi FROM skema_migrasi WHERE selesai IS NOT NULL")
+        selesai = {r[0] for r in cur.fetchall()}
+        conn.commit()
+
+        for versi, (keterangan, fungsi) in MIGRASI_DB.items():
+            if versi in selesai:
+                continue
+            click.echo(f"[{versi}] {keterangan}")
+            t0 = time.perf_counter()
+            cur.execute("""
+                INSERT INTO skema_migrasi (versi, keterangan) VALUES (%s, %s)
+                ON CONFLICT (versi) DO NOTHING
+            """, (versi, keterangan))
+            conn.commit()
+            if fungsi is migrasi_partisi_ch:
+                fungsi(conn, cur, click.echo, batch_baris)
+            else:
+                fungsi(conn, cur, click.echo)
+            cur.execute("UPDATE skema_migrasi SET selesai = NOW() WHERE versi = %s", (versi,))
+            conn.commit()
+            click.echo(f"    selesai ({time.perf_counter() - t0:.2f} detik)")
+
+        dibuat = pastikan_partisi_ch(cur)
+        if hapus_lama and ada_tabel(cur, "curah_hujan_lama"):
+            cur.execute("DROP TABLE curah_hujan_lama")
+            click.echo("curah_hujan_lama dibuang")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    if dibuat:
+        click.echo(f"partisi baru: {', '.join(dibuat)}")
+    naikkan_versi_pos()
+    hapus_cache()
+    click.echo(f"skema versi {max(MIGRASI_DB)}")
+
+
+# Pola query utama aplikasi -> harus memakai indeks (dicek oleh cek-db).
+# Parameter diisi contoh dari data yang ada.
+CEK_QUERY_DB = {
+    "seri satu pos": """
+        SELECT tanggal, ch_mm FROM curah_hujan
+        WHERE id_poshujan = %(id)s AND ch_mm IS NOT NULL AND (qc_flag & %(qc)s) = 0
+        ORDER BY tanggal
+    """,
+    "seri satu pos, satu tahun": """
+        SELECT tanggal, ch_mm FROM curah_hujan
+        WHERE id_poshujan = %(id)s AND ch_mm IS NOT NULL AND (qc_flag & %(qc)s) = 0
+          AND tanggal >= %(awal)s AND tanggal < %(awal)s::date + 365
+        ORDER BY tanggal
+    """,
+    "tanggal terakhir per pos": """
+        SELECT id_poshujan, MAX(tanggal) FROM curah_hujan
+        WHERE id_poshujan = ANY(%(ids)s) GROUP BY id_poshujan
+    """,
+    "semua pos satu tanggal": """
+        SELECT id_poshujan, ch_mm FROM curah_hujan WHERE tanggal = %(awal)s
+    """,
+    "cari pos per nama": """
+        SELECT id_poshujan FROM pos_hujan WHERE LOWER(nama_pos) = LOWER(%(nama)s)
+    """,
+}
+
+
+def node_rencana(rencana):
+    """Semua (node type, nama indeks) di rencana EXPLAIN (FORMAT JSON)."""
+    hasil = [(rencana["Node Type"], rencana.get("Index Name"))]
+    for anak in rencana.get("Plans", []):
+        hasil += node_rencana(anak)
+    return hasil
+
+
+@app.cli.command("cek-db")
+def cek_db_command():
+    """Tampilkan versi skema, partisi, dan rencana query utama (pakai indeks atau tidak)."""
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT to_regclass('skema_migrasi')")
+        if cur.fetchone()[0] is None:
+            click.echo("skema_migrasi belum ada: jalankan flask --app app migrasi-db")
+            return
+        cur.execute("SELECT versi, selesai FROM skema_migrasi")
+        status = dict(cur.fetchall())
+        for versi, (keterangan, _) in MIGRASI_DB.items():
+            click.echo(f"[{versi}] {'ok   ' if status.get(versi) else 'BELUM'} {keterangan}")
+
+        cur.execute("""
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), c.reltuples::bigint
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass('curah_hujan')
+            ORDER BY c.relname
+        """)
+        partisi = cur.fetchall()
+        click.echo(f"partisi curah_hujan: {len(partisi)}")
+        for nama, batas, baris in partisi:
+            click.echo(f"  {nama:<22} {batas}  (~{max(baris, 0)} baris)")
+
+        cur.execute("""
+            SELECT id_poshujan, nama_pos FROM pos_hujan
+            WHERE nama_pos IS NOT NULL ORDER BY id_poshujan LIMIT 1
+        """)
+        contoh = cur.fetchone() or (0, "")
+        cur.execute("SELECT COALESCE(MAX(tanggal), CURRENT_DATE) FROM curah_hujan")
+        params = {"id": contoh[0], "nama": contoh[1], "ids": [contoh[0]],
+                  "awal": cur.fetchone()[0], "qc": QC_SARING}
+
+        # seq scan dimatikan: tabel kecil / partisi kosong memang lebih murah
+        # di-seq scan, yang dicek di sini apakah indeksnya bisa dipakai
+        cur.execute("SET LOCAL enable_seqscan = off")
+        click.echo("rencana query (enable_seqscan = off):")
+        for nama, sql in CEK_QUERY_DB.items():
+            cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            node = node_rencana(cur.fetchone()[0][0]["Plan"])
+            # indeks per partisi (curah_hujan_2025_pkey, ...) diringkas
+            scan = [f"{jenis}({re.sub(r'_[0-9]{4}_', '_*_', indeks)})" if indeks else jenis
+                    for jenis, indeks in node if "Scan" in jenis]
+            seq = any(jenis == "Seq Scan" for jenis, _ in node)
+            click.echo(f"  {'TANPA INDEKS' if seq else 'ok':<12} {nama:<26} "
+                       f"{', '.join(dict.fromkeys(scan))}")
+    finally:
+        cur.close()
+        conn.rollback()
+
+
+# ============================================================
+# DEBUG: CEK DB & VERSI POSTGRES
+# ============================================================
+@app.route("/debug_db")
+def debug_db():
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT current_database(), version();")
+    db_name, ver = cur.fetchone()
+    cur.close()
+    return f"DB: {db_name}<br>Versi: {ver}"
+
+
+# ============================================================
+# DEBUG: STATISTIK POOL KONEKSI
+# ============================================================
+@app.route("/debug_pool")
+def debug_pool():
+    return jsonify(get_pool().stats())
+
+
+# ============================================================
+# BENCHMARK (flask --app app bench-siapkan)
+# ============================================================
+FILE_EXPORT_BAWAAN = [
+    "export-pos-hujan-2025-01-01-2025-11-25.csv",
+    "export-pos-hujan-2025-02-01-2025-11-25.csv",
+]
+
+
+def _siapkan_baris_iterrows(df_use, mapping):
+    # Cara lama (loop per baris), hanya dipakai sebagai pembanding benchmark
+    gagal_pos = []
+    rows_insert = []
+    for _, row in df_use.iterrows():
+        if pd.isna(row["tanggal"]) or pd.isna(row["curah_hujan"]):
+            continue
+
+        nama_pos_asli = str(row["pos_hujan"]).strip()
+        id_pos = mapping.get(nama_pos_asli.lower())
+        if not id_pos:
+            gagal_pos.append(nama_pos_asli)
+            continue
+
+        rows_insert.append((id_pos, row["tanggal"], float(row["curah_hujan"]), SUMBER_UPLOAD))
+    return rows_insert, sorted(set(gagal_pos))
+
+
+@app.cli.command("bench-siapkan")
+@click.option("--ulang", default=3, show_default=True, help="Jumlah pengulangan per cara.")
+def bench_siapkan(ulang):
+    """Bandingkan persiapan baris iterrows vs per kolom pada file export bawaan."""
+    folder = os.path.dirname(os.path.abspath(__file__))
+
+    for nama_file in FILE_EXPORT_BAWAAN:
+        df = pd.read_csv(os.path.join(folder, nama_file))
+        # File export BMKG: NAME, DATA TIMESTAMP, RAINFALL DAY MM
+        df.columns = ["pos_hujan", "tanggal", "curah_hujan"]
+        df_use = bersihkan_ch(df)
+
+        # Pura-pura ~5% pos belum ada di metadata
+        nama_unik = sorted(df_use["pos_hujan"].astype(str).str.strip().str.lower().unique())
+        terdaftar = nama_unik[: int(len(nama_unik) * 0.95)]
+        mapping_dict = {nama: i + 1 for i, nama in enumerate(terdaftar)}
+        mapping = pd.Series(mapping_dict, dtype=object)
+
+        hasil = {}
+        for label, fungsi, arg in [
+            ("iterrows", _siapkan_baris_iterrows, mapping_dict),
+            ("kolom", siapkan_baris_ch, mapping),
+        ]:
+            terbaik = float("inf")
+            for _ in range(ulang):
+                t0 = time.perf_counter()
+                baris, gagal = fungsi(df_use, arg)
+                terbaik = min(terbaik, time.perf_counter() - t0)
+            hasil[label] = (terbaik, len(baris), len(gagal))
+
+        click.echo(f"{nama_file} ({len(df_use)} baris)")
+        for label, (detik, n_baris, n_gagal) in hasil.items():
+            click.echo(f"  {label:<9} {detik * 1000:9.1f} ms  baris={n_baris}  pos_gagal={n_gagal}")
+        click.echo(f"  speedup   {hasil['iterrows'][0] / hasil['kolom'][0]:9.1f}x")
+
+
+@app.cli.command("bench-parser")
+@click.option("--ulang", default=3, show_default=True, help="Jumlah pengulangan per parser.")
+def bench_parser(ulang):
+    """Bandingkan parser generik vs BMKG (pandas / pyarrow) pada file export bawaan."""
+    folder = os.path.dirname(os.path.abspath(__file__))
+
+    cara = [
+        ("generik", baca_file_generik, bersihkan_ch, {}),
+        ("bmkg-pandas", baca_csv_bmkg, bersihkan_ch_bmkg, {"pakai_arrow": False}),
+    ]
+    if pyarrow is not None:
+        cara.append(("bmkg-arrow", baca_csv_bmkg, bersihkan_ch_bmkg, {"pakai_arrow": True}))
+
+    for nama_file in FILE_EXPORT_BAWAAN:
+        with open(os.path.join(folder, nama_file), "rb") as f:
+            isi = f.read()
+        click.echo(f"{nama_file} (parser terpilih: {pilih_parser_ch(io.BytesIO(isi), nama_file)})")
+
+        acuan = None
+        for label, baca, bersihkan, opsi in cara:
+            terbaik = float("inf")
+            for _ in range(ulang):
+                t0 = time.perf_counter()
+                with warnings.catch_warnings():
+                    # peringatan "Could not infer format" dari parser generik
+                    warnings.simplefilter("ignore", UserWarning)
+                    df = pd.concat([bersihkan(p) for p in baca(io.BytesIO(isi), nama_file, None, **opsi)])
+                terbaik = min(terbaik, time.perf_counter() - t0)
+
+            # hasil semua parser harus sama dengan parser generik
+            hasil = df[["tanggal", "curah_hujan"]].reset_index(drop=True)
+            hasil["tanggal"] = hasil["tanggal"].astype("datetime64[ns]")
+            acuan = hasil if acuan is None else acuan
+            sama = hasil.equals(acuan)
+            click.echo(
+                f"  {label:<12} {terbaik * 1000:8.1f} ms  "
+                f"{terbaik * 1000 * 100_000 / len(df):8.1f} ms/100k baris  "
+                f"baris={len(df)}  {'sama' if sama else 'BERBEDA'}"
+            )
 
 
 # ============================================================
@@ -0,0 +1,50 @@
+import time
+
+import numpy as np
+import pytest
+
+import app
+
+
+def buat_indeks(n=3000, seed=0):
+    rng = np.random.default_rng(seed)
+    daftar = [
+        {"id_poshujan": i, "lat": float(a), "lng": float(b), "ch_terkini": None}
+        for i, (a, b) in enumerate(zip(rng.uniform(-11, 6, n), rng.uniform(95, 141, n)))
+    ]
+    return app.IndeksSpasial(daftar)
+
+
+def terdekat_brute(indeks, lat, lng, k, radius_km=None):
+    jarak = app.jarak_km(lat, lng, indeks.lat, indeks.lng)
+    idx = np.arange(len(jarak))
+    if radius_km is not None:
+        idx = idx[jarak <= radius_km]
+    idx = idx[np.lexsort((idx, jarak[idx]))][:k]
+    return idx, jarak[idx]
+
+
+@pytest.mark.parametrize("lat, lng", [
+    (-6.2, 106.8),     # di tengah sebaran pos
+    (-89.0, -179.0),   # kutub, jauh dari semua pos
+    (89.9, 0.0),
+    (40.0, 140.0),     # di luar bbox data
+])
+@pytest.mark.parametrize("k, radius_km", [(1, None), (5, None), (20, 300.0)])
+def test_terdekat_sama_dengan_brute_force(lat, lng, k, radius_km):
+    indeks = buat_indeks()
+    idx, jarak = indeks.terdekat(lat, lng, k, radius_km)
+    idx_b, jarak_b = terdekat_brute(indeks, lat, lng, k, radius_km)
+    np.testing.assert_array_equal(idx, idx_b)
+    np.testing.assert_allclose(jarak, jarak_b)
+
+
+def test_terdekat_titik_jauh_tetap_cepat():
+    indeks = buat_indeks()
+    indeks.terdekat(-6.2, 106.8, 5)
+    t0 = time.perf_counter()
+    for _ in range(20):
+        idx, _ = indeks.terdekat(-89.0, -179.0, 5)
+    per_query = (time.perf_counter() - t0) / 20
+    assert len(idx) == 5
+    assert per_query < 0.01